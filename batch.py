@@ -0,0 +1,269 @@
+from array import array
+
+import math
+import time
+
+OD_ATTRIBUTES = ('FIXEDdemand', 'P_r', 'P_r_aug', 'tel', 'a_rs', 'a_rn', 'a_rsE', 'a_rnE', 'a_rsSC')
+
+class BadScenarioException(Exception):
+   """
+   Raised if a scenario batch is specified inconsistently (e.g., a shift for
+   an unknown OD attribute, or per-OD shifts of the wrong length).
+   """
+   pass
+
+class ScenarioBatch:
+   """
+   Solves K scenarios of the relaxed/elastic/singly constrained model together
+   on one Network, with the same convex combinations (MSA) iterations as
+   Network.RELAXEDuserEquilibrium.  Scenario k has its own telework multiplier
+   teleworkMultipliers[k] and optional attractiveness shifts shifts[k], a
+   dictionary mapping an OD attribute (e.g. 'a_rs' or 'a_rnE') to either a
+   constant or a sequence indexed by OD.index that is added to the base value.
+
+   The network and OD table are parsed once and shared.  Per-scenario state is
+   kept in flat arrays, one row per scenario:
+      flows, costs, targetFlows -- K x links, indexed by link.index
+      demands, targetDemands    -- K x ODs, indexed by OD.index
+   and only the shifted attributes get their own K x ODs rows; everything else
+   is read from a single copy of the base OD columns.  The per-scenario OD rows
+   use the network's storage precision (see Network.setPrecision); the base
+   columns stay in double precision, so applyScenario writes the unshifted
+   attributes back unchanged.  Link performance (the network's array kernels,
+   see linkfunctions.py), demand shifting and gap bookkeeping work directly on
+   the link and OD arrays.  Shortest paths are computed per scenario, and each
+   tree is used both for the skims feeding the demand function and for the
+   all-or-nothing loading, so every iteration does one shortest path per origin
+   and scenario (the single-scenario solver does two).
+
+   After solve(), applyScenario(k) copies scenario k's flows, costs and
+   demands back into the Network so the usual output methods can be used.
+   """
+
+   def __init__(self, network, teleworkMultipliers, shifts = None, demandFunction = None):
+      self.network = network
+      self.numScenarios = len(teleworkMultipliers)
+      self.teleworkMultipliers = list(teleworkMultipliers)
+      if shifts is None:
+         shifts = [dict() for k in range(self.numScenarios)]
+      if len(shifts) != self.numScenarios:
+         raise BadScenarioException("Need one shift dictionary per telework multiplier")
+      demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+      self.demandKernel = self.kernelFor(demandFunction)
+
+      numLinks = len(network.linkList)
+      numODs = len(network.ODlist)
+
+      # Shared base columns, one copy for all scenarios
+      self.base = dict()
+      storageType = network.storageType
+      for attribute in OD_ATTRIBUTES:
+         self.base[attribute] = array('d', [getattr(od, attribute) for od in network.ODlist])
+      self.destination = array('i', [od.destination for od in network.ODlist])
+      self.originRange = dict()
+      for origin, ods in network.originODs.items():
+         self.originRange[origin] = (ods[0].index, ods[-1].index + 1)
+
+      # Per-scenario parameter rows; unshifted attributes share the base column
+      self.parameters = list()
+      for k in range(self.numScenarios):
+         parameters = dict(self.base)
+         for attribute, shift in shifts[k].items():
+            if attribute not in self.base:
+               raise BadScenarioException("Unknown OD attribute " + str(attribute))
+            column = array(storageType, self.base[attribute])
+            if isinstance(shift, (int, float)):
+               for i in range(numODs):
+                  column[i] += shift
+            else:
+               if len(shift) != numODs:
+                  raise BadScenarioException("Shift for %s has %d entries, expected %d" % (attribute, len(shift), numODs))
+               for i in range(numODs):
+                  column[i] += shift[i]
+            parameters[attribute] = column
+         self.parameters.append(parameters)
+
+      blankLinks = array('d', [0.0]) * numLinks
+      blankODs = array(storageType, [0.0]) * numODs
+      self.flows = [array('d', blankLinks) for k in range(self.numScenarios)]
+      self.costs = [array('d', blankLinks) for k in range(self.numScenarios)]
+      self.targetFlows = [array('d', blankLinks) for k in range(self.numScenarios)]
+      self.demands = [array(storageType, blankODs) for k in range(self.numScenarios)]
+      self.targetDemands = [array(storageType, blankODs) for k in range(self.numScenarios)]
+      self.blankLinks = blankLinks
+
+      self.TSTT = [0.0] * self.numScenarios
+      self.SPTT = [0.0] * self.numScenarios
+      self.TMF = [9999.0] * self.numScenarios
+      self.totalDemand = [0.0] * self.numScenarios
+      self.iterations = [0] * self.numScenarios
+
+   def kernelFor(self, demandFunction):
+      """
+      Maps one of the Network.targetDemands* methods to the matching array
+      kernel below.
+      """
+      kernels = {'targetDemandsRelaxed' : self.relaxedKernel,
+                 'targetDemandsElastic' : self.elasticKernel,
+                 'targetDemandsSinglyConstrained' : self.singlyConstrainedKernel,
+                 'targetDemandsStatic' : self.staticKernel}
+      name = getattr(demandFunction, '__name__', str(demandFunction))
+      if name not in kernels:
+         raise BadScenarioException("No batch kernel for demand function " + name)
+      return kernels[name]
+
+   def relaxedKernel(self, k, lo, hi, cost, out):
+      p = self.parameters[k]
+      a_rs, a_rn, P_r_aug, destination = p['a_rs'], p['a_rn'], p['P_r_aug'], self.destination
+      weights = [math.exp(a_rs[i] - cost[destination[i]]) for i in range(lo, hi)]
+      denominator = sum(weights)
+      multiplier = self.teleworkMultipliers[k]
+      for i in range(lo, hi):
+         out[i] = P_r_aug[i] * weights[i - lo] / (denominator + math.exp(a_rn[i] * multiplier))
+
+   def elasticKernel(self, k, lo, hi, cost, out):
+      p = self.parameters[k]
+      a_rsE, a_rnE, FIXEDdemand, tel, destination = p['a_rsE'], p['a_rnE'], p['FIXEDdemand'], p['tel'], self.destination
+      multiplier = self.teleworkMultipliers[k]
+      for i in range(lo, hi):
+         weight = math.exp(a_rsE[i] - cost[destination[i]])
+         out[i] = (FIXEDdemand[i] / (1 - tel[i])) * weight / (weight + math.exp(a_rnE[i] * multiplier))
+
+   def singlyConstrainedKernel(self, k, lo, hi, cost, out):
+      p = self.parameters[k]
+      a_rsSC, P_r, FIXEDdemand, destination = p['a_rsSC'], p['P_r'], p['FIXEDdemand'], self.destination
+      weights = [math.exp(a_rsSC[i] - cost[destination[i]]) for i in range(lo, hi)]
+      denominator = sum(weights)
+      for i in range(lo, hi):
+         if denominator < 0.0000001:
+            out[i] = FIXEDdemand[i]
+         else:
+            out[i] = P_r[i] * weights[i - lo] / denominator
+
+   def staticKernel(self, k, lo, hi, cost, out):
+      FIXEDdemand = self.parameters[k]['FIXEDdemand']
+      for i in range(lo, hi):
+         out[i] = FIXEDdemand[i]
+
+   def updateCosts(self, scenarios):
+      """
+      Link performance (the network's link functions, see
+      Network.setLinkFunction) for all given scenarios in one pass over the
+      links (LinkPerformance.costRows); also recomputes TSTT for those
+      scenarios.
+      """
+      TSTT = self.network.linkPerformance.costRows([self.flows[k] for k in scenarios],
+                                                   [self.costs[k] for k in scenarios])
+      for k, scenarioTSTT in zip(scenarios, TSTT):
+         self.TSTT[k] = scenarioTSTT
+
+   def shift(self, scenarios, stepSize):
+      """
+      Moves flows and demands of the given scenarios towards their targets,
+      accumulating TMF and total demand, then updates link costs.
+      """
+      for k in scenarios:
+         flows, targetFlows = self.flows[k], self.targetFlows[k]
+         for i in range(len(flows)):
+            flows[i] = (1 - stepSize) * flows[i] + stepSize * targetFlows[i]
+         demands, targetDemands = self.demands[k], self.targetDemands[k]
+         TMF = 0.0
+         totalDemand = 0.0
+         for i in range(len(demands)):
+            TMF += abs(targetDemands[i] - demands[i])
+            demands[i] = (1 - stepSize) * demands[i] + stepSize * targetDemands[i]
+            totalDemand += demands[i]
+         self.TMF[k] = TMF
+         self.totalDemand[k] = totalDemand
+      self.updateCosts(scenarios)
+
+   def targets(self, k, useDemandKernel = True):
+      """
+      One shortest path tree per origin at scenario k's costs: computes target
+      demands with the demand kernel (or loads the current demands if
+      useDemandKernel is False) and loads them onto the same tree.
+      """
+      network = self.network
+      targetFlows = self.targetFlows[k]
+      targetFlows[:] = self.blankLinks
+      targetDemands = self.targetDemands[k]
+      SPTT = 0.0
+      for origin in network.relevant_origins:
+         cost = network.shortestPathLabels(origin, self.costs[k])[0]
+         lo, hi = self.originRange[origin]
+         if useDemandKernel:
+            self.demandKernel(k, lo, hi, cost, targetDemands)
+         else:
+            targetDemands[lo:hi] = self.demands[k][lo:hi]
+         SPTT += network.loadOriginTree(origin, targetDemands, targetFlows)
+      self.SPTT[k] = SPTT
+
+   def solve(self, maxIterations = 10, targetGap = 1e-6, targetGap2 = 1e-2):
+      """
+      Solves all scenarios with MSA.  The gaps are the average excess cost and
+      TMF, as with RELAXEDuserEquilibrium(gapFunction = averageExcessCost,
+      gapFunction2 = TMFGap).  A scenario stops iterating once both of its
+      gaps are below target; the batch stops when all have, or after
+      maxIterations.
+      """
+      network = self.network
+      network.refreshLinkParameters()
+      scenarios = list(range(self.numScenarios))
+
+      # Same starting point as Network.reset: fixed demand, free-flow times
+      freeFlow = array('d', [link.freeFlowTime for link in network.linkList])
+      for k in scenarios:
+         self.demands[k][:] = array(self.demands[k].typecode, self.parameters[k]['FIXEDdemand'])
+         self.totalDemand[k] = sum(self.demands[k])
+         self.TMF[k] = 9999.0
+         self.costs[k][:] = freeFlow
+         self.targets(k, useDemandKernel = False)
+         self.flows[k][:] = self.targetFlows[k]
+      self.updateCosts(scenarios)
+
+      active = scenarios
+      iteration = 0
+      startTime = time.time()
+      while iteration < maxIterations and len(active) > 0:
+         iteration += 1
+         stillActive = list()
+         for k in active:
+            self.iterations[k] = iteration
+            gap = (self.TSTT[k] - self.SPTT[k]) / self.totalDemand[k]
+            if self.network.iterationLog is not None:
+               self.network.iterationLog("Scenario %d iteration %d: AEC %f: TMF %f: time %f"
+                                         % (k, iteration, gap, self.TMF[k], time.time() - startTime))
+            if gap < targetGap and self.TMF[k] < targetGap2:
+               continue
+            stillActive.append(k)
+         active = stillActive
+         for k in active:
+            self.targets(k)
+         self.shift(active, 1 / (iteration + 1))
+
+   def averageExcessCost(self, k):
+      return (self.TSTT[k] - self.SPTT[k]) / self.totalDemand[k]
+
+   def applyScenario(self, k):
+      """
+      Copies scenario k's link flows and costs, OD demands, attractiveness
+      parameters and gap bookkeeping into the Network, so that printResults and
+      the other Network methods report on this scenario.  Note that this
+      overwrites the network's base attractiveness values with the shifted ones.
+      """
+      network = self.network
+      flows, costs = self.flows[k], self.costs[k]
+      for link in network.linkList:
+         link.flow = flows[link.index]
+         link.cost = costs[link.index]
+      parameters, demands = self.parameters[k], self.demands[k]
+      for od in network.ODlist:
+         od.demand = demands[od.index]
+         for attribute in OD_ATTRIBUTES:
+            setattr(od, attribute, parameters[attribute][od.index])
+      network.telework_multiplier = self.teleworkMultipliers[k]
+      network.TSTT = self.TSTT[k]
+      network.SPTT = self.SPTT[k]
+      network.TMF = self.TMF[k]
+      network.totalDemand = self.totalDemand[k]
+      network.refreshLinkCosts()
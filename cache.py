@@ -0,0 +1,399 @@
+from network import Network, PRECISIONS
+from batch import OD_ATTRIBUTES
+from results import AssignmentResult
+from pipeline import loadNetwork
+
+from array import array
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+DEFAULT_CACHE_SIZE = 2**30 # bytes kept in a cache directory before the least recently used entries go
+WARM_STEP_OFFSET = 10 # MSA step offset of a solve warm-started from a cached neighbour
+ARRAYS = ('linkFlows', 'demands', 'travelTimes')
+
+def networkDigest(network):
+   """
+   Content hash of everything a solve depends on that is held in the
+   network: the link topology, parameters and performance functions, the
+   toll and distance factors, and the OD pairs with their demand and
+   attractiveness attributes (OD_ATTRIBUTES).  It covers changes made in
+   memory (e.g. by scenario.py) as well as the input files.  Node
+   coordinates are not included, as they do not affect the equilibrium.
+   """
+   digest = hashlib.sha256()
+   digest.update(json.dumps([network.numZones, network.firstThroughNode, network.tollFactor,
+                             network.distanceFactor]).encode('utf-8'))
+   linkList = network.linkList
+   digest.update(array('i', [link.tail for link in linkList]).tobytes())
+   digest.update(array('i', [link.head for link in linkList]).tobytes())
+   for attribute in ('capacity', 'length', 'freeFlowTime', 'alpha', 'beta', 'toll'):
+      digest.update(array('d', [getattr(link, attribute) for link in linkList]).tobytes())
+   digest.update("\n".join("%s %r" % (link.linkType, link.function) for link in linkList).encode('utf-8'))
+   ODlist = network.ODlist
+   digest.update(array('i', [od.origin for od in ODlist]).tobytes())
+   digest.update(array('i', [od.destination for od in ODlist]).tobytes())
+   for attribute in OD_ATTRIBUTES:
+      digest.update(array('d', [getattr(od, attribute) for od in ODlist]).tobytes())
+   return digest.hexdigest()
+
+def functionName(network, function, default):
+   """
+   Name of a gap or demand function given to a solve, if it is one of the
+   network's own methods (None for the solver default); otherwise None,
+   as the function cannot be recreated from its name.
+   """
+   if function is None:
+      return default
+   if getattr(function, '__self__', None) is network and hasattr(Network, function.__name__):
+      return function.__name__
+   return None
+
+def settingsKey(inputs, settings):
+   return hashlib.sha256(json.dumps({'inputs' : inputs, 'settings' : settings}, sort_keys = True).encode('utf-8')).hexdigest()
+
+class ResultCache:
+   """
+   Cache of solved equilibria in a directory, shared by sessions and
+   processes, so that reruns of the same scenario (same network data,
+   demand function, telework multiplier, step size rule and gap targets)
+   return the stored solution instead of solving again:
+      cache = ResultCache("tap_cache")
+      result = cache.solve(net, net.targetDemandsElastic, teleworkMultiplier = 1.0, ...)
+   solve takes the arguments of Network.solve.  Entries are keyed by a
+   hash of the solver settings and of the network's data (networkDigest).
+   On a hit, the stored link flows, OD demands and travel times, and the
+   TSTT/SPTT/TMF of the solve, are put back into the network, so the
+   returned AssignmentResult and the network are as after the original
+   solve.  On a miss, the nearest entry of the same network, demand
+   function and precision, within warmDistance in telework multiplier, is
+   loaded instead and the solve is warm-started from it.  A warm-started
+   solve is only kept if it converges, since one stopped at maxIterations
+   depends on where it started; otherwise the scenario is solved again from
+   a cold start.  The new result is stored either way.  lastOutcome records
+   what happened: 'hit', 'warm', 'miss' or 'bypass' (solves with custom gap
+   functions, or with origin flow tracking on, are not cached).
+
+   Each entry is a pair of files named by its key: key.bin holds the
+   arrays (ARRAYS, doubles indexed by link.index and OD.index) and
+   key.json the settings, network scalars and convergence history.  The
+   json file is written last, so an entry exists once it is there.  When
+   the directory grows beyond maxBytes, the least recently used entries
+   (by the json file's modification time, renewed on every use) are
+   deleted.
+   """
+
+   def __init__(self, directory, maxBytes = DEFAULT_CACHE_SIZE, warmDistance = 0.25, log = print):
+      self.directory = directory
+      self.maxBytes = maxBytes
+      self.warmDistance = warmDistance
+      self.log = log
+      self.lastOutcome = None
+      os.makedirs(directory, exist_ok = True)
+
+   def path(self, key, extension):
+      return os.path.join(self.directory, key + extension)
+
+   def entries(self):
+      """
+      Metadata of all entries, least recently used first.
+      """
+      entries = list()
+      for fileName in os.listdir(self.directory):
+         if not fileName.endswith('.json'):
+            continue
+         try:
+            with open(os.path.join(self.directory, fileName), 'r') as f:
+               metadata = json.load(f)
+            metadata['lastUsed'] = os.path.getmtime(os.path.join(self.directory, fileName))
+         except (OSError, ValueError):
+            continue # removed or being replaced by another process
+         entries.append(metadata)
+      entries.sort(key = lambda metadata : metadata['lastUsed'])
+      return entries
+
+   def settings(self, network, demandFunction, stepSizeRule, maxIterations, targetGap, targetGap2,
+                gapFunction, gapFunction2, teleworkMultiplier):
+      """
+      The settings part of the key, or None if the solve cannot be cached.
+      """
+      settings = {'demandFunction' : functionName(network, demandFunction, 'targetDemandsRelaxed'),
+                  'gapFunction' : functionName(network, gapFunction, 'averageExcessCost'),
+                  'gapFunction2' : functionName(network, gapFunction2, 'TMFGap'),
+                  'stepSizeRule' : stepSizeRule, 'maxIterations' : maxIterations,
+                  'targetGap' : targetGap, 'targetGap2' : targetGap2,
+                  'teleworkMultiplier' : teleworkMultiplier, 'storageType' : network.storageType}
+      if None in (settings['demandFunction'], settings['gapFunction'], settings['gapFunction2']):
+         return None
+      if network.originFlows is not None:
+         return None
+      return settings
+
+   def solve(self, network, demandFunction = None, stepSizeRule = 'MSA', maxIterations = 10, targetGap = 1e-6,
+             targetGap2 = 1e-2, gapFunction = None, gapFunction2 = None, teleworkMultiplier = 0, verbose = False):
+      """
+      Network.solve through the cache; see the class docstring.
+      """
+      settings = self.settings(network, demandFunction, stepSizeRule, maxIterations, targetGap, targetGap2,
+                               gapFunction, gapFunction2, teleworkMultiplier)
+      arguments = dict(demandFunction = demandFunction, stepSizeRule = stepSizeRule, maxIterations = maxIterations,
+                       targetGap = targetGap, targetGap2 = targetGap2, gapFunction = gapFunction,
+                       gapFunction2 = gapFunction2, teleworkMultiplier = teleworkMultiplier, verbose = verbose)
+      if settings is None:
+         self.lastOutcome = 'bypass'
+         return network.solve(**arguments)
+      inputs = networkDigest(network)
+      key = settingsKey(inputs, settings)
+      result = self.load(network, key)
+      if result is not None:
+         self.lastOutcome = 'hit'
+         self.report("Cache hit %s" % key[:12])
+         return result
+
+      neighbour = self.nearest(inputs, settings)
+      if neighbour is not None and self.load(network, neighbour['key']) is not None:
+         self.lastOutcome = 'warm'
+         self.report("Cache miss %s; warm start from %s (telework multiplier %g)"
+                     % (key[:12], neighbour['key'][:12], neighbour['settings']['teleworkMultiplier']))
+         result = network.solve(warmStart = True, stepOffset = WARM_STEP_OFFSET, **arguments)
+         warmStartedFrom = neighbour['key']
+         if result.stopReason != 'converged':
+            self.lastOutcome = 'miss'
+            self.report("Warm start stopped (%s); solving %s from a cold start" % (result.stopReason, key[:12]))
+            result = network.solve(**arguments)
+            warmStartedFrom = None
+      else:
+         self.lastOutcome = 'miss'
+         self.report("Cache miss %s" % key[:12])
+         result = network.solve(**arguments)
+         warmStartedFrom = None
+      self.store(network, key, inputs, settings, result, warmStartedFrom)
+      return result
+
+   def report(self, message):
+      if self.log is not None:
+         self.log(message)
+
+   def nearest(self, inputs, settings):
+      """
+      The entry of the same network data, demand function, gap functions
+      and precision with the closest telework multiplier, within
+      warmDistance; ties go to the tighter gap target.
+      """
+      family = ('demandFunction', 'gapFunction', 'gapFunction2', 'storageType')
+      best = None
+      for metadata in self.entries():
+         if metadata['inputs'] != inputs:
+            continue
+         if any(metadata['settings'][name] != settings[name] for name in family):
+            continue
+         distance = abs(metadata['settings']['teleworkMultiplier'] - settings['teleworkMultiplier'])
+         if distance > self.warmDistance:
+            continue
+         rank = (distance, metadata['settings']['targetGap'], metadata['settings']['targetGap2'])
+         if best is None or rank < best[0]:
+            best = (rank, metadata)
+      return best[1] if best is not None else None
+
+   def readArrays(self, key, metadata):
+      """
+      The stored arrays of an entry, or None if its data file is missing or
+      does not match its metadata.
+      """
+      sizes = {'linkFlows' : metadata['numLinks'], 'demands' : metadata['numODs'], 'travelTimes' : metadata['numODs']}
+      values = array('d')
+      try:
+         with open(self.path(key, '.bin'), 'rb') as f:
+            values.frombytes(f.read())
+      except OSError:
+         return None
+      if len(values) != sum(sizes.values()):
+         return None
+      arrays = dict()
+      start = 0
+      for name in ARRAYS:
+         arrays[name] = values[start : start + sizes[name]]
+         start += sizes[name]
+      return arrays
+
+   def load(self, network, key):
+      """
+      Puts entry key into the network and returns its AssignmentResult, or
+      returns None if there is no usable entry (a warm-started entry that did
+      not converge is not used).
+      """
+      try:
+         with open(self.path(key, '.json'), 'r') as f:
+            metadata = json.load(f)
+      except (OSError, ValueError):
+         return None
+      if metadata['warmStartedFrom'] is not None and metadata['state']['stopReason'] != 'converged':
+         return None
+      if metadata['numLinks'] != len(network.linkList) or metadata['numODs'] != len(network.ODlist):
+         return None
+      arrays = self.readArrays(key, metadata)
+      if arrays is None:
+         self.remove(key)
+         return None
+      try:
+         os.utime(self.path(key, '.json'))
+      except OSError:
+         pass
+
+      linkFlows, demands, travelTimes = (arrays[name] for name in ARRAYS)
+      for link in network.linkList:
+         link.flow = linkFlows[link.index]
+         link.updateCost()
+      network.refreshLinkCosts()
+      for od in network.ODlist:
+         od.demand = demands[od.index]
+         od.k_rs = travelTimes[od.index]
+      state = metadata['state']
+      network.telework_multiplier = metadata['settings']['teleworkMultiplier']
+      network.TSTT = state['TSTT']
+      network.SPTT = state['SPTT']
+      network.TMF = state['TMF']
+      network.totalDemand = state['totalDemand']
+      network.iterations = state['iterations']
+      network.stopReason = state['stopReason']
+      network.convergenceHistory = [tuple(record) for record in state['convergenceHistory']]
+      network.pendingTargets = None
+      network.lastStepSize = None
+      return AssignmentResult(network, state['solveTime'])
+
+   def store(self, network, key, inputs, settings, result, warmStartedFrom = None):
+      metadata = {'key' : key, 'inputs' : inputs, 'settings' : settings, 'network' : network.name,
+                  'numLinks' : len(result.linkFlows), 'numODs' : len(result.demands),
+                  'created' : time.strftime("%Y-%m-%d %H:%M:%S"), 'warmStartedFrom' : warmStartedFrom,
+                  'state' : {'TSTT' : network.TSTT, 'SPTT' : network.SPTT, 'TMF' : network.TMF,
+                             'totalDemand' : network.totalDemand, 'iterations' : result.iterations,
+                             'stopReason' : result.stopReason, 'solveTime' : result.solveTime,
+                             'convergenceHistory' : result.convergenceHistory}}
+      # Write to temporary names and rename, so other processes never see a
+      # partial entry; the json file commits it.
+      for extension, write in (('.bin', lambda f : [array('d', result.linkFlows).tofile(f),
+                                                    array('d', result.demands).tofile(f),
+                                                    array('d', result.travelTimes).tofile(f)]),
+                               ('.json', lambda f : f.write(json.dumps(metadata).encode('utf-8')))):
+         temporaryName = self.path(key, extension + ".tmp")
+         with open(temporaryName, 'wb') as f:
+            write(f)
+         os.replace(temporaryName, self.path(key, extension))
+      self.evict(keep = key)
+
+   def entryBytes(self, key):
+      total = 0
+      for extension in ('.bin', '.json'):
+         try:
+            total += os.path.getsize(self.path(key, extension))
+         except OSError:
+            pass
+      return total
+
+   def evict(self, keep = None):
+      """
+      Deletes least recently used entries until the directory holds at
+      most maxBytes (the entry keep is spared).
+      """
+      entries = self.entries()
+      total = sum(self.entryBytes(metadata['key']) for metadata in entries)
+      for metadata in entries:
+         if total <= self.maxBytes:
+            break
+         if metadata['key'] == keep:
+            continue
+         total -= self.entryBytes(metadata['key'])
+         self.remove(metadata['key'])
+         self.report("Cache entry %s evicted" % metadata['key'][:12])
+
+   def remove(self, key):
+      for extension in ('.json', '.bin'):
+         try:
+            os.remove(self.path(key, extension))
+         except OSError:
+            pass
+
+   def verify(self, network, sample = 3, tolerance = 1e-6, warmTolerance = 1e-2, evict = False):
+      """
+      Recomputes up to sample randomly chosen entries of this network's
+      data from scratch and compares link flows and OD demands with the
+      stored ones.  An entry passes if the largest difference, relative to
+      the largest stored value, is within tolerance (warmTolerance for
+      entries that were solved from a warm start, which converge to the
+      same equilibrium along a different path).  Returns a list of (key,
+      passed, flow difference, demand difference); failed entries are
+      deleted if evict is True.  The network is left at the last
+      recomputed solution.
+      """
+      inputs = networkDigest(network)
+      candidates = [metadata for metadata in self.entries() if metadata['inputs'] == inputs]
+      self.report("%d of the cache entries are for this network" % len(candidates))
+      storageTypes = dict((typecode, precision) for precision, typecode in PRECISIONS.items())
+      outcomes = list()
+      for metadata in random.sample(candidates, min(sample, len(candidates))):
+         settings = metadata['settings']
+         arrays = self.readArrays(metadata['key'], metadata)
+         if arrays is None:
+            outcomes.append((metadata['key'], False, None, None))
+            continue
+         if network.storageType != settings['storageType']:
+            network.setPrecision(storageTypes[settings['storageType']])
+         result = network.solve(getattr(network, settings['demandFunction']), settings['stepSizeRule'],
+                                settings['maxIterations'], settings['targetGap'], settings['targetGap2'],
+                                getattr(network, settings['gapFunction']), getattr(network, settings['gapFunction2']),
+                                settings['teleworkMultiplier'])
+         differences = list()
+         for stored, computed in ((arrays['linkFlows'], result.linkFlows), (arrays['demands'], result.demands)):
+            scale = max([abs(value) for value in stored] + [1.0])
+            differences.append(max([abs(a - b) for a, b in zip(stored, computed)] + [0.0]) / scale)
+         limit = warmTolerance if metadata['warmStartedFrom'] is not None else tolerance
+         passed = max(differences) <= limit
+         outcomes.append((metadata['key'], passed, differences[0], differences[1]))
+         self.report("%s %s: telework multiplier %g, flow difference %.3g, demand difference %.3g"
+                     % (metadata['key'][:12], "ok" if passed else "MISMATCH", settings['teleworkMultiplier'],
+                        differences[0], differences[1]))
+         if not passed and evict:
+            self.remove(metadata['key'])
+      return outcomes
+
+def main(arguments = None):
+   parser = argparse.ArgumentParser(description = "Inspect or verify a result cache (see ResultCache)")
+   parser.add_argument('mode', choices = ['list', 'verify'])
+   parser.add_argument('directory', help = "cache directory")
+   parser.add_argument('network', nargs = '?', help = "TNTP network file (verify)")
+   parser.add_argument('demand', nargs = '?', help = "TNTP trips file (verify)")
+   parser.add_argument('--nodes', help = "node file (see Network.readNodeFile)")
+   parser.add_argument('--attributes', help = "attractiveness file (see Network.readODFile)")
+   parser.add_argument('--sample', type = int, default = 3, help = "entries to recompute")
+   parser.add_argument('--tolerance', type = float, default = 1e-6)
+   parser.add_argument('--warm-tolerance', type = float, default = 1e-2)
+   parser.add_argument('--evict', action = 'store_true', help = "delete entries that fail verification")
+   options = parser.parse_args(arguments)
+
+   cache = ResultCache(options.directory)
+   if options.mode == 'list':
+      for metadata in cache.entries():
+         settings = metadata['settings']
+         print("%s %s %s telework %g %s %d iterations (%s) %.1f MB, last used %s%s" % (
+            metadata['key'][:12], metadata['network'], settings['demandFunction'], settings['teleworkMultiplier'],
+            settings['stepSizeRule'], metadata['state']['iterations'], metadata['state']['stopReason'],
+            cache.entryBytes(metadata['key']) / 2**20,
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(metadata['lastUsed'])),
+            ", warm started" if metadata['warmStartedFrom'] is not None else ""))
+      return 0
+   if options.network is None or options.demand is None:
+      parser.error("verify needs the network and trips files")
+   network = loadNetwork(options.network, options.demand, options.nodes, options.attributes)
+   network.iterationLog = None
+   outcomes = cache.verify(network, options.sample, options.tolerance, options.warm_tolerance, options.evict)
+   failed = [key for key, passed, flowDifference, demandDifference in outcomes if not passed]
+   print("%d entries verified, %d failed" % (len(outcomes), len(failed)))
+   return 1 if failed else 0
+
+if __name__ == '__main__':
+   sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,113 @@
+from network import BadNetworkOperationException, DEMAND_UTILITIES
+
+import math
+
+class DualityGap:
+   """
+   Rigorous convergence measure for the equilibrium models, based on the
+   convex program they solve.  With Beckmann function B(x) and the demand
+   term D(d) of Network.demandObjective, the equilibrium minimizes
+   Z = B(x) + D(d) over flows x loading demands d.  Linearizing B at the
+   current flows and minimizing over d exactly -- which gives the targets of
+   the demand function g, loaded all-or-nothing -- yields the Frank-Wolfe
+   lower bound
+      LB = Z - (TSTT - SPTT(g)) - (D(d) - D(g))
+   on the optimal objective, so the duality gap Z - LB >= 0 is zero exactly
+   at equilibrium, and bounds how far the objective is from optimal.  Both
+   parts are computed from the current link flows and OD demands, unlike
+   averageExcessCost (whose SPTT dates from the previous all-or-nothing
+   assignment) and TMFGap (an L1 distance without an optimality meaning).
+
+   averageDualityGap (also the object itself when called) divides the gap by
+   the total demand, so it is in the same units as averageExcessCost, with
+   which it coincides for static demand; pass either as the gapFunction of
+   RELAXEDuserEquilibrium or userEquilibrium.  The targets and all-or-nothing
+   flows computed for the bound are left in the network's buffers and reused
+   by the solver's next step, so using this measure costs no shortest paths
+   beyond the iteration's own.  Evaluations at the same link costs are shared,
+   so it can serve as gapFunction and gapFunction2 at once.
+   """
+
+   def __init__(self, network, demandFunction = None):
+      demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+      self.network = network
+      self.demandFunction = demandFunction
+      self.name = demandFunction.__name__
+      if self.name not in DEMAND_UTILITIES:
+         raise BadNetworkOperationException("No convex objective for demand function " + self.name)
+      self.originDemands = network.originDemandFunction(demandFunction)
+      self.bestLowerBound = -math.inf
+      self.key = None
+
+   def demandObjective(self, demands):
+      """
+      The demand term D of the objective for the given demands, indexed by
+      OD.index; see Network.demandObjective.
+      """
+      return self.network.demandObjective(demands, self.demandFunction)
+
+   def evaluate(self):
+      """
+      Computes the objective, lower bound and duality gap at the current
+      link flows and OD demands, with one shortest path tree per origin, and
+      returns (objective, lower bound, gap).  The target demands and their
+      all-or-nothing flows are left in targetDemandBuffer and
+      targetFlowBuffer, with SPTT set as by allOrNothingDemand.
+      """
+      network = self.network
+      key = (network.costState(), self.name)
+      if self.key == key and network.pendingTargets == key:
+         return (self.objectiveValue, self.lowerBoundValue, self.gapValue)
+
+      targetDemands = network.targetDemandBuffer
+      targetFlows = network.targetFlowBuffer
+      targetFlows[:] = network.blankLinkBuffer
+      originFlows = network.originFlows
+      network.SPTT = 0
+      for origin in network.relevant_origins:
+         cost = network.shortestPathLabels(origin)[0]
+         self.originDemands(origin, cost, targetDemands)
+         network.SPTT += network.loadOriginTree(origin, targetDemands, targetFlows)
+         if originFlows is not None:
+            originFlows.recordTree(origin, targetDemands)
+
+      demands = network.currentDemands()
+      TSTT = 0.0
+      for link in network.linkList:
+         TSTT += link.flow * link.cost
+      currentTerm = self.demandObjective(demands)
+      gap = (TSTT - network.SPTT) + (currentTerm - self.demandObjective(targetDemands))
+      objective = network.beckmannFunction() + currentTerm
+      self.objectiveValue = objective
+      self.lowerBoundValue = objective - gap
+      self.gapValue = gap
+      self.bestLowerBound = max(self.bestLowerBound, self.lowerBoundValue)
+      self.key = key
+      network.pendingTargets = key
+      return (objective, self.lowerBoundValue, gap)
+
+   def objective(self):
+      return self.evaluate()[0]
+
+   def lowerBound(self):
+      return self.evaluate()[1]
+
+   def dualityGap(self):
+      return self.evaluate()[2]
+
+   def averageDualityGap(self):
+      gap = self.evaluate()[2]
+      totalDemand = sum(self.network.currentDemands())
+      return gap / totalDemand if totalDemand > 0 else gap
+
+   def bestDualityGap(self):
+      """
+      Objective minus the best lower bound found by any evaluation so far,
+      which is never larger than dualityGap.  Only meaningful while the
+      network and demand parameters stay the same; create a new DualityGap
+      for another scenario.
+      """
+      return self.evaluate()[0] - self.bestLowerBound
+
+   def __call__(self):
+      return self.averageDualityGap()
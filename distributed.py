@@ -0,0 +1,444 @@
+from network import Network, BadNetworkOperationException
+from link import Link
+from node import Node
+from od import OD
+from batch import OD_ATTRIBUTES
+
+from array import array
+from multiprocessing.connection import Listener, Client, wait
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+CHUNKS_PER_WORKER = 4 # origin chunks handed out per worker and iteration, for load balancing
+
+class WorkerLostException(Exception):
+   """
+   Raised inside the coordinator when a worker's connection fails or times
+   out; the worker is dropped and its chunk handed to another one.
+   """
+   pass
+
+def networkSpec(network):
+   """
+   Picklable description of what a worker needs to rebuild the network: the
+   topology and link parameters in linkList order, and the OD pairs in
+   ODlist order, so positions (link.index, OD.index) agree on both sides.
+   """
+   return {'name' : network.name,
+           'numNodes' : network.numNodes, 'numLinks' : network.numLinks, 'numZones' : network.numZones,
+           'firstThroughNode' : network.firstThroughNode,
+           'tollFactor' : network.tollFactor, 'distanceFactor' : network.distanceFactor,
+           'nodes' : [(ID, network.node[ID].isZone) for ID in network.node],
+           'links' : [(link.ID, link.tail, link.head, link.capacity, link.length, link.freeFlowTime, link.alpha,
+                       link.beta, link.speedLimit, link.toll, link.linkType) for link in network.linkList],
+           'ods' : [(od.ID, od.origin, od.destination) for od in network.ODlist],
+           'parameters' : demandParameters(network)}
+
+def demandParameters(network):
+   """
+   The OD attributes read by the demand functions, as one array('d') per
+   attribute indexed by OD.index.
+   """
+   return dict((attribute, array('d', [getattr(od, attribute) for od in network.ODlist]))
+               for attribute in OD_ATTRIBUTES)
+
+def buildNetwork(spec):
+   """
+   Rebuilds a Network from networkSpec on a worker.
+   """
+   network = Network()
+   network.name = spec['name']
+   network.numNodes = spec['numNodes']
+   network.numLinks = spec['numLinks']
+   network.numZones = spec['numZones']
+   network.firstThroughNode = spec['firstThroughNode']
+   network.tollFactor = spec['tollFactor']
+   network.distanceFactor = spec['distanceFactor']
+   for ID, isZone in spec['nodes']:
+      network.node[ID] = Node(isZone)
+   for ID, tail, head, capacity, length, freeFlowTime, alpha, beta, speedLimit, toll, linkType in spec['links']:
+      network.link[ID] = Link(network, tail, head, capacity, length, freeFlowTime, alpha, beta, speedLimit, toll, linkType)
+   for ID, origin, destination in spec['ods']:
+      network.ODpair[ID] = OD(origin, destination)
+   network.iterationLog = None
+   network.finalize()
+   setDemandParameters(network, spec['parameters'])
+   return network
+
+def setDemandParameters(network, parameters):
+   for attribute, column in parameters.items():
+      for od in network.ODlist:
+         setattr(od, attribute, column[od.index])
+
+def loadOrigins(network, origins, linkCosts, originDemands, targetDemands, flows):
+   """
+   The fused per-origin kernel run by the workers (and by the coordinator
+   for chunks no worker is left to take): one shortest path tree per origin
+   at linkCosts, target demands of its OD pairs from originDemands, and
+   their all-or-nothing loading onto the same tree.  Adds the flows to
+   flows, writes the targets into targetDemands and returns
+   (SPTT, targets, costs), the last two holding the origins' OD pairs in
+   ODlist order.
+   """
+   SPTT = 0.0
+   targets = array('d')
+   costs = array('d')
+   for origin in origins:
+      cost = network.shortestPathLabels(origin, linkCosts)[0]
+      originDemands(origin, cost, targetDemands)
+      SPTT += network.loadOriginTree(origin, targetDemands, flows)
+      for od in network.originODs[origin]:
+         targets.append(targetDemands[od.index])
+         costs.append(od.k_rs)
+   return (SPTT, targets, costs)
+
+def serveWorker(listener, log = print):
+   """
+   Worker loop: serves one coordinator connection at a time until it is
+   sent 'shutdown'.  Messages are tuples:
+      ('setup', spec)             -- rebuild the network (see networkSpec)
+      ('parameters', columns)     -- replace the OD attributes
+      ('load', request, linkCosts, demandFunction, teleworkMultiplier, origins)
+                                  -- run loadOrigins; linkCosts are the bytes
+                                     of an array('d') by link.index
+      ('close',) / ('shutdown',)  -- end the connection / the worker
+   Replies are ('ready',) or ('loaded', request, SPTT, flows, targets,
+   costs), with the arrays as bytes.
+   """
+   network = None
+   while True:
+      try:
+         connection = listener.accept()
+      except (OSError, EOFError) as error:
+         if log is not None:
+            log("Rejected coordinator connection: %s" % error)
+         continue
+      try:
+         while True:
+            message = connection.recv()
+            if message[0] == 'setup':
+               network = buildNetwork(message[1])
+               linkCosts = array('d', network.linkCosts)
+               flows = array('d', network.blankLinkBuffer)
+               connection.send(('ready',))
+            elif message[0] == 'parameters':
+               setDemandParameters(network, message[1])
+               connection.send(('ready',))
+            elif message[0] == 'load':
+               request, costBytes, demandFunction, teleworkMultiplier, origins = message[1:]
+               linkCosts[:] = array('d', costBytes)
+               flows[:] = network.blankLinkBuffer
+               network.telework_multiplier = teleworkMultiplier
+               originDemands = network.originDemandFunction(getattr(network, demandFunction))
+               SPTT, targets, costs = loadOrigins(network, origins, linkCosts, originDemands,
+                                                  network.targetDemandBuffer, flows)
+               connection.send(('loaded', request, SPTT, flows.tobytes(), targets.tobytes(), costs.tobytes()))
+            elif message[0] == 'close':
+               break
+            elif message[0] == 'shutdown':
+               connection.close()
+               return
+      except (EOFError, OSError):
+         pass # coordinator went away; wait for the next one
+      connection.close()
+
+class DistributedLoader:
+   """
+   Coordinator that spreads the shortest path, demand and all-or-nothing
+   work of each iteration over worker processes on other hosts (started
+   with "python distributed.py worker", or LocalCluster for one machine),
+   talking over multiprocessing.connection sockets authenticated with
+   authkey.  Each worker holds a copy of the network and OD attributes,
+   sent once by connect; per iteration it receives the link cost vector and
+   a chunk of origins, and returns the chunk's link flows, target demands
+   and shortest path costs (k_rs).  Origins are split into
+   CHUNKS_PER_WORKER chunks per worker, balanced by OD count, and handed out
+   as workers finish, so faster hosts take more.
+
+   A worker whose connection fails, or that takes longer than timeout
+   seconds (None waits forever) for a chunk, is dropped for the rest of the
+   run and its chunk goes to another worker; with no workers left the
+   coordinator finishes the chunks itself.
+
+   Use averageExcessCost as the gapFunction of RELAXEDuserEquilibrium (with
+   the same demandFunction): it loads the targets at the current costs,
+   sets SPTT, targetDemandBuffer, targetFlowBuffer and k_rs, and leaves them
+   pending, so the solver step reuses them and runs no shortest paths
+   locally.  After changing OD attributes (e.g. Scenario.apply), call
+   sendDemandParameters.  Origin flow tracking is not supported.
+   """
+
+   def __init__(self, network, addresses, authkey, demandFunction = None, timeout = None, log = print):
+      if network.originFlows is not None:
+         raise BadNetworkOperationException("Distributed loading does not track origin flows")
+      self.network = network
+      self.addresses = list(addresses)
+      self.authkey = authkey
+      self.demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+      self.originDemands = network.originDemandFunction(self.demandFunction)
+      self.timeout = timeout
+      self.log = log
+      self.workers = dict() # connection -> address
+      self.request = 0
+      self.localChunks = 0
+      self.originRange = dict((origin, (ods[0].index, ods[-1].index + 1)) for origin, ods in network.originODs.items())
+      self.chunks = self.makeChunks(max(1, len(self.addresses)) * CHUNKS_PER_WORKER)
+
+   def makeChunks(self, count):
+      """
+      Splits the origins into about count contiguous chunks of similar OD
+      counts.
+      """
+      origins = sorted(self.network.relevant_origins)
+      target = len(self.network.ODlist) / count
+      chunks = list()
+      chunk = list()
+      size = 0
+      for origin in origins:
+         chunk.append(origin)
+         size += len(self.network.originODs[origin])
+         if size >= target:
+            chunks.append(chunk)
+            chunk = list()
+            size = 0
+      if len(chunk) > 0:
+         chunks.append(chunk)
+      return chunks
+
+   def report(self, message):
+      if self.log is not None:
+         self.log(message)
+
+   def connect(self):
+      """
+      Connects to the workers and sends them the network; unreachable
+      workers are skipped.  Returns the number of workers connected.
+      """
+      spec = networkSpec(self.network)
+      for address in self.addresses:
+         try:
+            connection = Client(address, authkey = self.authkey)
+            connection.send(('setup', spec))
+            self.receive(connection, None)
+            self.workers[connection] = address
+         except (OSError, EOFError, WorkerLostException, multiprocessing.AuthenticationError) as error:
+            self.report("Worker %s not available: %s" % (str(address), error))
+      self.report("Connected to %d of %d workers" % (len(self.workers), len(self.addresses)))
+      return len(self.workers)
+
+   def receive(self, connection, timeout):
+      try:
+         if timeout is not None and not connection.poll(timeout):
+            raise WorkerLostException("no reply within %s seconds" % timeout)
+         return connection.recv()
+      except (OSError, EOFError) as error:
+         raise WorkerLostException(str(error) or type(error).__name__)
+
+   def drop(self, connection, error):
+      address = self.workers.pop(connection)
+      self.report("Lost worker %s (%s); %d left" % (str(address), error, len(self.workers)))
+      try:
+         connection.close()
+      except OSError:
+         pass
+
+   def sendDemandParameters(self):
+      """
+      Sends the current OD attributes to the workers.
+      """
+      parameters = demandParameters(self.network)
+      for connection in list(self.workers):
+         try:
+            connection.send(('parameters', parameters))
+            self.receive(connection, self.timeout)
+         except (OSError, WorkerLostException) as error:
+            self.drop(connection, error)
+
+   def loadTargets(self):
+      """
+      Target demands of demandFunction at the current link costs and their
+      all-or-nothing flows, computed by the workers; see the class docstring.
+      Returns targetFlowBuffer.
+      """
+      network = self.network
+      network.refreshLinkCosts()
+      costBytes = network.linkCosts.tobytes()
+      name = self.demandFunction.__name__
+      targetFlows = network.targetFlowBuffer
+      targetFlows[:] = network.blankLinkBuffer
+      targetDemands = network.targetDemandBuffer
+      self.request += 1
+      queue = list(self.chunks)
+      inFlight = dict() # connection -> (chunk, time sent)
+      SPTT = 0.0
+
+      def dispatch(connection):
+         chunk = queue.pop()
+         try:
+            connection.send(('load', self.request, costBytes, name, network.telework_multiplier, chunk))
+            inFlight[connection] = (chunk, time.time())
+         except OSError as error:
+            queue.append(chunk)
+            self.drop(connection, error)
+
+      while len(queue) > 0 or len(inFlight) > 0:
+         if len(self.workers) == 0:
+            self.localChunks += len(queue)
+            SPTT += self.loadLocally(queue, targetFlows, targetDemands)
+            queue = list()
+            break
+         for connection in [connection for connection in self.workers if connection not in inFlight]:
+            if len(queue) > 0:
+               dispatch(connection)
+         if len(inFlight) == 0:
+            continue
+         timeout = None
+         if self.timeout is not None:
+            oldest = min(sent for chunk, sent in inFlight.values())
+            timeout = max(0, oldest + self.timeout - time.time())
+         ready = wait(list(inFlight), timeout)
+         if len(ready) == 0:
+            now = time.time()
+            for connection, (chunk, sent) in list(inFlight.items()):
+               if now - sent >= self.timeout:
+                  del inFlight[connection]
+                  queue.append(chunk)
+                  self.drop(connection, "no reply within %s seconds" % self.timeout)
+         for connection in ready:
+            chunk, sent = inFlight.pop(connection)
+            try:
+               reply = self.receive(connection, None)
+               if reply[0] != 'loaded' or reply[1] != self.request:
+                  raise WorkerLostException("unexpected reply " + str(reply[0]))
+            except WorkerLostException as error:
+               queue.append(chunk)
+               self.drop(connection, error)
+               continue
+            SPTT += self.merge(chunk, reply, targetFlows, targetDemands)
+
+      network.SPTT = SPTT
+      network.pendingTargets = (network.costState(), name)
+      return targetFlows
+
+   def merge(self, chunk, reply, targetFlows, targetDemands):
+      SPTT, flowBytes, targetBytes, costBytes = reply[2:]
+      flows = array('d', flowBytes)
+      for i in range(len(flows)):
+         if flows[i] != 0:
+            targetFlows[i] += flows[i]
+      targets = array('d', targetBytes)
+      costs = array('d', costBytes)
+      ODlist = self.network.ODlist
+      position = 0
+      for origin in chunk:
+         lo, hi = self.originRange[origin]
+         for i in range(lo, hi):
+            targetDemands[i] = targets[position]
+            ODlist[i].k_rs = costs[position]
+            position += 1
+      return SPTT
+
+   def loadLocally(self, chunks, targetFlows, targetDemands):
+      network = self.network
+      SPTT = 0.0
+      for chunk in chunks:
+         SPTT += loadOrigins(network, chunk, network.linkCosts, self.originDemands, targetDemands, targetFlows)[0]
+      return SPTT
+
+   def averageExcessCost(self):
+      """
+      Gap function: loads the targets on the workers and returns
+      (TSTT - SPTT) / totalDemand, as Network.averageExcessCost does after
+      an all-or-nothing assignment.
+      """
+      self.loadTargets()
+      network = self.network
+      return (network.TSTT - network.SPTT) / network.totalDemand
+
+   def close(self):
+      for connection in list(self.workers):
+         try:
+            connection.send(('close',))
+            connection.close()
+         except OSError:
+            pass
+      self.workers = dict()
+
+   def __enter__(self):
+      if len(self.workers) == 0:
+         self.connect()
+      return self
+
+   def __exit__(self, excType, excValue, traceback):
+      self.close()
+
+def localWorker(authkey, addressPipe):
+   listener = Listener(('127.0.0.1', 0), authkey = authkey)
+   addressPipe.send(listener.address)
+   addressPipe.close()
+   serveWorker(listener, None)
+
+class LocalCluster:
+   """
+   Stand-in for a set of worker hosts: count worker processes on this
+   machine, listening on local ports.  addresses and authkey are what
+   DistributedLoader needs; stop(i) kills worker i, to exercise the fault
+   handling.
+      with LocalCluster(4) as cluster:
+         with DistributedLoader(net, cluster.addresses, cluster.authkey,
+                                net.targetDemandsElastic) as loader:
+            net.RELAXEDuserEquilibrium(..., gapFunction = loader.averageExcessCost, ...)
+   """
+
+   def __init__(self, count, authkey = None):
+      self.authkey = authkey if authkey is not None else os.urandom(16)
+      self.processes = list()
+      self.addresses = list()
+      for i in range(count):
+         receiver, sender = multiprocessing.Pipe(duplex = False)
+         process = multiprocessing.Process(target = localWorker, args = (self.authkey, sender), daemon = True)
+         process.start()
+         sender.close()
+         self.addresses.append(receiver.recv())
+         receiver.close()
+         self.processes.append(process)
+
+   def stop(self, i):
+      self.processes[i].terminate()
+      self.processes[i].join()
+
+   def close(self):
+      for process in self.processes:
+         if process.is_alive():
+            process.terminate()
+         process.join()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, excType, excValue, traceback):
+      self.close()
+
+def parseAddress(text):
+   host, port = text.rsplit(':', 1)
+   return (host, int(port))
+
+def main(arguments = None):
+   parser = argparse.ArgumentParser(description = "Worker for distributed shortest path and loading (see DistributedLoader)")
+   parser.add_argument('mode', choices = ['worker'])
+   parser.add_argument('--listen', default = '0.0.0.0:6100', help = "host:port to listen on")
+   parser.add_argument('--authkey', default = os.environ.get('TAP_AUTHKEY'),
+                       help = "shared secret (default: the TAP_AUTHKEY environment variable)")
+   options = parser.parse_args(arguments)
+   if not options.authkey:
+      parser.error("an authkey is required")
+   listener = Listener(parseAddress(options.listen), authkey = options.authkey.encode())
+   print("Worker listening on %s" % options.listen)
+   serveWorker(listener)
+
+if __name__ == '__main__':
+   main(sys.argv[1:])
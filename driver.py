@@ -20,6 +20,18 @@ net.RELAXEDuserEquilibrium("MSA", 1000, 1e-6, 1e-2, net.averageExcessCost, net.T
 net.printResults("Austin_sdb\Output\Austin_sdb_ODResults.txt", "Austin_sdb\Output\Austin_sdb_LinkResults.txt", "Austin_sdb\Output\Austin_sdb_OriginResults.txt", "Austin_sdb\Output\Austin_sdb_DemandResults.txt", "Austin_sdb\Output\Austin_sdb_AggregateResults.txt")
 
 
+'''
+###### STEP SIZE RULE BENCHMARK ##########################
+from convergence import DualityGap
+for rule in ("MSA", "SRA", "ARMIJO"):
+    net = Network("Austin_sdb\Austin_sdb_net.txt", "Austin_sdb\Austin_sdb_trips.txt")
+    net.readNodeFile("Austin_sdb\Austin_sdb_node.txt")
+    net.readODFile("Austin_sdb\Austin_sdb_attr.txt")
+    ruleStart = time.time()
+    net.RELAXEDuserEquilibrium(rule, 1000, 1e-3, 1e2, net.averageExcessCost, net.TMFGap, net.targetDemandsElastic, 1.0)
+    print(rule, net.iterations, net.stopReason, DualityGap(net, net.targetDemandsElastic)(), time.time() - ruleStart)
+'''
+
 
 endTime = time.time()
 
@@ -0,0 +1,205 @@
+from network import BadNetworkOperationException
+
+import time
+
+def screenOrigins(network, originDemands):
+   """
+   One pass over all origins at the current (fixed) link costs.  Sets the
+   network's TSTT, SPTT, TMF and totalDemand exactly as a solver iteration
+   would, so the network's gap functions can be evaluated, and returns a
+   dictionary with each origin's share of the gaps, (excess cost, TMF):
+      excess cost -- sum_l x_ol c_l minus the origin's demands times their
+                     shortest path costs, which is zero at equilibrium
+      TMF         -- sum over the origin's OD pairs of |target - demand|
+   """
+   originFlows = network.originFlows
+   targetDemands = network.targetDemandBuffer
+   network.refreshLinkCosts()
+   linkCosts = network.linkCosts
+   network.TSTT = 0
+   for link in network.linkList:
+      network.TSTT += link.flow * link.cost
+   network.SPTT = 0
+   network.TMF = 0
+   network.totalDemand = 0
+   scores = dict()
+   for origin in network.relevant_origins:
+      cost = network.shortestPathLabels(origin)[0]
+      originDemands(origin, cost, targetDemands)
+      shortestCost = 0
+      TMF = 0
+      for od in network.originODs[origin]:
+         shortestCost += od.demand * od.k_rs
+         network.SPTT += targetDemands[od.index] * od.k_rs
+         TMF += abs(targetDemands[od.index] - od.demand)
+         network.totalDemand += od.demand
+      network.TMF += TMF
+      scores[origin] = (originFlows.originCost(origin, linkCosts) - shortestCost, TMF)
+   return scores
+
+def updateOrigins(network, origins, originDemands, updates, stepOffset = 0):
+   """
+   Gauss-Seidel step for a batch of origins: their shortest path trees and
+   target demands are found at the current link costs, then each origin's
+   flows and demands are shifted 1 / (updates[origin] + 1 + stepOffset) of
+   the way to its targets, refreshing the costs of the links involved
+   before the next batch.  updates counts the steps taken by each origin.
+
+   Returns a dictionary mapping each origin to its gap terms measured
+   before the step, (excess cost, TMF, excess cost to targets): the first
+   two as in screenOrigins, the third being the origin's contribution to
+   TSTT - SPTT as used by averageExcessCost (the SPTT term uses target
+   demands).
+   """
+   originFlows = network.originFlows
+   targetDemands = network.targetDemandBuffer
+   linkCosts = network.linkCosts
+   terms = dict()
+   for origin in origins:
+      cost = network.shortestPathLabels(origin)[0]
+      originDemands(origin, cost, targetDemands)
+      originFlows.recordTree(origin, targetDemands)
+      shortestCost = 0
+      targetCost = 0
+      TMF = 0
+      for od in network.originODs[origin]:
+         shortestCost += od.demand * od.k_rs
+         targetCost += targetDemands[od.index] * od.k_rs
+         TMF += abs(targetDemands[od.index] - od.demand)
+      flowCost = originFlows.originCost(origin, linkCosts)
+      terms[origin] = (flowCost - shortestCost, TMF, flowCost - targetCost)
+   for origin in origins:
+      updates[origin] += 1
+      originFlows.shiftOrigin(origin, targetDemands, 1 / (updates[origin] + 1 + stepOffset))
+   return terms
+
+def originPriority(excess, TMF, excessScale, targetGap2):
+   """
+   An origin's gap relative to the targets, used to order and revisit the
+   origins; with a zero target (a run for a fixed number of sweeps) the TMF
+   term is left unscaled.
+   """
+   return max(excess, 0) / excessScale + (TMF / targetGap2 if targetGap2 > 0 else TMF)
+
+def gaussSeidelEquilibrium(network, maxSweeps = 100, targetGap = 1e-6, targetGap2 = 1e-2, gapFunction = None,
+                           gapFunction2 = None, demandFunction = None, teleworkMultiplier = 0, warmStart = False,
+                           stepOffset = 0, batchSize = 1, revisitFactor = 2.0, maxVisits = 3,
+                           stoppingPolicy = None):
+   """
+   Alternative to RELAXEDuserEquilibrium that updates one origin (or a batch
+   of batchSize origins) at a time: each update finds the origin's shortest
+   path tree and target demands at the current costs, shifts only that
+   origin's link flows and demands (by 1 / (its updates + 1 + stepOffset)),
+   and refreshes the affected link costs immediately, so later origins in
+   the same sweep already see them.  Origin flows are tracked (see
+   Network.trackOriginFlows), and switched on if they are not.
+
+   Each sweep updates every origin once, largest gap first, then revisits
+   the origins whose gap (excess cost and TMF, each relative to its target)
+   is more than revisitFactor times the average, up to maxVisits updates per
+   sweep in total.  The gaps reported for a sweep are accumulated from the
+   origins' first update in it, which costs no extra shortest paths but
+   mixes cost states; when they meet targetGap and targetGap2 the solution
+   is confirmed by an exact pass at fixed costs before stopping.
+
+   As in RELAXEDuserEquilibrium, warmStart starts from the current flows and
+   demands (which requires origin flows tracked by the previous solve), the
+   number of sweeps is stored in network.iterations, (sweep, gap, gap2,
+   elapsed time) in network.convergenceHistory, and stoppingPolicy (see
+   stopping.py) is applied to the sweep gaps.  On return, the network's
+   TSTT, SPTT, TMF and totalDemand describe the final (or restored) flows
+   and demands, an exact pass being made if the last sweep did not end with
+   one.  Returns the number of origin updates (shortest path trees) made by
+   the sweeps.
+   """
+   demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+   gapFunction = gapFunction if gapFunction is not None else network.averageExcessCost
+   gapFunction2 = gapFunction2 if gapFunction2 is not None else network.TMFGap
+   originDemands = network.originDemandFunction(demandFunction)
+   if warmStart:
+      if network.originFlows is None:
+         raise BadNetworkOperationException("A warm-started Gauss-Seidel solve needs the origin flows of the "
+                                            "previous solve; call trackOriginFlows() before solving it")
+      network.refreshWarmState(teleworkMultiplier)
+   else:
+      if network.originFlows is None:
+         network.trackOriginFlows()
+      network.coldStart(teleworkMultiplier)
+   network.refreshLinkCosts()
+
+   origins = sorted(network.relevant_origins)
+   updates = dict((origin, 0) for origin in origins)
+   priority = dict((origin, 0.0) for origin in origins)
+   totalUpdates = 0
+   network.convergenceHistory = list()
+   network.stopReason = 'maxIterations'
+   stopReason = None
+   if stoppingPolicy is not None:
+      stoppingPolicy.start(network, targetGap, targetGap2)
+   startTime = time.time()
+   sweep = 0
+   exact = False
+   while sweep < maxSweeps:
+      sweep += 1
+      network.iterations = sweep
+      if network.profiler is not None:
+         network.profiler.iteration(sweep)
+      order = sorted(origins, key = lambda origin : priority[origin], reverse = True)
+      excessScale = (targetGap if targetGap > 0 else 1) * max(sum(od.demand for od in network.ODlist), 1e-12)
+      excessTotal = 0
+      TMFTotal = 0
+      with network.phase("originUpdates"):
+         for first in range(0, len(order), batchSize):
+            batch = order[first : first + batchSize]
+            terms = updateOrigins(network, batch, originDemands, updates, stepOffset)
+            totalUpdates += len(batch)
+            for origin, (excess, TMF, targetExcess) in terms.items():
+               excessTotal += targetExcess
+               TMFTotal += TMF
+               priority[origin] = originPriority(excess, TMF, excessScale, targetGap2)
+         average = sum(priority.values()) / len(origins) if len(origins) > 0 else 0
+         for visit in range(1, maxVisits):
+            revisit = [origin for origin in order if priority[origin] > revisitFactor * average]
+            if len(revisit) == 0:
+               break
+            for first in range(0, len(revisit), batchSize):
+               batch = revisit[first : first + batchSize]
+               terms = updateOrigins(network, batch, originDemands, updates, stepOffset)
+               totalUpdates += len(batch)
+               for origin, (excess, TMF, targetExcess) in terms.items():
+                  priority[origin] = originPriority(excess, TMF, excessScale, targetGap2)
+      exact = False
+
+      totalDemand = sum(od.demand for od in network.ODlist)
+      gap = excessTotal / totalDemand if totalDemand > 0 else 0
+      gap2 = TMFTotal
+      elapsed = time.time() - startTime
+      network.convergenceHistory.append((sweep, gap, gap2, elapsed))
+      if network.trajectory is not None:
+         network.trajectory.record(network, sweep, gap, gap2, elapsed)
+      if network.iterationLog is not None:
+         network.iterationLog("Sweep %d: AEC %f: TMF %f: time %f: %d origin updates%s" % (
+            sweep, gap, gap2, elapsed, totalUpdates, network.memoryStatus()))
+      if gap < targetGap and gap2 < targetGap2:
+         with network.phase("confirmGap"):
+            screenOrigins(network, originDemands)
+         exact = True
+         gap = gapFunction()
+         gap2 = gapFunction2()
+         if network.iterationLog is not None:
+            network.iterationLog("Exact gap: AEC %f: TMF %f" % (gap, gap2))
+         if gap < targetGap and gap2 < targetGap2:
+            stopReason = 'converged'
+            network.stopReason = stopReason
+      if stoppingPolicy is not None:
+         reason = stoppingPolicy.check(network, sweep, gap, gap2, elapsed)
+         stopReason = stopReason if stopReason is not None else reason
+      if stopReason is not None:
+         break
+
+   if stoppingPolicy is not None and stoppingPolicy.finish(network, stopReason):
+      exact = False
+   if not exact:
+      with network.phase("confirmGap"):
+         screenOrigins(network, originDemands)
+   return totalUpdates
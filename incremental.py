@@ -0,0 +1,133 @@
+from network import BadNetworkOperationException
+from gaussseidel import screenOrigins, updateOrigins
+
+import time
+
+LINK_ATTRIBUTES = ('capacity', 'freeFlowTime', 'alpha', 'beta', 'toll', 'length')
+
+def applyChanges(network, odChanges = None, linkChanges = None):
+   """
+   Applies a scenario change to a network in place and returns the origins
+   and link positions it touches directly.
+      odChanges   -- dictionary mapping OD pair IDs (or (origin, destination)
+                     tuples) to dictionaries of additive deltas of OD
+                     attributes, e.g. {(12, 40) : {'a_rs' : 5, 'a_rsE' : 5}}
+      linkChanges -- dictionary mapping link IDs (or (tail, head) tuples) to
+                     dictionaries of new values for the attributes in
+                     LINK_ATTRIBUTES, e.g. {'(3,7)' : {'capacity' : 1800}}
+   Link costs are updated for the new attributes.
+   """
+   odByNodes = dict(((od.origin, od.destination), od) for od in network.ODlist)
+   linkByNodes = dict(((link.tail, link.head), link) for link in network.linkList)
+   origins = set()
+   links = set()
+   for key, deltas in (odChanges or dict()).items():
+      od = network.ODpair.get(key) if key in network.ODpair else odByNodes.get(key)
+      if od is None:
+         raise BadNetworkOperationException("Unknown OD pair " + str(key))
+      for attribute, delta in deltas.items():
+         setattr(od, attribute, getattr(od, attribute) + delta)
+      origins.add(od.origin)
+   for key, values in (linkChanges or dict()).items():
+      link = network.link.get(key) if key in network.link else linkByNodes.get(key)
+      if link is None:
+         raise BadNetworkOperationException("Unknown link " + str(key))
+      for attribute, value in values.items():
+         if attribute not in LINK_ATTRIBUTES:
+            raise BadNetworkOperationException("Cannot change link attribute " + str(attribute))
+         setattr(link, attribute, value)
+      links.add(link.index)
+   if len(links) > 0:
+      network.refreshLinkParameters()
+      for l in links:
+         network.linkList[l].updateCost()
+   return (origins, links)
+
+def incrementalEquilibrium(network, odChanges = None, linkChanges = None, demandFunction = None,
+                           teleworkMultiplier = 0, maxSweeps = 100, targetGap = 1e-6, targetGap2 = 1e-2,
+                           gapFunction = None, gapFunction2 = None, localRounds = 3, coverage = 0.9,
+                           stepOffset = 10):
+   """
+   Re-equilibrates a solved network after a localized change (see
+   applyChanges) starting from the previous solution, instead of solving
+   the changed scenario from scratch.  The previous solve must have been run
+   with origin flow tracking on (Network.trackOriginFlows).
+
+   Work is organized in sweeps.  Each sweep first screens every origin at
+   the current costs (screenOrigins), which gives the global gaps; the
+   re-solve stops as soon as they meet targetGap and targetGap2, as in
+   RELAXEDuserEquilibrium.  Otherwise the origins are ranked by their
+   contribution to the gaps, each term scaled by its target, and the
+   smallest set of origins covering the given fraction of the total is
+   updated localRounds times, one origin at a time (Gauss-Seidel): a fresh
+   shortest path tree, target demands, and a step of
+   1 / (updates of that origin + 1 + stepOffset) for that origin's flows and
+   demands alone.  In the first sweep, origins whose OD pairs changed or
+   whose flows use a changed link are always updated.
+
+   The number of sweeps is stored in network.iterations, why the re-solve
+   stopped ('converged' or 'maxIterations') in network.stopReason, and
+   (sweep, gap, gap2, elapsed time) for each in network.convergenceHistory.
+   Returns a list of (sweep, gap, gap2, origins updated) tuples.
+   """
+   originFlows = network.originFlows
+   if originFlows is None:
+      raise BadNetworkOperationException("Incremental re-equilibration needs the origin flows of the previous "
+                                         "solve; call trackOriginFlows() before solving it")
+   demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+   gapFunction = gapFunction if gapFunction is not None else network.averageExcessCost
+   gapFunction2 = gapFunction2 if gapFunction2 is not None else network.TMFGap
+   originDemands = network.originDemandFunction(demandFunction)
+   network.telework_multiplier = teleworkMultiplier
+
+   changedOrigins, changedLinks = applyChanges(network, odChanges, linkChanges)
+   for origin in network.relevant_origins:
+      if any(originFlows.usesLink(origin, l) for l in changedLinks):
+         changedOrigins.add(origin)
+
+   updates = dict((origin, 0) for origin in network.relevant_origins)
+   history = list()
+   network.convergenceHistory = list()
+   network.stopReason = 'maxIterations'
+   startTime = time.time()
+   sweep = 0
+   while sweep < maxSweeps:
+      sweep += 1
+      network.iterations = sweep
+      scores = screenOrigins(network, originDemands)
+      gap = gapFunction()
+      gap2 = gapFunction2()
+      elapsed = time.time() - startTime
+      network.convergenceHistory.append((sweep, gap, gap2, elapsed))
+      if network.trajectory is not None:
+         network.trajectory.record(network, sweep, gap, gap2, elapsed)
+      if gap < targetGap and gap2 < targetGap2:
+         if network.iterationLog is not None:
+            network.iterationLog("Sweep %d: AEC %f: TMF %f: time %f" % (sweep, gap, gap2, elapsed))
+         history.append((sweep, gap, gap2, 0))
+         network.stopReason = 'converged'
+         break
+
+      weights = dict()
+      for origin, (excess, TMF) in scores.items():
+         weights[origin] = max(excess, 0) / (network.totalDemand * targetGap) + TMF / targetGap2
+      ranked = sorted(weights, key = lambda origin : weights[origin], reverse = True)
+      total = sum(weights.values())
+      active = list()
+      covered = 0
+      for origin in ranked:
+         if covered >= coverage * total:
+            break
+         active.append(origin)
+         covered += weights[origin]
+      if sweep == 1:
+         active.extend(origin for origin in changedOrigins if origin not in active)
+      if network.iterationLog is not None:
+         network.iterationLog("Sweep %d: AEC %f: TMF %f: time %f: updating %d origins"
+                              % (sweep, gap, gap2, elapsed, len(active)))
+      history.append((sweep, gap, gap2, len(active)))
+
+      for localRound in range(localRounds):
+         for origin in active:
+            updateOrigins(network, (origin,), originDemands, updates, stepOffset)
+   return history
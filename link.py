@@ -1,8 +1,12 @@
+from linkfunctions import DEFAULT_LINK_FUNCTION
+
 class Link:
    """
    Class for network links.  As currently written, assumes costs are calculated as the
    sum of three factors:
-      1. Travel time, computed via the BPR function
+      1. Travel time, computed via the link's performance function (function
+         attribute; BPR unless set by Network.setLinkFunction, see
+         linkfunctions.py)
       2. Toll cost, the product of toll and network.tollFactor
       3. Distance-related costs, the product of length and network.distanceFactor
    """
@@ -10,9 +14,10 @@ class Link:
    def __init__(self, network, tail, head, capacity = 99999, length = 99999, freeFlowTime = 99999, alpha = 0.15, beta = 4, speedLimit = 99999, toll = 0, linkType = 0):
       """
       Initializer for links; note default values for parameters if not specified.
-      For the classic traffic assignment problem speedLimit and linkType do  not
-      have any impact (and length and toll are only relevant if a distanceFactor
-      or tollFactor are specified). 
+      For the classic traffic assignment problem speedLimit does not have any
+      impact, and linkType only selects the performance function if
+      Network.setLinkFunction is given link types (and length and toll are only
+      relevant if a distanceFactor or tollFactor are specified).
       """
       self.network = network
       self.tail = tail
@@ -26,52 +31,62 @@ class Link:
       self.toll = toll
       self.linkType = linkType
       self.sortKey = tail * network.numLinks + head # makes for easy sorting in forward star order
+      self.ID = None # set by Network.buildWorkBuffers, along with the position
+      self.index = None # of the link in Network.linkList
+      self.function = DEFAULT_LINK_FUNCTION
       
    def calculateCost(self):
       """
-      Calculates the cost of the link using the BPR relation, adding in toll and
-      distance-related costs.
+      Calculates the cost of the link using its performance function, adding
+      in toll and distance-related costs.
       This cost is returned by the method and NOT stored in the cost attribute.
       """   
-      vcRatio = self.flow / self.capacity
-      # Protect against negative flows, 0^0 errors.
-      if vcRatio <= 0:
-         return self.freeFlowTime + self.toll * self.network.tollFactor + self.length * self.network.distanceFactor 
-      if(self.beta == 4):
-        travelTime = self.freeFlowTime * (1 + self.alpha * vcRatio*vcRatio* vcRatio*vcRatio)
-      else:
-        travelTime = self.freeFlowTime * (1 + self.alpha * pow(vcRatio, self.beta))
-      return travelTime + self.toll * self.network.tollFactor + self.length * self.network.distanceFactor 
+      return self.calculateTMPCost(self.flow)
 
    def calculateTMPCost(self, TMPflow):
       """
-      Calculates the cost of the link using the BPR relation, adding in toll and
-      distance-related costs.
-      This cost is returned by the method and NOT stored in the cost attribute.
+      Same as calculateCost, for the flow TMPflow instead of the link's
+      current flow.
       """   
-      vcRatio = TMPflow / self.capacity
-      # Protect against negative flows, 0^0 errors.
-      if vcRatio <= 0:
-         return self.freeFlowTime + self.toll * self.network.tollFactor + self.length * self.network.distanceFactor 
-      if(self.beta == 4):
-        travelTime = self.freeFlowTime * (1 + self.alpha * vcRatio*vcRatio* vcRatio*vcRatio)
-      else:
-        travelTime = self.freeFlowTime * (1 + self.alpha * pow(vcRatio, self.beta))
+      travelTime = self.function.travelTime(self.freeFlowTime, self.capacity, self.alpha, self.beta, TMPflow)
       return travelTime + self.toll * self.network.tollFactor + self.length * self.network.distanceFactor 
 
 
    def calculateBeckmannComponent(self):
       """
-      Calculates the integral of the BPR function for the link, for its
+      Calculates the integral of the cost function for the link, for its
       contribution to the sum in the Beckmann function.
       """
-      vcRatio = self.flow / self.capacity
-      # Protect against negative flows, 0^0 errors.
-      if vcRatio <= 0:
+      return self.calculateTMPBeckmannComponent(self.flow)
+
+
+   def calculateTMPBeckmannComponent(self, TMPflow):
+      """
+      Same as calculateBeckmannComponent, for the flow TMPflow instead of the
+      link's current flow.
+      """
+      # Protect against negative flows
+      if TMPflow <= 0:
          return 0
-      return self.flow * (self.toll * self.network.tollFactor + self.length * self.network.distanceFactor 
-                           + self.freeFlowTime * (1 + self.alpha / (self.beta + 1) * pow(vcRatio, self.beta))
-                         )
+      return (TMPflow * (self.toll * self.network.tollFactor + self.length * self.network.distanceFactor)
+              + self.function.integral(self.freeFlowTime, self.capacity, self.alpha, self.beta, TMPflow))
+
+
+   def calculateCostDerivative(self):
+      """
+      Calculates the derivative of the travel time with respect to the link
+      flow, at the current flow.  Toll and distance costs do not depend on
+      flow.
+      """
+      return self.function.derivative(self.freeFlowTime, self.capacity, self.alpha, self.beta, self.flow)
+
+
+   def calculateCapacityDerivative(self):
+      """
+      Calculates the derivative of the travel time with respect to the link
+      capacity, at the current flow.
+      """
+      return self.function.capacityDerivative(self.freeFlowTime, self.capacity, self.alpha, self.beta, self.flow)
 
 
    def updateCost(self):
@@ -0,0 +1,465 @@
+from array import array
+
+import bisect
+import math
+
+class BadLinkFunctionException(Exception):
+   """
+   Raised for an unknown link performance function or invalid parameters
+   (e.g., a conical function with steepness at most 1).
+   """
+   pass
+
+class LinkFunction:
+   """
+   Base class of the link performance functions: the travel time of a link
+   as a function of its flow, excluding the toll and distance costs (which
+   do not depend on flow, and are added by Link and LinkPerformance).  A
+   function is evaluated on the link parameters of the network file, passed
+   as plain numbers, so each subclass only defines
+      travelTime(freeFlowTime, capacity, alpha, beta, flow)
+      integral(...)   -- of the travel time from 0 to flow (Beckmann term)
+      derivative(...) -- of the travel time with respect to flow
+   and, if the time depends on capacity other than through flow / capacity,
+      capacityDerivative(...)
+   Flows at or below zero get the free-flow value (and zero integral).
+   The array kernels below apply these to a LinkGroup at once; subclasses
+   may override them with inlined loops (see BPR).  checkLink raises
+   BadLinkFunctionException for links the function cannot be used on.
+   """
+
+   name = None
+
+   def capacityDerivative(self, freeFlowTime, capacity, alpha, beta, flow):
+      return -flow / capacity * self.derivative(freeFlowTime, capacity, alpha, beta, flow)
+
+   def checkLink(self, freeFlowTime, capacity, alpha, beta):
+      pass
+
+   def travelTimes(self, group, flows, out):
+      """
+      Writes the travel time of each link of group, at flows[link.index],
+      into out[link.index].
+      """
+      travelTime = self.travelTime
+      for position, freeFlowTime, capacity, alpha, beta in group.columns():
+         out[position] = travelTime(freeFlowTime, capacity, alpha, beta, flows[position])
+
+   def integrals(self, group, flows):
+      """
+      Sum of the travel time integrals of the links of group.
+      """
+      integral = self.integral
+      total = 0.0
+      for position, freeFlowTime, capacity, alpha, beta in group.columns():
+         total += integral(freeFlowTime, capacity, alpha, beta, flows[position])
+      return total
+
+   def derivatives(self, group, flows, out):
+      """
+      Writes the travel time derivative of each link of group into
+      out[link.index].
+      """
+      derivative = self.derivative
+      for position, freeFlowTime, capacity, alpha, beta in group.columns():
+         out[position] = derivative(freeFlowTime, capacity, alpha, beta, flows[position])
+
+   def travelTimeRows(self, group, flowRows, outRows, totals):
+      """
+      travelTimes for several flow arrays at once (e.g. one per scenario),
+      in one pass over the links of group: writes the travel times at
+      flowRows[r] into outRows[r] and adds the sum of flow times travel time
+      of row r to totals[r].
+      """
+      travelTime = self.travelTime
+      rows = range(len(flowRows))
+      for position, freeFlowTime, capacity, alpha, beta in group.columns():
+         for r in rows:
+            flow = flowRows[r][position]
+            time = travelTime(freeFlowTime, capacity, alpha, beta, flow)
+            outRows[r][position] = time
+            totals[r] += flow * time
+
+   def __repr__(self):
+      return "%s()" % type(self).__name__
+
+class BPR(LinkFunction):
+   """
+   Bureau of Public Roads function, freeFlowTime * (1 + alpha * (flow /
+   capacity) ^ beta), with alpha and beta from the network file.  beta = 4,
+   the usual value, is computed by multiplication instead of pow.
+   """
+
+   name = 'bpr'
+
+   def travelTime(self, freeFlowTime, capacity, alpha, beta, flow):
+      vcRatio = flow / capacity
+      # Protect against negative flows, 0^0 errors.
+      if vcRatio <= 0:
+         return freeFlowTime
+      if beta == 4:
+         return freeFlowTime * (1 + alpha * vcRatio*vcRatio*vcRatio*vcRatio)
+      return freeFlowTime * (1 + alpha * pow(vcRatio, beta))
+
+   def integral(self, freeFlowTime, capacity, alpha, beta, flow):
+      vcRatio = flow / capacity
+      if vcRatio <= 0:
+         return 0.0
+      if beta == 4:
+         return flow * freeFlowTime * (1 + alpha / 5 * vcRatio*vcRatio*vcRatio*vcRatio)
+      return flow * freeFlowTime * (1 + alpha / (beta + 1) * pow(vcRatio, beta))
+
+   def derivative(self, freeFlowTime, capacity, alpha, beta, flow):
+      vcRatio = flow / capacity
+      if vcRatio <= 0:
+         return 0.0
+      if beta == 4:
+         return freeFlowTime * alpha * 4 * vcRatio*vcRatio*vcRatio / capacity
+      return freeFlowTime * alpha * beta * pow(vcRatio, beta - 1) / capacity
+
+   def travelTimes(self, group, flows, out):
+      for position, freeFlowTime, capacity, alpha, beta in group.columns():
+         vcRatio = flows[position] / capacity
+         if vcRatio <= 0:
+            out[position] = freeFlowTime
+         elif beta == 4:
+            out[position] = freeFlowTime * (1 + alpha * vcRatio*vcRatio*vcRatio*vcRatio)
+         else:
+            out[position] = freeFlowTime * (1 + alpha * pow(vcRatio, beta))
+
+   def integrals(self, group, flows):
+      total = 0.0
+      for position, freeFlowTime, capacity, alpha, beta in group.columns():
+         flow = flows[position]
+         vcRatio = flow / capacity
+         if vcRatio <= 0:
+            continue
+         if beta == 4:
+            total += flow * freeFlowTime * (1 + alpha / 5 * vcRatio*vcRatio*vcRatio*vcRatio)
+         else:
+            total += flow * freeFlowTime * (1 + alpha / (beta + 1) * pow(vcRatio, beta))
+      return total
+
+   def derivatives(self, group, flows, out):
+      for position, freeFlowTime, capacity, alpha, beta in group.columns():
+         vcRatio = flows[position] / capacity
+         if vcRatio <= 0:
+            out[position] = 0.0
+         elif beta == 4:
+            out[position] = freeFlowTime * alpha * 4 * vcRatio*vcRatio*vcRatio / capacity
+         else:
+            out[position] = freeFlowTime * alpha * beta * pow(vcRatio, beta - 1) / capacity
+
+   def travelTimeRows(self, group, flowRows, outRows, totals):
+      rows = range(len(flowRows))
+      for position, freeFlowTime, capacity, alpha, beta in group.columns():
+         for r in rows:
+            flow = flowRows[r][position]
+            vcRatio = flow / capacity
+            if vcRatio <= 0:
+               time = freeFlowTime
+            elif beta == 4:
+               time = freeFlowTime * (1 + alpha * vcRatio*vcRatio*vcRatio*vcRatio)
+            else:
+               time = freeFlowTime * (1 + alpha * pow(vcRatio, beta))
+            outRows[r][position] = time
+            totals[r] += flow * time
+
+class Conical(LinkFunction):
+   """
+   Spiess' conical function, freeFlowTime * (2 + sqrt(a^2 (1 - x)^2 + b^2)
+   - a (1 - x) - b) with x = flow / capacity and b = (2a - 1) / (2a - 2).
+   It equals freeFlowTime at zero flow and 2 * freeFlowTime at capacity,
+   like BPR with alpha = 1, but grows linearly (slope a) far above capacity
+   instead of with a high power.  The steepness a (> 1) is the steepness
+   argument or, if that is None, each link's beta, which plays the same
+   role as the BPR exponent.
+   """
+
+   name = 'conical'
+
+   def __init__(self, steepness = None):
+      if steepness is not None and steepness <= 1:
+         raise BadLinkFunctionException("Conical steepness must be greater than 1, not %s" % steepness)
+      self.steepness = steepness
+
+   def shape(self, beta):
+      a = self.steepness if self.steepness is not None else beta
+      return (a, (2 * a - 1) / (2 * a - 2))
+
+   def checkLink(self, freeFlowTime, capacity, alpha, beta):
+      if self.steepness is None and beta <= 1:
+         raise BadLinkFunctionException("Conical steepness (link beta) must be greater than 1, not %s" % beta)
+
+   def travelTime(self, freeFlowTime, capacity, alpha, beta, flow):
+      a, b = self.shape(beta)
+      slack = 1 - max(flow / capacity, 0.0)
+      return freeFlowTime * (2 + math.sqrt(a*a * slack*slack + b*b) - a * slack - b)
+
+   def integral(self, freeFlowTime, capacity, alpha, beta, flow):
+      if flow <= 0:
+         return 0.0
+      a, b = self.shape(beta)
+      x = flow / capacity
+      def root(w):
+         # antiderivative of sqrt(w^2 + b^2)
+         r = math.sqrt(w*w + b*b)
+         # w + r = b^2 / (r - w), without cancellation for negative w
+         return (w * r + b*b * math.log(w + r if w >= 0 else b*b / (r - w))) / 2
+      area = (2 - b) * x - a * (x - x*x / 2) + (root(a) - root(a * (1 - x))) / a
+      return freeFlowTime * capacity * area
+
+   def derivative(self, freeFlowTime, capacity, alpha, beta, flow):
+      a, b = self.shape(beta)
+      slack = 1 - max(flow / capacity, 0.0)
+      return freeFlowTime / capacity * (a - a*a * slack / math.sqrt(a*a * slack*slack + b*b))
+
+   def __repr__(self):
+      return "Conical(steepness = %r)" % self.steepness
+
+class Akcelik(LinkFunction):
+   """
+   Akcelik's function, freeFlowTime + 0.25 * period * timeScale * (z +
+   sqrt(z^2 + 8 J x / (capacity * period))) with x = flow / capacity and
+   z = x - 1: the free-flow time plus a queueing delay over an analysis
+   period (in hours, with capacity in vehicles per hour) converted to the
+   units of freeFlowTime by timeScale (60 for minutes).  The delay
+   parameter J is typically 0.1 for freeways, 0.2-0.4 for uninterrupted
+   arterials and 0.8-1.6 for signalized roads, so it is usually set per
+   link type.  Finite above capacity, unlike BPR it stays accurate at high
+   volume to capacity ratios.  The delay depends on capacity directly, not
+   only through x, which capacityDerivative accounts for.
+   """
+
+   name = 'akcelik'
+
+   def __init__(self, delayParameter = 0.1, period = 1.0, timeScale = 60.0):
+      if delayParameter <= 0 or period <= 0 or timeScale <= 0:
+         raise BadLinkFunctionException("Akcelik parameters must be positive")
+      self.delayParameter = delayParameter
+      self.period = period
+      self.timeScale = timeScale
+      self.delayScale = 0.25 * period * timeScale
+
+   def travelTime(self, freeFlowTime, capacity, alpha, beta, flow):
+      x = max(flow / capacity, 0.0)
+      k = 8 * self.delayParameter / (capacity * self.period)
+      z = x - 1
+      return freeFlowTime + self.delayScale * (z + math.sqrt(z*z + k * x))
+
+   def integral(self, freeFlowTime, capacity, alpha, beta, flow):
+      if flow <= 0:
+         return 0.0
+      x = flow / capacity
+      k = 8 * self.delayParameter / (capacity * self.period)
+      # z^2 + k x = v^2 + m, with v = x + (k - 2) / 2; v > 0 whenever m <= 0
+      shift = (k - 2) / 2
+      m = k * (1 - k / 4)
+      def root(v):
+         # antiderivative of sqrt(v^2 + m)
+         r = math.sqrt(v*v + m)
+         if m == 0:
+            return v * r / 2
+         return (v * r + m * math.log(v + r if v >= 0 else m / (r - v))) / 2
+      area = freeFlowTime * x + self.delayScale * (x*x / 2 - x + root(x + shift) - root(shift))
+      return capacity * area
+
+   def derivative(self, freeFlowTime, capacity, alpha, beta, flow):
+      x = max(flow / capacity, 0.0)
+      k = 8 * self.delayParameter / (capacity * self.period)
+      z = x - 1
+      return self.delayScale / capacity * (1 + (z + k / 2) / math.sqrt(z*z + k * x))
+
+   def capacityDerivative(self, freeFlowTime, capacity, alpha, beta, flow):
+      x = max(flow / capacity, 0.0)
+      k = 8 * self.delayParameter / (capacity * self.period)
+      z = x - 1
+      return -x / capacity * self.delayScale * (1 + (z + k) / math.sqrt(z*z + k * x))
+
+   def __repr__(self):
+      return "Akcelik(delayParameter = %r, period = %r, timeScale = %r)" % (self.delayParameter, self.period,
+                                                                           self.timeScale)
+
+class Piecewise(LinkFunction):
+   """
+   Piecewise linear function of the volume to capacity ratio: points is a
+   sequence of (ratio, multiplier) pairs, starting at ratio 0, and the
+   travel time is freeFlowTime times the multiplier interpolated at flow /
+   capacity, extrapolated with the last segment's slope beyond the last
+   point.  Multipliers must not decrease, so that the Beckmann function
+   stays convex.  Useful for functions tabulated from observations, or for
+   approximating other functions with cheap exact integrals.
+   """
+
+   name = 'piecewise'
+
+   def __init__(self, points):
+      points = [(float(ratio), float(multiplier)) for ratio, multiplier in points]
+      if len(points) < 2 or points[0][0] != 0:
+         raise BadLinkFunctionException("A piecewise function needs at least two points, the first at ratio 0")
+      for (ratio, multiplier), (nextRatio, nextMultiplier) in zip(points, points[1:]):
+         if nextRatio <= ratio or nextMultiplier < multiplier:
+            raise BadLinkFunctionException("Piecewise points must have increasing ratios and nondecreasing "
+                                           "multipliers")
+      self.points = points
+      self.ratios = [ratio for ratio, multiplier in points]
+      self.multipliers = [multiplier for ratio, multiplier in points]
+      self.slopes = [(nextMultiplier - multiplier) / (nextRatio - ratio)
+                     for (ratio, multiplier), (nextRatio, nextMultiplier) in zip(points, points[1:])]
+      # area under the multiplier up to each point
+      self.areas = [0.0]
+      for (ratio, multiplier), (nextRatio, nextMultiplier) in zip(points, points[1:]):
+         self.areas.append(self.areas[-1] + (nextRatio - ratio) * (multiplier + nextMultiplier) / 2)
+
+   def segment(self, x):
+      return min(bisect.bisect_right(self.ratios, x) - 1, len(self.slopes) - 1)
+
+   def travelTime(self, freeFlowTime, capacity, alpha, beta, flow):
+      x = max(flow / capacity, 0.0)
+      s = self.segment(x)
+      return freeFlowTime * (self.multipliers[s] + self.slopes[s] * (x - self.ratios[s]))
+
+   def integral(self, freeFlowTime, capacity, alpha, beta, flow):
+      if flow <= 0:
+         return 0.0
+      x = flow / capacity
+      s = self.segment(x)
+      step = x - self.ratios[s]
+      area = self.areas[s] + step * (self.multipliers[s] + self.slopes[s] * step / 2)
+      return freeFlowTime * capacity * area
+
+   def derivative(self, freeFlowTime, capacity, alpha, beta, flow):
+      return freeFlowTime / capacity * self.slopes[self.segment(max(flow / capacity, 0.0))]
+
+   def __repr__(self):
+      return "Piecewise(%r)" % (self.points,)
+
+# Link performance functions by name, for Network.setLinkFunction
+LINK_FUNCTIONS = dict()
+
+def registerLinkFunction(functionClass):
+   """
+   Makes a LinkFunction subclass available by its (lower case) name.
+   """
+   LINK_FUNCTIONS[functionClass.name] = functionClass
+   return functionClass
+
+for functionClass in (BPR, Conical, Akcelik, Piecewise):
+   registerLinkFunction(functionClass)
+
+DEFAULT_LINK_FUNCTION = BPR()
+
+def makeLinkFunction(function, **parameters):
+   """
+   The LinkFunction for function, either an instance (returned as it is) or
+   a registered name, instantiated with parameters.
+   """
+   if isinstance(function, LinkFunction):
+      if len(parameters) > 0:
+         raise BadLinkFunctionException("Parameters can only be given with a function name")
+      return function
+   functionClass = LINK_FUNCTIONS.get(str(function).lower())
+   if functionClass is None:
+      raise BadLinkFunctionException("Unknown link performance function %s; known are %s"
+                                     % (function, ", ".join(sorted(LINK_FUNCTIONS))))
+   return functionClass(**parameters)
+
+class LinkGroup:
+   """
+   The links sharing one LinkFunction, as parallel arrays: their positions
+   (link.index) and parameters.
+   """
+
+   def __init__(self, function, links):
+      self.function = function
+      self.positions = array('i', [link.index for link in links])
+      self.freeFlowTime = array('d', [link.freeFlowTime for link in links])
+      self.capacity = array('d', [link.capacity for link in links])
+      self.alpha = array('d', [link.alpha for link in links])
+      self.beta = array('d', [link.beta for link in links])
+
+   def columns(self):
+      return zip(self.positions, self.freeFlowTime, self.capacity, self.alpha, self.beta)
+
+class LinkPerformance:
+   """
+   Evaluates the link performance functions of all links of a network on
+   flow arrays indexed by link.index, one kernel call per function, with
+   the links' parameters copied into arrays; Network.linkPerformance holds
+   the one for the network's current link functions.  The arrays are a
+   snapshot: call refresh (or Network.refreshLinkParameters) after changing
+   link capacities, times or the toll and distance factors.  The costs
+   include the tolls and distances, as Link.calculateCost.
+   """
+
+   def __init__(self, network):
+      self.network = network
+      self.refresh()
+
+   def refresh(self):
+      network = self.network
+      members = dict()
+      for link in network.linkList:
+         link.function.checkLink(link.freeFlowTime, link.capacity, link.alpha, link.beta)
+         members.setdefault(id(link.function), (link.function, list()))[1].append(link)
+      self.groups = [LinkGroup(function, links) for function, links in members.values()]
+      self.tollCost = array('d', [link.toll * network.tollFactor for link in network.linkList])
+      self.distanceCost = array('d', [link.length * network.distanceFactor for link in network.linkList])
+      self.fixedCosts = any(self.tollCost) or any(self.distanceCost)
+
+   def costs(self, flows, out):
+      """
+      Writes the link costs at flows into out and returns it.
+      """
+      for group in self.groups:
+         group.function.travelTimes(group, flows, out)
+      if self.fixedCosts:
+         tollCost, distanceCost = self.tollCost, self.distanceCost
+         for i in range(len(out)):
+            out[i] = out[i] + tollCost[i] + distanceCost[i]
+      return out
+
+   def costRows(self, flowRows, outRows):
+      """
+      Writes the link costs at each of the flow arrays flowRows into the
+      matching array of outRows, in one pass over the links for all rows, and
+      returns the list of the total travel times (sum of flow times cost) of
+      the rows.  Tolls and distances, if any, take a second pass.
+      """
+      totals = [0.0] * len(flowRows)
+      for group in self.groups:
+         group.function.travelTimeRows(group, flowRows, outRows, totals)
+      if self.fixedCosts:
+         tollCost, distanceCost = self.tollCost, self.distanceCost
+         for r in range(len(flowRows)):
+            flows, out = flowRows[r], outRows[r]
+            for i in range(len(out)):
+               # added in the order of Link.calculateCost
+               out[i] = out[i] + tollCost[i] + distanceCost[i]
+               totals[r] += flows[i] * (tollCost[i] + distanceCost[i])
+      return totals
+
+   def beckmann(self, flows):
+      """
+      The Beckmann function at flows: the sum over links of the integral of
+      the cost from 0 to the flow.
+      """
+      total = sum(group.function.integrals(group, flows) for group in self.groups)
+      if self.fixedCosts:
+         tollCost, distanceCost = self.tollCost, self.distanceCost
+         fixedTotal = 0
+         for i in range(len(flows)):
+            flow = flows[i]
+            if flow > 0:
+               fixedTotal += flow * (tollCost[i] + distanceCost[i])
+         total += fixedTotal
+      return total
+
+   def derivatives(self, flows, out):
+      """
+      Writes the derivatives of the link costs with respect to flow at flows
+      into out and returns it.
+      """
+      for group in self.groups:
+         group.function.derivatives(group, flows, out)
+      return out
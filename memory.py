@@ -0,0 +1,149 @@
+import sys
+import tracemalloc
+
+try:
+   import resource
+except ImportError: # not available on Windows
+   resource = None
+
+MEGABYTE = 1024 * 1024
+
+def deepSizeOf(obj, seen):
+   """
+   Approximate number of bytes used by obj and everything it references,
+   following containers and object __dict__'s.  Objects whose id is already in
+   the seen set are not counted again, so callers can seed seen with objects
+   (such as the parent Network) that should be excluded.
+   """
+   size = 0
+   stack = [obj]
+   while len(stack) > 0:
+      current = stack.pop()
+      if id(current) in seen:
+         continue
+      seen.add(id(current))
+      size += sys.getsizeof(current)
+      if isinstance(current, dict):
+         stack.extend(current.keys())
+         stack.extend(current.values())
+      elif isinstance(current, (list, tuple, set, frozenset)):
+         stack.extend(current)
+      elif hasattr(current, "__dict__") and not isinstance(current, type):
+         stack.append(current.__dict__)
+   return size
+
+def currentRSS():
+   """
+   Current resident set size in bytes, or None if it cannot be determined
+   (only Linux exposes this cheaply through /proc).
+   """
+   try:
+      with open("/proc/self/statm", "r") as statm:
+         return int(statm.read().split()[1]) * resource.getpagesize()
+   except (IOError, OSError, AttributeError):
+      return None
+
+def peakRSS():
+   """
+   Peak resident set size of the process in bytes, or None if unavailable.
+   """
+   if resource is None:
+      return None
+   peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   return peak if sys.platform == "darwin" else peak * 1024 # kB on Linux
+
+class MemoryPhase:
+   """
+   Context manager returned by MemoryMonitor.phase; see there.
+   """
+
+   def __init__(self, monitor, name):
+      self.monitor = monitor
+      self.name = name
+
+   def __enter__(self):
+      self.monitor.enterPhase(self.name)
+      return self
+
+   def __exit__(self, excType, excValue, excTraceback):
+      self.monitor.exitPhase()
+      return False
+
+class MemoryMonitor:
+   """
+   Records the peak allocation of each named solver phase.  Two methods are
+   available:
+      tracemalloc -- exact peak Python allocation inside the phase, relative to
+                     the memory in use when the phase started.  Accurate but
+                     slows the solver down noticeably.
+      rss         -- samples the process resident set size at phase boundaries.
+                     Nearly free, but only sees growth that survives to the end
+                     of the phase.
+   Phases may be nested; the peak of an inner phase also counts towards the
+   enclosing one.  For each phase name the number of calls, the largest peak,
+   and the total memory retained after the phase are accumulated in
+   self.phases.
+   """
+
+   def __init__(self, method = "tracemalloc"):
+      if method not in ("tracemalloc", "rss"):
+         raise ValueError("Unknown memory tracking method " + str(method))
+      self.method = method
+      self.stack = list()
+      self.phases = dict()
+      if method == "tracemalloc" and not tracemalloc.is_tracing():
+         tracemalloc.start()
+
+   def phase(self, name):
+      return MemoryPhase(self, name)
+
+   def measure(self):
+      """
+      Returns (current, peak) memory in bytes for the configured method.
+      """
+      if self.method == "tracemalloc":
+         return tracemalloc.get_traced_memory()
+      rss = currentRSS()
+      if rss is None:
+         rss = peakRSS() or 0
+      return (rss, rss)
+
+   def enterPhase(self, name):
+      current, peak = self.measure()
+      if len(self.stack) > 0:
+         self.stack[-1][2] = max(self.stack[-1][2], peak)
+      if self.method == "tracemalloc":
+         tracemalloc.reset_peak()
+      self.stack.append([name, current, current])
+
+   def exitPhase(self):
+      name, start, peak = self.stack.pop()
+      current, latestPeak = self.measure()
+      peak = max(peak, latestPeak, current)
+      if len(self.stack) > 0:
+         self.stack[-1][2] = max(self.stack[-1][2], peak)
+      record = self.phases.setdefault(name, {'calls' : 0, 'peak' : 0, 'retained' : 0})
+      record['calls'] += 1
+      record['peak'] = max(record['peak'], peak - start)
+      record['retained'] += current - start
+
+   def stop(self):
+      if self.method == "tracemalloc" and tracemalloc.is_tracing():
+         tracemalloc.stop()
+
+def formatMemoryReport(report):
+   """
+   Formats the dictionary returned by Network.memoryReport as text.
+   """
+   text = "Memory use (MB):\n"
+   for store, size in report['stores'].items():
+      text += "%12.2f  %s store\n" % (size / MEGABYTE, store)
+   if report['peakRSS'] is not None:
+      text += "%12.2f  peak resident set size\n" % (report['peakRSS'] / MEGABYTE)
+   if len(report['phases']) > 0:
+      text += "Peak allocation per phase (%s):\n" % report['method']
+      text += "%12s %12s %8s  %s\n" % ("peak MB", "retained MB", "calls", "phase")
+      for name, record in report['phases'].items():
+         text += "%12.2f %12.2f %8d  %s\n" % (record['peak'] / MEGABYTE, record['retained'] / MEGABYTE,
+                                            record['calls'], name)
+   return text
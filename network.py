@@ -2,15 +2,72 @@ from link import Link
 from node import Node
 from path import Path
 from od import OD
+from profiler import Profiler, instrumented
+from memory import MemoryMonitor, deepSizeOf, peakRSS, formatMemoryReport, MEGABYTE
+from originflows import OriginFlows
+from results import AssignmentResult
+from linkfunctions import LinkPerformance, makeLinkFunction, DEFAULT_LINK_FUNCTION
+from trajectory import TrajectoryRecorder
 
+import contextlib
+import io
+import os
 import sys
 import traceback
 import utils
 import time
+import hashlib
 import heapq as heap
 import math
+from array import array
 
 FRANK_WOLFE_STEPSIZE_PRECISION = 1e-4
+SRA_INCREASE = 1.5 # added to the SRA step denominator when the gap grew
+SRA_DECREASE = 0.2 # and this when it shrank
+ARMIJO_SUFFICIENT_DECREASE = 1e-4
+ARMIJO_BACKTRACK = 0.5
+
+# Array typecodes of the OD-sized and skim storage for each precision mode
+# (see Network.setPrecision)
+PRECISIONS = {'double' : 'd', 'single' : 'f'}
+
+# OD attribute holding the log attractiveness of travelling, for each demand
+# model with a convex objective (see demandObjective)
+DEMAND_UTILITIES = {'targetDemandsRelaxed' : 'a_rs',
+                    'targetDemandsElastic' : 'a_rsE',
+                    'targetDemandsSinglyConstrained' : 'a_rsSC',
+                    'targetDemandsStatic' : None}
+
+def entropyTerm(demand, utility):
+   """
+   demand * (log(demand) - 1 - utility), continued by 0 at demand 0.
+   """
+   if demand <= 0:
+      return 0.0
+   return demand * (math.log(demand) - 1 - utility)
+
+def entropySlope(demand, change, utility):
+   """
+   Derivative of entropyTerm along a change in demand: change times
+   (log(demand) - utility), with an infinite slope at demand 0.
+   """
+   if change == 0:
+      return 0.0
+   if demand <= 0:
+      return -math.inf if change > 0 else math.inf
+   return change * (math.log(demand) - utility)
+
+# Network attributes reported together as one store by memoryReport; the
+# buffers only exist once buildWorkBuffers has run
+MEMORY_STORES = (('linkBuffers', ('linkCosts', 'blankLinkBuffer', 'targetFlowBuffer', 'flowBuffer', 'trialFlowBuffer',
+                                  'trialCostBuffer', 'flowChangeBuffer', 'linkTail', 'linkHead', 'forwardStarIndex')),
+                 ('labels', ('costLabels', 'backlinkLabels', 'blankCostLabels', 'blankBacklinkLabels', 'settledOrder',
+                             'nodeLoads', 'priorityQueue')),
+                 ('ODBuffers', ('targetDemandBuffer', 'demandBuffer', 'trialDemandBuffer', 'weightBuffer')),
+                 ('classFlows', ('classFlows', 'classTargetFlows', 'classTotalBuffer', 'blankClassBuffer',
+                                 'classCosts')),
+                 ('linkPerformance', ('linkPerformance',)),
+                 ('originFlows', ('originFlows',)))
 
 class BadNetworkOperationException(Exception):
    """
@@ -42,6 +99,27 @@ class Network:
                           When implementing shortest path or other routefinding,
                           you should prevent trips from using nodes with lower
                           IDs than firstThroughNode, unless it is the destination.
+
+   For speed, the solvers do not work on these dictionaries directly but on
+   integer positions and preallocated work buffers built by buildWorkBuffers
+   (called from finalize), so that steady-state iterations reuse the same
+   storage instead of building new dictionaries:
+      linkList, ODlist -- Link and OD objects in a fixed order; link.index and
+                          OD.index give each object's position
+      originODs -- for each origin, the list of its OD objects
+      linkTail, linkHead, forwardStarIndex -- topology by link position
+      linkCosts -- snapshot of link costs read by shortestPathLabels
+      costLabels, backlinkLabels -- shortest path labels indexed by node ID
+      targetFlowBuffer, targetDemandBuffer -- returned by allOrNothingDemand
+                          and the targetDemands* methods; they are overwritten
+                          by the next call, so copy them if you need to keep them
+      storageType -- typecode of the OD-sized buffers; see setPrecision
+      linkPerformance -- evaluates the link performance functions on flow
+                          arrays indexed by link.index (see linkfunctions.py
+                          and setLinkFunction)
+      iterationLog -- called with the progress line of each solver iteration,
+                          calibration round, sweep step and batch or
+                          sensitivity run (print by default; None for silence)
    """
 
    def __init__(self, networkFile="", demandFile=""):
@@ -61,12 +139,39 @@ class Network:
       self.TSTT = 0
       self.SPTT = 0
       self.TMF = 9999
+      self.iterations = 0
+      self.convergenceHistory = list()
+      self.stopReason = None
+      self.skimCostState = None
+      self.skims = None
+      self.originFlows = None
+      self.pendingTargets = None
+      self.classFlows = None
+      self.classTargetFlows = None
+      self.classTotalBuffer = None
+      self.blankClassBuffer = None
+      self.classCosts = None
+      self.trajectory = None
+      self.lastStepSize = None
+      self.iterationLog = print
+      self.inputPrefetch = None
+      self.storageType = PRECISIONS['double']
+      self.defaultLinkFunction = DEFAULT_LINK_FUNCTION
+      self.linkFunctions = dict()
+      self.linkPerformance = None
 
       self.relevant_origins = set()
       self.relevant_destinations = set()
 
       self.telework_multiplier = 0.0
 
+      self.linkList = list()
+      self.ODlist = list()
+      self.originODs = dict()
+
+      self.name = os.path.splitext(os.path.basename(networkFile))[0]
+      self.profiler = None
+      self.memoryMonitor = None
 
       if len(networkFile) > 0 and len(demandFile) > 0:
          self.readFromFiles(networkFile, demandFile)
@@ -111,7 +216,7 @@ class Network:
       """
       This method should update the flow on each link, by taking a weighted
       average of the current link flows (self.link[ij].flow) and the flows
-      given in the targetFlows dictionary (targetFlows[ij]).  stepSize indicates
+      given in the targetFlows buffer (targetFlows[link.index]).  stepSize indicates
       the weight to place on the target flows (so the weight on the current
       flows is 1 - stepSize).
       
@@ -122,25 +227,28 @@ class Network:
       This method does not need to return a value.
       """
 
+      self.lastStepSize = stepSize
       self.TSTT = 0
-      for l in self.link:
-          self.link[l].flow = (1-stepSize)*self.link[l].flow + stepSize*targetFlows[l]
-          self.link[l].updateCost()
-          self.TSTT += self.link[l].flow * self.link[l].cost
+      for link, targetFlow in zip(self.linkList, targetFlows):
+          link.flow = (1-stepSize)*link.flow + stepSize*targetFlow
+          link.updateCost()
+          self.TSTT += link.flow * link.cost
           
       self.TMF = 0 
       self.totalDemand = 0
-      for OD in self.ODpair:
-          self.TMF += abs(targetDemands[OD] - self.ODpair[OD].demand)
-          self.ODpair[OD].demand = (1-stepSize)*self.ODpair[OD].demand + stepSize*targetDemands[OD]
-          self.totalDemand += self.ODpair[OD].demand
+      for od, targetDemand in zip(self.ODlist, targetDemands):
+          self.TMF += abs(targetDemand - od.demand)
+          od.demand = (1-stepSize)*od.demand + stepSize*targetDemand
+          self.totalDemand += od.demand
+      if self.originFlows is not None:
+          self.originFlows.shift(stepSize)
           
 
    def shiftFlows(self, targetFlows, stepSize):
       """
       This method should update the flow on each link, by taking a weighted
       average of the current link flows (self.link[ij].flow) and the flows
-      given in the targetFlows dictionary (targetFlows[ij]).  stepSize indicates
+      given in the targetFlows buffer (targetFlows[link.index]).  stepSize indicates
       the weight to place on the target flows (so the weight on the current
       flows is 1 - stepSize).
       
@@ -150,110 +258,316 @@ class Network:
       
       This method does not need to return a value.
       """
+      self.lastStepSize = stepSize
       self.TSTT = 0
-      for l in self.link:
-          self.link[l].flow = (1-stepSize)*self.link[l].flow + stepSize*targetFlows[l]
-          self.link[l].updateCost()
-          self.TSTT += self.link[l].flow * self.link[l].cost
+      for link, targetFlow in zip(self.linkList, targetFlows):
+          link.flow = (1-stepSize)*link.flow + stepSize*targetFlow
+          link.updateCost()
+          self.TSTT += link.flow * link.cost
+      if self.originFlows is not None:
+          self.originFlows.shift(stepSize)
           
     
    def targetDemandsSinglyConstrained(self): #NO a_rn IN THE DENOMINATOR
         """
         Calculates target demands based on the demand functions.
+        The result is targetDemandBuffer, indexed by OD.index.
         """
-        # Calculate shortest path travel times (k_rs) for each OD pair
-        for origin in self.relevant_origins:
-            backlink, cost = self.shortestPath(origin)
-            for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-                self.ODpair[OD].k_rs = cost[self.ODpair[OD].destination]
-        
-        targetDemands = {}
+        skims = self.currentSkims()
+        targetDemands = self.targetDemandBuffer
         for origin in self.relevant_origins:
-            denominator = 0.0
-            for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-                denominator += math.exp(self.ODpair[OD].a_rsSC - self.ODpair[OD].k_rs)
-            if denominator < 0.0000001:
-                for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-                    targetDemands[OD] = self.ODpair[OD].FIXEDdemand
-            else:
-                for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-                    targetDemands[OD] = self.ODpair[OD].P_r * math.exp(self.ODpair[OD].a_rsSC - self.ODpair[OD].k_rs) / denominator
-            
+            # Calculate shortest path travel times (k_rs) for each OD pair
+            cost = self.originCostLabels(origin, skims)
+            self.originDemandsSinglyConstrained(origin, cost, targetDemands)
         return targetDemands
     
    def targetDemandsStatic(self):
         """
         Calculates target demands based on the demand functions.
+        The result is targetDemandBuffer, indexed by OD.index.
         """
-        targetDemands = {}
-        for OD in self.ODpair:
-            targetDemands[OD] = self.ODpair[OD].FIXEDdemand
+        targetDemands = self.targetDemandBuffer
+        for od in self.ODlist:
+            targetDemands[od.index] = od.FIXEDdemand
         return targetDemands
 
    def targetDemandsElastic(self):
         """
         Calculates target demands based on the demand functions.
+        The result is targetDemandBuffer, indexed by OD.index.
         """
-              # Calculate shortest path travel times (k_rs) for each OD pair
+        skims = self.currentSkims()
+        targetDemands = self.targetDemandBuffer
         for origin in self.relevant_origins:
-            backlink, cost = self.shortestPath(origin)
-            for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-                self.ODpair[OD].k_rs = cost[self.ODpair[OD].destination]
-                
-        targetDemands = {}
-        for OD in self.ODpair:
-            targetDemands[OD] = (self.ODpair[OD].FIXEDdemand / (1 - self.ODpair[OD].tel)) * math.exp(self.ODpair[OD].a_rsE - self.ODpair[OD].k_rs) / (math.exp(self.ODpair[OD].a_rsE - self.ODpair[OD].k_rs) + math.exp(self.ODpair[OD].a_rnE*self.telework_multiplier))
-            
+            # Calculate shortest path travel times (k_rs) for each OD pair
+            cost = self.originCostLabels(origin, skims)
+            self.originDemandsElastic(origin, cost, targetDemands)
         return targetDemands
     
    def targetDemandsRelaxed(self):
         """
         Calculates target demands based on the demand functions.
+        The result is targetDemandBuffer, indexed by OD.index.
         """
-              # Calculate shortest path travel times (k_rs) for each OD pair
-        for origin in self.relevant_origins:
-            backlink, cost = self.shortestPath(origin)
-            for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-                self.ODpair[OD].k_rs = cost[self.ODpair[OD].destination]
-                
-        targetDemands = {}
+        skims = self.currentSkims()
+        targetDemands = self.targetDemandBuffer
         for origin in self.relevant_origins:
-            denominator = 0.0
-            for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-                denominator += math.exp(self.ODpair[OD].a_rs - self.ODpair[OD].k_rs)
-            for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-                targetDemands[OD] = self.ODpair[OD].P_r_aug * math.exp(self.ODpair[OD].a_rs - self.ODpair[OD].k_rs) / (denominator + math.exp(self.ODpair[OD].a_rn*self.telework_multiplier))
-            
+            # Calculate shortest path travel times (k_rs) for each OD pair
+            cost = self.originCostLabels(origin, skims)
+            self.originDemandsRelaxed(origin, cost, targetDemands)
         return targetDemands
 
+   def originDemandsSinglyConstrained(self, origin, cost, targetDemands):
+        """
+        Singly constrained demand function for the OD pairs of one origin,
+        given its shortest path costs (indexed by node ID).  Sets k_rs and
+        writes the target demands into targetDemands (indexed by OD.index).
+        """
+        weights = self.weightBuffer
+        ods = self.originODs[origin]
+        denominator = 0.0
+        for od in ods:
+            od.k_rs = cost[od.destination]
+            weights[od.index] = math.exp(od.a_rsSC - od.k_rs)
+            denominator += weights[od.index]
+        if denominator < 0.0000001:
+            for od in ods:
+                targetDemands[od.index] = od.FIXEDdemand
+        else:
+            for od in ods:
+                targetDemands[od.index] = od.P_r * weights[od.index] / denominator
+
+   def originDemandsStatic(self, origin, cost, targetDemands):
+        for od in self.originODs[origin]:
+            od.k_rs = cost[od.destination]
+            targetDemands[od.index] = od.FIXEDdemand
+
+   def originDemandsElastic(self, origin, cost, targetDemands):
+        """
+        Elastic demand function for the OD pairs of one origin; see
+        originDemandsSinglyConstrained.
+        """
+        for od in self.originODs[origin]:
+            od.k_rs = cost[od.destination]
+            weight = math.exp(od.a_rsE - od.k_rs)
+            targetDemands[od.index] = (od.FIXEDdemand / (1 - od.tel)) * weight / (weight + math.exp(od.a_rnE*self.telework_multiplier))
+
+   def originDemandsRelaxed(self, origin, cost, targetDemands):
+        """
+        Relaxed singly constrained demand function for the OD pairs of one
+        origin; see originDemandsSinglyConstrained.
+        """
+        weights = self.weightBuffer
+        ods = self.originODs[origin]
+        denominator = 0.0
+        for od in ods:
+            od.k_rs = cost[od.destination]
+            weights[od.index] = math.exp(od.a_rs - od.k_rs)
+            denominator += weights[od.index]
+        for od in ods:
+            targetDemands[od.index] = od.P_r_aug * weights[od.index] / (denominator + math.exp(od.a_rn*self.telework_multiplier))
+
+   def originDemandFunction(self, demandFunction):
+        """
+        The per-origin kernel (originDemands*) matching one of the
+        targetDemands* methods.
+        """
+        name = demandFunction.__name__
+        if not name.startswith('targetDemands') or not hasattr(self, 'originDemands' + name[len('targetDemands'):]):
+            raise BadNetworkOperationException("No per-origin form of demand function " + name)
+        return getattr(self, 'originDemands' + name[len('targetDemands'):])
+
 
    def FrankWolfeStepSize(self, targetFlows, precision = FRANK_WOLFE_STEPSIZE_PRECISION):
       """
       This method returns the step size lambda used by the Frank-Wolfe algorithm.
       
       The current link flows are given in the self.link[ij].flow attributes, and the
-      target flows are given in the targetFlows dictionary.
+      target flows are given in the targetFlows buffer (indexed by link.index).
       
       The precision argument dictates how close your method needs to come to finding
       the exact Frank-Wolfe step size: you are fine if the absolute difference
       between the true value, and the value returned by your method, is less than
       precision.
+
+      The step minimizes the Beckmann function along the move toward the
+      target flows, found by bisection on its derivative
+         sum of cost(flow at step) * (target flow - flow)
+      (see linkCostSlope).
       """
-      
+      flows = self.currentFlows()
+      changes = self.flowChanges(flows, targetFlows)
+      if self.linkCostSlope(flows, changes, 1.0) <= 0:
+         return 1.0
       l = [0,1]
       while (l[1]-l[0])/2 > precision:
          l1 = (l[1]-l[0])/2 + l[0]
-         f = 0
-         for i in self.link:
-             f = f + self.link[i].calculateTMPCost(targetFlows[i] - self.link[i].flow)
-         if f < 0:
+         if self.linkCostSlope(flows, changes, l1) < 0:
             l[0] = l1
          else:
              l[1] = l1
-      return l1
+      return (l[0] + l[1]) / 2
+
+   def linkCostSlope(self, flows, changes, stepSize):
+      """
+      Derivative of the Beckmann function along changes, at flows +
+      stepSize * changes (arrays indexed by link.index): the sum of the link
+      costs there times changes, evaluated with linkPerformance.
+      """
+      trialFlows = self.trialFlowBuffer
+      for i, (flow, change) in enumerate(zip(flows, changes)):
+         trialFlows[i] = flow + stepSize * change
+      costs = self.linkPerformance.costs(trialFlows, self.trialCostBuffer)
+      slope = 0
+      for cost, change in zip(costs, changes):
+         if change != 0:
+            slope += cost * change
+      return slope
+
+   def flowChanges(self, flows, targetFlows):
+      """
+      Writes targetFlows - flows into flowChangeBuffer and returns it.
+      """
+      changes = self.flowChangeBuffer
+      for i in range(len(changes)):
+         changes[i] = targetFlows[i] - flows[i]
+      return changes
    
+   def demandObjective(self, demands, demandFunction):
+      """
+      The demand term of the objective minimized by the equilibrium with the
+      given demand function, for demands indexed by OD.index:
+         sum over OD pairs of d (log d - 1 - a)
+         + sum of e (log e - 1 - a_n * telework_multiplier)
+      over the non-travelling demand e (relaxed: P_r_aug minus the origin's
+      demand, with a_rn; elastic: FIXEDdemand / (1 - tel) minus the OD pair's
+      demand, with a_rnE; singly constrained and static: none).  The
+      attractiveness a is given by DEMAND_UTILITIES.  Adding the Beckmann
+      function gives the full objective.
+      """
+      name = demandFunction.__name__
+      if name not in DEMAND_UTILITIES:
+         raise BadNetworkOperationException("No convex objective for demand function " + name)
+      attribute = DEMAND_UTILITIES[name]
+      if attribute is None:
+         return 0.0
+      multiplier = self.telework_multiplier
+      total = 0.0
+      for origin in self.relevant_origins:
+         ods = self.originODs[origin]
+         travelling = 0.0
+         for od in ods:
+            demand = demands[od.index]
+            travelling += demand
+            total += entropyTerm(demand, getattr(od, attribute))
+            if name == 'targetDemandsElastic':
+               total += entropyTerm(od.FIXEDdemand / (1 - od.tel) - demand, od.a_rnE * multiplier)
+         if name == 'targetDemandsRelaxed':
+            total += entropyTerm(ods[0].P_r_aug - travelling, ods[0].a_rn * multiplier)
+      return total
+
+   def demandObjectiveSlope(self, demands, targetDemands, stepSize, demandFunction):
+      """
+      Derivative with respect to the step size of demandObjective along the
+      move from demands toward targetDemands, at demands + stepSize *
+      (targetDemands - demands).
+      """
+      name = demandFunction.__name__
+      attribute = DEMAND_UTILITIES[name]
+      if attribute is None:
+         return 0.0
+      multiplier = self.telework_multiplier
+      slope = 0.0
+      for origin in self.relevant_origins:
+         ods = self.originODs[origin]
+         travelling = 0.0
+         travellingChange = 0.0
+         for od in ods:
+            change = targetDemands[od.index] - demands[od.index]
+            demand = demands[od.index] + stepSize * change
+            travelling += demand
+            travellingChange += change
+            slope += entropySlope(demand, change, getattr(od, attribute))
+            if name == 'targetDemandsElastic':
+               slope += entropySlope(od.FIXEDdemand / (1 - od.tel) - demand, -change, od.a_rnE * multiplier)
+         if name == 'targetDemandsRelaxed':
+            slope += entropySlope(ods[0].P_r_aug - travelling, -travellingChange, ods[0].a_rn * multiplier)
+      return slope
+
+   def EvansStepSize(self, targetFlows, targetDemands, demandFunction, precision = FRANK_WOLFE_STEPSIZE_PRECISION):
+      """
+      Exact line search of Evans' partial linearization algorithm.  The
+      target demands of the demand functions solve the demand subproblem --
+      minimizing demandObjective plus the linearized link costs, i.e. the
+      shortest path costs, of each origin's trips, including the
+      non-travelling alternative -- exactly, and targetFlows loads them; this
+      finds the step along the joint move of link flows and demands toward
+      them that minimizes Z = Beckmann + demandObjective, by bisection on
+         dZ/dstep = sum of cost(flow at step) * (target flow - flow)
+                    + demandObjectiveSlope
+      to within precision.  Costs no shortest paths.
+      """
+      currentDemands = self.currentDemands()
+      flows = self.currentFlows()
+      changes = self.flowChanges(flows, targetFlows)
+      def slope(stepSize):
+         return (self.linkCostSlope(flows, changes, stepSize)
+                 + self.demandObjectiveSlope(currentDemands, targetDemands, stepSize, demandFunction))
+      if slope(1.0) <= 0:
+         return 1.0
+      low = 0.0
+      high = 1.0
+      while (high - low) / 2 > precision:
+         middle = (low + high) / 2
+         if slope(middle) < 0:
+            low = middle
+         else:
+            high = middle
+      return (low + high) / 2
+
+   def ArmijoStepSize(self, targetFlows, targetDemands, demandFunction, minimumStep):
+      """
+      Step size for the joint move of link flows and OD demands toward
+      targetFlows and targetDemands, by Armijo backtracking on the objective
+      Z = Beckmann + demandObjective: starting from 1, the step is multiplied
+      by ARMIJO_BACKTRACK until
+         Z(step) <= Z(0) - ARMIJO_SUFFICIENT_DECREASE * step * gap
+      where gap = TSTT - SPTT + D(demands) - D(targets) is the duality gap
+      (see convergence.py), which bounds the objective's descent rate from
+      above.  Only the link cost integrals and demand terms are evaluated,
+      so trying a step costs no shortest paths.  Steps are never below
+      minimumStep (typically the MSA step), which is also returned if the
+      objective does not decrease at all.
+
+      TSTT must describe the current flows and SPTT the target demands at the
+      current costs, as after allOrNothingDemand.
+      """
+      currentDemands = self.currentDemands()
+      currentTerm = self.demandObjective(currentDemands, demandFunction)
+      gap = self.TSTT - self.SPTT + currentTerm - self.demandObjective(targetDemands, demandFunction)
+      if gap <= 0:
+         return minimumStep
+      trialDemands = self.trialDemandBuffer
+      flows = self.currentFlows()
+      trialFlows = self.trialFlowBuffer
+      objective = currentTerm + self.linkPerformance.beckmann(flows)
+      stepSize = 1.0
+      while stepSize > minimumStep:
+         for i in range(len(trialFlows)):
+            trialFlows[i] = flows[i] + stepSize * (targetFlows[i] - flows[i])
+         trialObjective = self.linkPerformance.beckmann(trialFlows)
+         for od in self.ODlist:
+            trialDemands[od.index] = currentDemands[od.index] + stepSize * (targetDemands[od.index]
+                                                                            - currentDemands[od.index])
+         trialObjective += self.demandObjective(trialDemands, demandFunction)
+         if trialObjective <= objective - ARMIJO_SUFFICIENT_DECREASE * stepSize * gap:
+            return stepSize
+         stepSize *= ARMIJO_BACKTRACK
+      return minimumStep
+
    def reset(self, teleworkMultiplier):
        self.telework_multiplier = teleworkMultiplier
+       self.refreshLinkParameters()
        self.TMF = 9999
        self.TSTT = 0
        self.SPTT = 0
@@ -266,7 +580,186 @@ class Network:
        for l in self.link:
            self.link[l].flow = 0
            self.link[l].cost = self.link[l].freeFlowTime
+       if self.originFlows is not None:
+           self.originFlows.clear()
+       self.pendingTargets = None
+       self.lastStepSize = None
+
+   def coldStart(self, teleworkMultiplier):
+      """
+      reset() followed by an all-or-nothing loading of the fixed demands,
+      the starting point of a solve from scratch.
+      """
+      self.reset(teleworkMultiplier)
+      
+      #initialDemands = self.targetDemands() Dont need initial demands can used fixed demands
+      initialFlows = self.allOrNothing()
+      self.TSTT = 0
+      for link, initialFlow in zip(self.linkList, initialFlows):
+         link.flow = initialFlow
+         link.updateCost()
+         self.TSTT += link.flow * link.cost
+      if self.originFlows is not None:
+         self.originFlows.shift(1)
+
+   def warmStart(self, teleworkMultiplier, demandFunction):
+      """
+      Alternative to reset() for solving from the current link flows and OD
+      demands, e.g. the solution of a neighbouring scenario.  Link costs, TSTT
+      and total demand are recomputed for the current state, and the target
+      demands at the current costs are evaluated once so that SPTT and TMF
+      (and hence the gap functions) describe this state rather than the
+      previous solve.
+      """
+      self.refreshWarmState(teleworkMultiplier)
+      targetDemands = demandFunction()
+      self.allOrNothingDemand(targetDemands)
+      self.TMF = 0
+      for od in self.ODlist:
+         self.TMF += abs(targetDemands[od.index] - od.demand)
+
+   def refreshWarmState(self, teleworkMultiplier):
+      """
+      The part of warmStart that needs no shortest paths: sets the telework
+      multiplier, drops the step size and pending targets of the previous
+      solve, and recomputes link costs (from the current link parameters, see
+      refreshLinkParameters), TSTT and total demand for the current flows and
+      demands.
+      """
+      self.telework_multiplier = teleworkMultiplier
+      self.pendingTargets = None
+      self.lastStepSize = None
+      self.refreshLinkParameters()
+      self.TSTT = 0
+      for link in self.linkList:
+         link.updateCost()
+         self.TSTT += link.flow * link.cost
+      self.totalDemand = 0
+      for od in self.ODlist:
+         self.totalDemand += od.demand
+
+   def enableProfiling(self, scenario = "", firstIteration = 1, lastIteration = None,
+                       topN = 20, outputPrefix = "profile", deep = False):
+      """
+      Attaches a Profiler (see profiler.py) to the solver entry points.  Only
+      iterations firstIteration..lastIteration of the solvers are profiled;
+      reports are tagged with the network name and the given scenario name.
+      Stack sampling is used unless deep is True, in which case cProfile
+      traces every call and a pstats file is dumped as well.
+      """
+      self.profiler = Profiler(self.name, scenario, firstIteration, lastIteration, topN, outputPrefix, deep)
+      return self.profiler
+
+   def disableProfiling(self):
+      self.profiler = None
+
+   def enableMemoryTracking(self, method = "tracemalloc"):
+      """
+      Attaches a MemoryMonitor (see memory.py) which records the peak
+      allocation of each solver phase.  method is 'tracemalloc' (exact, but
+      slows the run) or 'rss' (sampled resident set size, nearly free).
+      """
+      self.memoryMonitor = MemoryMonitor(method)
+      return self.memoryMonitor
+
+   def disableMemoryTracking(self):
+      if self.memoryMonitor is not None:
+         self.memoryMonitor.stop()
+      self.memoryMonitor = None
+
+   def phase(self, name):
+      """
+      Context manager marking a solver phase for memory tracking; does nothing
+      unless enableMemoryTracking has been called.
+      """
+      if self.memoryMonitor is None:
+         return contextlib.nullcontext()
+      return self.memoryMonitor.phase(name)
+
+   def memoryReport(self):
+      """
+      Returns a dictionary describing memory use: 'stores' gives the
+      approximate size in bytes of
+         node, link, ODpair, path -- the dictionaries, including the objects
+                       they hold
+         linkBuffers -- the link-sized work buffers and topology arrays
+         labels      -- the node-sized shortest path labels
+         ODBuffers   -- the OD-sized work buffers
+         classFlows  -- the classes x links flows, work buffers and class costs
+                       of the last multi-class solve
+         linkPerformance -- the per-link parameter arrays of the link
+                       performance functions
+         originFlows -- the link flows by origin, if tracked
+         skims       -- the mapping of the attached skim file, which is only
+                       resident as far as it has been read
+      (the buffers only once they are built, the other stores only when
+      present); 'phases' gives the peak and retained allocation per solver
+      phase if memory tracking is enabled, and 'peakRSS' is the peak resident
+      set size of the process.
+      """
+      stores = dict()
+      for name, store in (('node', self.node), ('link', self.link), ('ODpair', self.ODpair), ('path', self.path)):
+         stores[name] = deepSizeOf(store, {id(self)})
+      for name, attributes in MEMORY_STORES:
+         held = [getattr(self, attribute, None) for attribute in attributes]
+         held = [store for store in held if store is not None]
+         if len(held) > 0:
+            stores[name] = sum(deepSizeOf(store, {id(self)}) for store in held)
+      if self.skims is not None and self.skims.map is not None:
+         stores['skims'] = len(self.skims.map)
+      report = dict()
+      report['stores'] = stores
+      report['phases'] = dict(self.memoryMonitor.phases) if self.memoryMonitor is not None else dict()
+      report['method'] = self.memoryMonitor.method if self.memoryMonitor is not None else None
+      report['peakRSS'] = peakRSS()
+      return report
+
+   def formatMemoryReport(self):
+      return formatMemoryReport(self.memoryReport())
+
+   def memoryStatus(self):
+      """
+      Short memory suffix for the per-iteration log line; empty unless memory
+      tracking is enabled.
+      """
+      if self.memoryMonitor is None:
+         return ""
+      current, peak = self.memoryMonitor.measure()
+      return ": memory %.1f MB (peak %.1f MB)" % (current / MEGABYTE, peak / MEGABYTE)
        
+   def solve(self, demandFunction = None, stepSizeRule = 'MSA', maxIterations = 10, targetGap = 1e-6,
+             targetGap2 = 1e-2, gapFunction = None, gapFunction2 = None, teleworkMultiplier = 0,
+             warmStart = False, stepOffset = 0, stoppingPolicy = None, userClasses = None, callback = None,
+             verbose = False):
+      """
+      Library entry point: solves the network with RELAXEDuserEquilibrium and
+      returns an AssignmentResult (see results.py) holding the link flows and
+      costs, OD demands and travel times, origin and destination aggregates,
+      gap history and solve time in arrays.  demandFunction defaults to
+      targetDemandsRelaxed (targetDemandsStatic gives fixed demand), and
+      gapFunction / gapFunction2 to averageExcessCost / TMFGap; the other
+      arguments, including callback, are those of RELAXEDuserEquilibrium.
+
+      Nothing is printed unless verbose is True, and nothing is written; call
+      writeFiles on the result for the printResults files.
+      """
+      demandFunction = demandFunction if demandFunction is not None else self.targetDemandsRelaxed
+      gapFunction = gapFunction if gapFunction is not None else self.averageExcessCost
+      gapFunction2 = gapFunction2 if gapFunction2 is not None else self.TMFGap
+      iterationLog = self.iterationLog
+      if not verbose:
+         self.iterationLog = None
+      try:
+         startTime = time.time()
+         self.RELAXEDuserEquilibrium(stepSizeRule, maxIterations, targetGap, targetGap2, gapFunction, gapFunction2,
+                                     demandFunction, teleworkMultiplier, warmStart, stepOffset, stoppingPolicy,
+                                     userClasses, callback)
+         solveTime = time.time() - startTime
+      finally:
+         self.iterationLog = iterationLog
+      return AssignmentResult(self, solveTime)
+
+   @instrumented("RELAXEDuserEquilibrium", iterative = True)
    def RELAXEDuserEquilibrium(self, stepSizeRule = 'MSA',
                           maxIterations = 10,
                           targetGap = 1e-6, 
@@ -274,96 +767,394 @@ class Network:
                           gapFunction = relativeGap,
                           gapFunction2 = TMFGap,
                           demandFunction = targetDemandsRelaxed,
-                          teleworkMultiplier = 0):
+                          teleworkMultiplier = 0,
+                          warmStart = False,
+                          stepOffset = 0,
+                          stoppingPolicy = None,
+                          userClasses = None,
+                          callback = None):
       """
       This method uses the (link-based) convex combinations algorithm to solve
       for user equilibrium.  Arguments are the following:
          stepSizeRule -- a string specifying how the step size lambda is
-                         to be chosen.  Currently 'FW' and 'MSA' are the
-                         available choices, but you can implement more if you
-                         want.
+                         to be chosen: 'FW', 'MSA', 'SRA' (self-regulating
+                         averaging: 1 / beta, where beta grows by SRA_INCREASE
+                         when the gaps, each relative to its target, grew
+                         since the last iteration and by SRA_DECREASE when
+                         they shrank) or 'ARMIJO' (backtracking from 1 on the
+                         joint link and demand objective, see ArmijoStepSize)
+                         or 'EVANS' (partial linearization: exact line search
+                         on that objective, see EvansStepSize)
          maxIterations -- stop after this many iterations have been performed
          targetGap     -- stop once the gap is below this level
          gapFunction   -- pointer to the function used to calculate gap.  After
                           finishing this assignment, you should be able to
                           choose either relativeGap or averageExcessCost.
+         warmStart     -- if True, start from the current link flows and OD
+                          demands (see warmStart) instead of reset() and an
+                          all-or-nothing loading of the fixed demands
+         stepOffset    -- MSA uses 1 / (iteration + 1 + stepOffset); a positive
+                          offset keeps the first steps of a warm start from
+                          discarding most of the starting solution
+         stoppingPolicy -- optional StoppingPolicy (see stopping.py) adding a
+                          time budget, stall detection and a projected time
+                          limit, and restoring the best iterate at the end
+         userClasses   -- optional list of UserClass objects (see userclass.py)
+                          for multi-class assignment; see multiClassEquilibrium
+         callback      -- optional function called each iteration, once the
+                          gaps are known, as callback(network, iteration, gap,
+                          gap2, elapsed time); the solve stops (stopReason
+                          'callback') when it returns True
+      Each iteration is reported through self.iterationLog (print by
+      default; None for silence).  The number of iterations performed is
+      stored in self.iterations, and (iteration, gap, gap2, elapsed time) for
+      each one in self.convergenceHistory.
       """
-      self.reset(teleworkMultiplier)
-      
-      #initialDemands = self.targetDemands() Dont need initial demands can used fixed demands
-      initialFlows = self.allOrNothing()
-      self.TSTT = 0
-      for ij in self.link:
-         self.link[ij].flow = initialFlows[ij]
-         self.link[ij].updateCost()
-         self.TSTT += self.link[ij].flow * self.link[ij].cost
+      if userClasses is not None:
+         if warmStart or stoppingPolicy is not None:
+            raise BadNetworkOperationException("Multi-class assignment does not support warm starts or stopping policies")
+         return self.multiClassEquilibrium(userClasses, stepSizeRule, maxIterations, targetGap, targetGap2,
+                                           gapFunction, gapFunction2, teleworkMultiplier, stepOffset, callback)
+      if warmStart:
+         self.warmStart(teleworkMultiplier, demandFunction)
+      else:
+         self.coldStart(teleworkMultiplier)
          
       iteration = 0
+      stepDenominator = 1 + stepOffset
+      previousProgress = None
+      self.convergenceHistory = list()
+      self.stopReason = 'maxIterations'
+      stopReason = None
+      if stoppingPolicy is not None:
+         stoppingPolicy.start(self, targetGap, targetGap2)
       startTime = time.time()
       while iteration < maxIterations:
          iteration += 1
+         self.iterations = iteration
+         if self.profiler is not None:
+            self.profiler.iteration(iteration)
          gap = gapFunction()
          gap2 = gapFunction2()
          endTime = time.time() - startTime
-         print("Iteration %d: AEC %f: TMF %f: time %f" % (iteration, gap, gap2, endTime))
+         self.convergenceHistory.append((iteration, gap, gap2, endTime))
+         if self.trajectory is not None:
+            self.trajectory.record(self, iteration, gap, gap2, endTime)
+         if self.iterationLog is not None:
+            self.iterationLog("Iteration %d: AEC %f: TMF %f: time %f%s" % (iteration, gap, gap2, endTime, self.memoryStatus()))
          if (gap < targetGap):
              if gap2 < targetGap2:
+                 stopReason = 'converged'
+                 self.stopReason = stopReason
+                 if stoppingPolicy is not None:
+                    stoppingPolicy.check(self, iteration, gap, gap2, endTime)
                  break
-         targetDemands = demandFunction()
-         targetFlows = self.allOrNothingDemand(targetDemands)
+         if callback is not None and callback(self, iteration, gap, gap2, endTime):
+            stopReason = 'callback'
+            self.stopReason = stopReason
+            if stoppingPolicy is not None:
+               stoppingPolicy.check(self, iteration, gap, gap2, endTime)
+            break
+         if stoppingPolicy is not None:
+            stopReason = stoppingPolicy.check(self, iteration, gap, gap2, endTime)
+            if stopReason is not None:
+               break
+         if self.pendingTargetsFor(demandFunction):
+            targetDemands = self.targetDemandBuffer
+            targetFlows = self.targetFlowBuffer
+         else:
+            with self.phase("targetDemands"):
+               targetDemands = demandFunction()
+            with self.phase("allOrNothing"):
+               targetFlows = self.allOrNothingDemand(targetDemands)
          if stepSizeRule == 'FW':
             stepSize = self.FrankWolfeStepSize(targetFlows)
          elif stepSizeRule == 'MSA':
-            stepSize = 1 / (iteration + 1)
+            stepSize = 1 / (iteration + 1 + stepOffset)
+         elif stepSizeRule == 'SRA':
+            progress = (gap / targetGap if targetGap > 0 else gap) + (gap2 / targetGap2 if targetGap2 > 0 else gap2)
+            stepDenominator += SRA_INCREASE if iteration > 1 and progress >= previousProgress else SRA_DECREASE
+            previousProgress = progress
+            stepSize = 1 / stepDenominator
+         elif stepSizeRule == 'ARMIJO':
+            stepSize = self.ArmijoStepSize(targetFlows, targetDemands, demandFunction, 1 / (iteration + 1 + stepOffset))
+         elif stepSizeRule == 'EVANS':
+            stepSize = self.EvansStepSize(targetFlows, targetDemands, demandFunction)
          else:
             raise BadNetworkOperationException("Unknown step size rule " + str(stepSizeRule))
-         self.shiftDemandFlows(targetFlows, targetDemands, stepSize)
+         with self.phase("shiftFlows"):
+            self.shiftDemandFlows(targetFlows, targetDemands, stepSize)
+      if stoppingPolicy is not None:
+         stoppingPolicy.finish(self, stopReason, stopReason is None)
          
 
+   @instrumented("userEquilibrium", iterative = True)
    def userEquilibrium(self, stepSizeRule = 'MSA',
                           maxIterations = 10,
                           targetGap = 1e-6, 
-                          gapFunction = relativeGap):
+                          gapFunction = relativeGap,
+                          stoppingPolicy = None,
+                          callback = None):
       """
       This method uses the (link-based) convex combinations algorithm to solve
       for user equilibrium.  Arguments are the following:
          stepSizeRule -- a string specifying how the step size lambda is
-                         to be chosen.  Currently 'FW' and 'MSA' are the
-                         available choices, but you can implement more if you
-                         want.
+                         to be chosen: 'FW', 'MSA', 'SRA' (self-regulating
+                         averaging: 1 / beta, where beta grows by SRA_INCREASE
+                         when the gaps, each relative to its target, grew
+                         since the last iteration and by SRA_DECREASE when
+                         they shrank) or 'ARMIJO' (backtracking from 1 on the
+                         joint link and demand objective, see ArmijoStepSize)
+                         or 'EVANS' (partial linearization: exact line search
+                         on that objective, see EvansStepSize)
          maxIterations -- stop after this many iterations have been performed
          targetGap     -- stop once the gap is below this level
          gapFunction   -- pointer to the function used to calculate gap.  After
                           finishing this assignment, you should be able to
                           choose either relativeGap or averageExcessCost.
+         stoppingPolicy -- optional StoppingPolicy; see RELAXEDuserEquilibrium
+         callback      -- see RELAXEDuserEquilibrium; gap2 is always 0
       """
       self.TMF = 0
+      self.lastStepSize = None
       
       initialFlows = self.allOrNothing()
       self.TSTT = 0
-      for ij in self.link:
-         self.link[ij].flow = initialFlows[ij]
-         self.link[ij].updateCost()
-         self.TSTT += self.link[ij].flow * self.link[ij].cost
+      for link, initialFlow in zip(self.linkList, initialFlows):
+         link.flow = initialFlow
+         link.updateCost()
+         self.TSTT += link.flow * link.cost
+      if self.originFlows is not None:
+         self.originFlows.shift(1)
          
       iteration = 0
+      stepDenominator = 1
+      previousProgress = None
+      self.convergenceHistory = list()
+      self.stopReason = 'maxIterations'
+      stopReason = None
+      if stoppingPolicy is not None:
+         stoppingPolicy.start(self, targetGap)
       startTime = time.time()
       while iteration < maxIterations:
          iteration += 1
+         self.iterations = iteration
+         if self.profiler is not None:
+            self.profiler.iteration(iteration)
          gap = gapFunction()
          endTime = time.time() - startTime
-         print("Iteration %d: gap %f: time %f" % (iteration, gap, endTime))
+         self.convergenceHistory.append((iteration, gap, 0, endTime))
+         if self.trajectory is not None:
+            self.trajectory.record(self, iteration, gap, 0, endTime)
+         if self.iterationLog is not None:
+            self.iterationLog("Iteration %d: gap %f: time %f%s" % (iteration, gap, endTime, self.memoryStatus()))
          if gap < targetGap:
+            stopReason = 'converged'
+            self.stopReason = stopReason
+            if stoppingPolicy is not None:
+               stoppingPolicy.check(self, iteration, gap, 0, endTime)
+            break
+         if callback is not None and callback(self, iteration, gap, 0, endTime):
+            stopReason = 'callback'
+            self.stopReason = stopReason
+            if stoppingPolicy is not None:
+               stoppingPolicy.check(self, iteration, gap, 0, endTime)
             break
-         targetFlows = self.allOrNothing()
+         if stoppingPolicy is not None:
+            stopReason = stoppingPolicy.check(self, iteration, gap, 0, endTime)
+            if stopReason is not None:
+               break
+         if self.pendingTargetsFor(self.targetDemandsStatic):
+            targetFlows = self.targetFlowBuffer
+         else:
+            with self.phase("allOrNothing"):
+               targetFlows = self.allOrNothing()
          if stepSizeRule == 'FW':
             stepSize = self.FrankWolfeStepSize(targetFlows)
          elif stepSizeRule == 'MSA':
             stepSize = 1 / (iteration + 1)
+         elif stepSizeRule == 'SRA':
+            stepDenominator += SRA_INCREASE if iteration > 1 and gap >= previousProgress else SRA_DECREASE
+            previousProgress = gap
+            stepSize = 1 / stepDenominator
+         elif stepSizeRule == 'ARMIJO':
+            stepSize = self.ArmijoStepSize(targetFlows, self.currentDemands(), self.targetDemandsStatic,
+                                           1 / (iteration + 1))
+         elif stepSizeRule == 'EVANS':
+            stepSize = self.EvansStepSize(targetFlows, self.currentDemands(), self.targetDemandsStatic)
          else:
             raise BadNetworkOperationException("Unknown step size rule " + str(stepSizeRule))
-         self.shiftFlows(targetFlows, stepSize)
+         with self.phase("shiftFlows"):
+            self.shiftFlows(targetFlows, stepSize)
+      if stoppingPolicy is not None:
+         stoppingPolicy.finish(self, stopReason, stopReason is None)
          
+   def multiClassEquilibrium(self, userClasses, stepSizeRule = 'MSA', maxIterations = 10, targetGap = 1e-6,
+                             targetGap2 = 1e-2, gapFunction = None, gapFunction2 = None, teleworkMultiplier = 0,
+                             stepOffset = 0, callback = None):
+      """
+      Convex combinations algorithm for several user classes (see
+      userclass.py) sharing the network: travel times depend on the total
+      link flow, the sum of the classes' flows weighted by their pce, while
+      each class sees its own generalized costs (its toll and distance
+      weights) and demand function.  Called by RELAXEDuserEquilibrium when
+      userClasses are given; stepSizeRule is 'MSA' or 'SRA', as the classes'
+      costs have no common objective for the line searches.
+
+      Classes with the same cost weights share one shortest path tree per
+      origin, which is used both for their target demands and for their
+      all-or-nothing loading.  Class link flows and targets are kept in flat
+      classes x links arrays (classFlows, classTargetFlows; each class's
+      flows and targetFlows are its row), and all classes are shifted in one
+      pass over them, in place; the pce-weighted link totals are accumulated
+      in a preallocated buffer.
+
+      TSTT, SPTT, TMF and totalDemand are summed over the classes, so the
+      network's gap functions apply unchanged.
+      """
+      gapFunction = gapFunction if gapFunction is not None else self.averageExcessCost
+      gapFunction2 = gapFunction2 if gapFunction2 is not None else self.TMFGap
+      if stepSizeRule not in ('MSA', 'SRA'):
+         raise BadNetworkOperationException("Step size rule %s is not available for multi-class assignment" % stepSizeRule)
+      classes = list(userClasses)
+      numLinks = len(self.linkList)
+      self.classFlows = array('d', [0.0]) * (len(classes) * numLinks)
+      self.classTargetFlows = array('d', self.classFlows)
+      self.classTotalBuffer = array('d', [0.0]) * numLinks
+      self.blankClassBuffer = array('d', self.classTotalBuffer)
+      flows = memoryview(self.classFlows)
+      targetFlows = memoryview(self.classTargetFlows)
+      groups = dict()
+      for c, userClass in enumerate(classes):
+         userClass.flows = flows[c * numLinks : (c + 1) * numLinks]
+         userClass.targetFlows = targetFlows[c * numLinks : (c + 1) * numLinks]
+         userClass.telework_multiplier = teleworkMultiplier
+         groups.setdefault(userClass.costKey(), list()).append(userClass)
+      self.classCosts = dict((key, array('d', [0.0]) * numLinks) for key in groups)
+      origins = sorted(set().union(*[userClass.relevant_origins for userClass in classes]))
+
+      self.reset(teleworkMultiplier)
+      for userClass in classes:
+         for od in userClass.ODlist:
+            od.demand = od.FIXEDdemand
+      self.loadClassTargets(classes, groups, origins, False)
+      self.shiftClasses(classes, 1)
+      self.lastStepSize = None
+      self.TMF = 9999
+
+      iteration = 0
+      stepDenominator = 1 + stepOffset
+      previousProgress = None
+      self.convergenceHistory = list()
+      self.stopReason = 'maxIterations'
+      startTime = time.time()
+      while iteration < maxIterations:
+         iteration += 1
+         self.iterations = iteration
+         if self.profiler is not None:
+            self.profiler.iteration(iteration)
+         gap = gapFunction()
+         gap2 = gapFunction2()
+         endTime = time.time() - startTime
+         self.convergenceHistory.append((iteration, gap, gap2, endTime))
+         if self.trajectory is not None:
+            self.trajectory.record(self, iteration, gap, gap2, endTime)
+         if self.iterationLog is not None:
+            self.iterationLog("Iteration %d: AEC %f: TMF %f: time %f%s" % (iteration, gap, gap2, endTime, self.memoryStatus()))
+         if gap < targetGap and gap2 < targetGap2:
+            self.stopReason = 'converged'
+            break
+         if callback is not None and callback(self, iteration, gap, gap2, endTime):
+            self.stopReason = 'callback'
+            break
+         with self.phase("classTargets"):
+            self.loadClassTargets(classes, groups, origins, True)
+         if stepSizeRule == 'MSA':
+            stepSize = 1 / (iteration + 1 + stepOffset)
+         else:
+            progress = (gap / targetGap if targetGap > 0 else gap) + (gap2 / targetGap2 if targetGap2 > 0 else gap2)
+            stepDenominator += SRA_INCREASE if iteration > 1 and progress >= previousProgress else SRA_DECREASE
+            previousProgress = progress
+            stepSize = 1 / stepDenominator
+         with self.phase("shiftFlows"):
+            self.shiftClasses(classes, stepSize)
+
+   def refreshClassCosts(self):
+      """
+      Generalized link costs of each group of classes (keyed by
+      UserClass.costKey) at the current link costs, in classCosts.
+      """
+      for (tollFactor, distanceFactor), costs in self.classCosts.items():
+         tollDifference = tollFactor - self.tollFactor
+         distanceDifference = distanceFactor - self.distanceFactor
+         for link in self.linkList:
+            costs[link.index] = link.cost + link.toll * tollDifference + link.length * distanceDifference
+
+   def loadClassTargets(self, classes, groups, origins, useDemandFunctions):
+      """
+      One pass over the origins: for each group of classes with the same
+      costs, one shortest path tree, from which every class in the group with
+      trips from the origin gets its target demands (its demand function, or
+      its current demands if useDemandFunctions is False) and its
+      all-or-nothing flows, in classTargetFlows.  Sets SPTT.
+      """
+      self.refreshClassCosts()
+      for userClass in classes:
+         userClass.targetFlows[:] = self.blankClassBuffer
+      self.SPTT = 0
+      for origin in origins:
+         for key, members in groups.items():
+            members = [userClass for userClass in members if origin in userClass.originODs]
+            if len(members) == 0:
+               continue
+            cost = self.shortestPathLabels(origin, self.classCosts[key])[0]
+            for userClass in members:
+               ods = userClass.originODs[origin]
+               if useDemandFunctions:
+                  userClass.originDemands(userClass, origin, cost, userClass.targetDemands)
+               else:
+                  for od in ods:
+                     od.k_rs = cost[od.destination]
+                     userClass.targetDemands[od.index] = od.demand
+               self.SPTT += self.loadOriginTree(origin, userClass.targetDemands, userClass.targetFlows, ods)
+
+   def shiftClasses(self, classes, stepSize):
+      """
+      Moves all classes' link flows and demands stepSize of the way to their
+      targets, then sets the link flows to the pce-weighted total, updates
+      link costs, and recomputes TSTT (in each class's generalized costs),
+      TMF and totalDemand.
+      """
+      self.lastStepSize = stepSize
+      flows = self.classFlows
+      for i, target in enumerate(self.classTargetFlows):
+         flows[i] += stepSize * (target - flows[i])
+      totals = self.classTotalBuffer
+      totals[:] = self.blankClassBuffer
+      for userClass in classes:
+         pce = userClass.pce
+         for l, flow in enumerate(userClass.flows):
+            totals[l] += pce * flow
+      for link in self.linkList:
+         link.flow = totals[link.index]
+         link.updateCost()
+      self.refreshClassCosts()
+
+      self.TSTT = 0
+      self.TMF = 0
+      self.totalDemand = 0
+      for userClass in classes:
+         costs = self.classCosts[userClass.costKey()]
+         for l, flow in enumerate(userClass.flows):
+            self.TSTT += flow * costs[l]
+         targetDemands = userClass.targetDemands
+         for od in userClass.ODlist:
+            self.TMF += abs(targetDemands[od.index] - od.demand)
+            od.demand = (1 - stepSize) * od.demand + stepSize * targetDemands[od.index]
+            self.totalDemand += od.demand
+      self.refreshLinkCosts()
+
+   @instrumented("calcAttractiveness")
    def calcAttractiveness(self):
       """
       This method calculates origin-specific attractiveness of each destination
@@ -371,28 +1162,18 @@ class Network:
       """
       
       #calculate P_r and then assign it to all nodes with the same origin
-      P_r = {}
       for origin in self.relevant_origins:
-          P_r[origin] = sum(self.ODpair[OD].demand for OD in self.ODpair if self.ODpair[OD].origin == origin)
-          for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-              self.ODpair[OD].P_r = P_r[origin]
-              self.ODpair[OD].P_r_aug = P_r[origin] / (1 - self.ODpair[OD].tel)
-         
-      # Calculate shortest path travel times (k_rs) for each OD pair
-      for origin in self.relevant_origins:
-          backlink, cost = self.shortestPath(origin)
-          for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-                  destination = self.ODpair[OD].destination
-                  self.ODpair[OD].k_rs = cost[destination]
-        
-      for OD in self.ODpair:
-          origin = self.ODpair[OD].origin
-          self.ODpair[OD].a_rs = math.log(self.ODpair[OD].demand / self.ODpair[OD].P_r_aug) + self.ODpair[OD].k_rs
-          self.ODpair[OD].a_rn = math.log((self.ODpair[OD].P_r_aug - self.ODpair[OD].P_r) / self.ODpair[OD].P_r_aug)
-          self.ODpair[OD].a_rsE = math.log(self.ODpair[OD].demand / (self.ODpair[OD].demand/(1 - self.ODpair[OD].tel))) + self.ODpair[OD].k_rs
-          self.ODpair[OD].a_rnE = math.log(1 - self.ODpair[OD].demand / (self.ODpair[OD].demand/(1 - self.ODpair[OD].tel)))
-          self.ODpair[OD].a_rsSC = math.log(self.ODpair[OD].demand / self.ODpair[OD].P_r) + self.ODpair[OD].k_rs
+          ods = self.originODs[origin]
+          P_r = 0
+          for od in ods:
+              P_r += od.demand
+          for od in ods:
+              od.P_r = P_r
+              od.P_r_aug = P_r / (1 - od.tel)
          
+      # Shortest path travel times (k_rs) for each OD pair
+      self.updateSkims()
+      self.attractivenessFromDemands()
             
    def updateAttractiveness(self):
       """
@@ -400,24 +1181,199 @@ class Network:
       This method calculates origin-specific attractiveness of each destination
       using inverse demand functions
       """
-      for OD in self.ODpair:
-          origin = self.ODpair[OD].origin
-          self.ODpair[OD].a_rs = math.log(self.ODpair[OD].demand / self.ODpair[OD].P_r_aug) + self.ODpair[OD].k_rs
-          self.ODpair[OD].a_rn = math.log((self.ODpair[OD].P_r_aug - self.ODpair[OD].P_r) / self.ODpair[OD].P_r_aug)
-          self.ODpair[OD].a_rsE = math.log(self.ODpair[OD].demand / (self.ODpair[OD].demand/(1 - self.ODpair[OD].tel))) + self.ODpair[OD].k_rs
-          self.ODpair[OD].a_rnE = math.log(1 - self.ODpair[OD].demand / (self.ODpair[OD].demand/(1 - self.ODpair[OD].tel)))
-          self.ODpair[OD].a_rsSC = math.log(self.ODpair[OD].demand / self.ODpair[OD].P_r) + self.ODpair[OD].k_rs
+      self.attractivenessFromDemands()
+
+   def attractivenessFromDemands(self):
+      """
+      Inverts the demand functions: computes all five attractiveness
+      parameters (a_rs, a_rn, a_rsE, a_rnE, a_rsSC) of every OD pair in a
+      single pass, from its current demand, k_rs, P_r, P_r_aug and tel.
+      """
+      log = math.log
+      for od in self.ODlist:
+          demand = od.demand
+          augmentedDemand = demand / (1 - od.tel)
+          od.a_rs = log(demand / od.P_r_aug) + od.k_rs
+          od.a_rn = log((od.P_r_aug - od.P_r) / od.P_r_aug)
+          od.a_rsE = log(demand / augmentedDemand) + od.k_rs
+          od.a_rnE = log(1 - demand / augmentedDemand)
+          od.a_rsSC = log(demand / od.P_r) + od.k_rs
+
+   def costState(self):
+      """
+      Short fingerprint of the current link costs, used to tell whether
+      shortest path skims computed earlier are still valid.
+      """
+      self.refreshLinkCosts()
+      return hashlib.blake2b(self.linkCosts.tobytes(), digest_size = 16).hexdigest()
+
+   def updateSkims(self):
+      """
+      Sets k_rs for every OD pair to its shortest path cost at the current
+      link costs, with one shortest path tree per origin, or from the attached
+      skim file (see attachSkims) if it matches these costs.  The skims are
+      cached: if the link costs have not changed since the last call, nothing
+      is recomputed.
+      """
+      state = self.costState()
+      if state == self.skimCostState:
+         return
+      skims = self.skims if self.skims is not None and self.skims.costState == state else None
+      for origin in self.relevant_origins:
+          cost = self.originCostLabels(origin, skims)
+          for od in self.originODs[origin]:
+              od.k_rs = cost[od.destination]
+      self.skimCostState = state
+
+   def attachSkims(self, skims):
+      """
+      Attaches a SkimMatrix (see skim.py), or detaches with None.  While the
+      network's link costs match the state the skims were computed at, the
+      demand functions and updateSkims read shortest path costs from the skim
+      file instead of running shortest paths.
+      """
+      if skims is not None and skims.numZones != self.numZones:
+         raise BadNetworkOperationException("Skims have %d zones, network has %d" % (skims.numZones, self.numZones))
+      self.skims = skims
+
+   def trackOriginFlows(self, enable = True):
+      """
+      Switches on (or off) the breakdown of link flows by origin (see
+      originflows.py), which incremental re-equilibration needs from the
+      solve it starts from.  Tracking must be on from the start of that
+      solve, as the breakdown is built up from its all-or-nothing trees.
+      """
+      self.originFlows = OriginFlows(self) if enable else None
+      return self.originFlows
+
+   def recordTrajectory(self, fileName, every = 1, maxSnapshots = 100, fields = ('flow', 'cost', 'demand')):
+      """
+      Attaches a TrajectoryRecorder (see trajectory.py), which stores the
+      link flows, link costs and OD demands of every every-th iteration of
+      the following solves in fileName, preallocated for maxSnapshots
+      snapshots, with an index of iterations, gaps and step sizes.  Read it
+      back with openTrajectory.
+      """
+      self.stopRecordingTrajectory()
+      self.trajectory = TrajectoryRecorder(self, fileName, every, maxSnapshots, fields)
+      return self.trajectory
+
+   def stopRecordingTrajectory(self):
+      if self.trajectory is not None:
+         self.trajectory.close()
+      self.trajectory = None
+
+   def currentSkims(self):
+      """
+      Refreshes the linkCosts buffer and returns the attached skims if they
+      were computed at these costs, or None otherwise.
+      """
+      if self.skims is None:
+         self.refreshLinkCosts()
+         return None
+      return self.skims if self.costState() == self.skims.costState else None
+
+   def originCostLabels(self, origin, skims = None):
+      """
+      Shortest path costs from origin, indexed by node ID (only zone entries
+      are valid when read from skims): a row of skims if given, otherwise
+      the labels of a fresh shortest path tree at the current linkCosts.
+      """
+      if skims is not None:
+         return skims.row(origin)
+      return self.shortestPathLabels(origin)[0]
+
+   def calibrateAttractiveness(self, demandFunction = None,
+                               teleworkMultiplier = 1.0,
+                               tolerance = 1e-3,
+                               maxRounds = 20,
+                               stepSizeRule = 'MSA',
+                               maxIterations = 100,
+                               targetGap = 1e-6,
+                               targetGap2 = 1e-2,
+                               gapFunction = None,
+                               gapFunction2 = None,
+                               stepOffset = 10):
+      """
+      Iteratively adjusts the attractiveness parameters of the given demand
+      function until the equilibrium demands reproduce the observed demands
+      (FIXEDdemand) within tolerance.  The error is the total absolute
+      demand mismatch divided by the total observed demand.
+
+      Each round solves RELAXEDuserEquilibrium (warm-started from the previous
+      round after the first) and then corrects the parameters multiplicatively,
+      which reproduces the observed demands exactly at the current skims:
+         relaxed  -- a_rs += log(observed / solved) per OD pair, and a_rn is
+                     shifted so that each origin's non-travelling demand
+                     (P_r_aug minus total demand) matches P_r_aug - P_r
+         elastic  -- a_rsE += log(observed / solved), and a_rnE is shifted so
+                     that each OD pair's non-travelling demand matches
+                     FIXEDdemand / (1 - tel) - FIXEDdemand
+         singly constrained -- a_rsSC += log(observed / solved)
+      Returns a list of (round, error, equilibrium iterations) tuples.
+      """
+      demandFunction = demandFunction if demandFunction is not None else self.targetDemandsRelaxed
+      gapFunction = gapFunction if gapFunction is not None else self.averageExcessCost
+      gapFunction2 = gapFunction2 if gapFunction2 is not None else self.TMFGap
+      name = demandFunction.__name__
+      if name not in ('targetDemandsRelaxed', 'targetDemandsElastic', 'targetDemandsSinglyConstrained'):
+         raise BadNetworkOperationException("Cannot calibrate demand function " + name)
+      log = math.log
+      multiplier = teleworkMultiplier if teleworkMultiplier != 0 else 1.0
+
+      history = list()
+      for calibrationRound in range(1, maxRounds + 1):
+         warm = calibrationRound > 1
+         self.RELAXEDuserEquilibrium(stepSizeRule, maxIterations, targetGap, targetGap2, gapFunction, gapFunction2,
+                                     demandFunction, teleworkMultiplier, warm, stepOffset if warm else 0)
+         mismatch = 0
+         observedTotal = 0
+         for od in self.ODlist:
+            mismatch += abs(od.demand - od.FIXEDdemand)
+            observedTotal += od.FIXEDdemand
+         error = mismatch / observedTotal if observedTotal > 0 else 0
+         history.append((calibrationRound, error, self.iterations))
+         if self.iterationLog is not None:
+            self.iterationLog("Calibration round %d: demand error %f after %d iterations"
+                              % (calibrationRound, error, self.iterations))
+         if error < tolerance:
+            break
+
+         for origin in self.relevant_origins:
+            ods = self.originODs[origin]
+            if name == 'targetDemandsRelaxed':
+               solvedTotal = 0
+               for od in ods:
+                  solvedTotal += od.demand
+               nonTravel = ods[0].P_r_aug - solvedTotal
+               observedNonTravel = ods[0].P_r_aug - ods[0].P_r
+               if nonTravel > 0 and observedNonTravel > 0:
+                  correction = log(observedNonTravel / nonTravel) / multiplier
+                  for od in ods:
+                     od.a_rn += correction
+            for od in ods:
+               if od.demand <= 0 or od.FIXEDdemand <= 0:
+                  continue
+               correction = log(od.FIXEDdemand / od.demand)
+               if name == 'targetDemandsRelaxed':
+                  od.a_rs += correction
+               elif name == 'targetDemandsElastic':
+                  od.a_rsE += correction
+                  augmentedDemand = od.FIXEDdemand / (1 - od.tel)
+                  nonTravel = augmentedDemand - od.demand
+                  observedNonTravel = augmentedDemand - od.FIXEDdemand
+                  if nonTravel > 0 and observedNonTravel > 0:
+                     od.a_rnE += log(observedNonTravel / nonTravel) / multiplier
+               else:
+                  od.a_rsSC += correction
+      return history
         
-            
    def beckmannFunction(self):
       """
       This method evaluates the Beckmann function at the current link
       flows.
       """
-      beckmann = 0
-      for ij in self.link:
-         beckmann += self.link[ij].calculateBeckmannComponent()
-      return beckmann
+      return self.linkPerformance.beckmann(self.currentFlows())
       
          
    def acyclicShortestPath(self, origin):
@@ -531,29 +1487,230 @@ class Network:
       
       return (backlink, cost)
       '''
-      visited = set()
+      self.refreshLinkCosts()
+      (costLabels, backlinkLabels) = self.shortestPathLabels(origin)
       backlink = dict()
       cost = dict()
       for n in self.node:
-          backlink[n] = utils.NO_PATH_EXISTS
-          cost[n] = utils.INFINITY
+          backlink[n] = (self.linkList[backlinkLabels[n]].ID if backlinkLabels[n] >= 0
+                         else utils.NO_PATH_EXISTS)
+          cost[n] = costLabels[n]
+      return (backlink, cost)
+
+   def shortestPathLabels(self, origin, linkCosts = None):
+      """
+      Label-setting (Dijkstra) shortest paths from origin using the link cost
+      snapshot in self.linkCosts (see refreshLinkCosts), or the given linkCosts
+      array (indexed by link.index) if one is passed.  Unlike shortestPath,
+      the labels are written in place into the preallocated work buffers and
+      returned as (costLabels, backlinkLabels), both indexed by node ID:
+      backlinkLabels holds the position (link.index) of the last link on the
+      shortest path, or -1 if there is none.  The nodes are also recorded in
+      the order they were settled (settledOrder[0:numSettled]), which lets
+      callers load flows onto the tree in a single reverse pass.
+
+      The buffers are overwritten by the next call, so copy them if needed.
+      """
+      cost = self.costLabels
+      backlink = self.backlinkLabels
+      order = self.settledOrder
+      cost[:] = self.blankCostLabels
+      backlink[:] = self.blankBacklinkLabels
+      if linkCosts is None:
+         linkCosts = self.linkCosts
+      linkHead = self.linkHead
+      forwardStar = self.forwardStarIndex
+      firstThroughNode = self.firstThroughNode
+
       cost[origin] = 0
-      PriorityQueue = []
+      numSettled = 0
+      PriorityQueue = self.priorityQueue
+      PriorityQueue.clear()
       heap.heappush(PriorityQueue, (0, origin))
-      
       while PriorityQueue:
-            _, n = heap.heappop(PriorityQueue)
-            visited.add(n)
-            for l in self.node[n].forwardStar:
-                if self.link[l].head in visited:	
-                    continue
-                if self.link[l].tail >= self.firstThroughNode or self.link[l].tail == origin:  
-                    if cost[self.link[l].head] > cost[n] + self.link[l].cost:
-                        backlink[self.link[l].head] = l
-                        cost[self.link[l].head] = cost[n] + self.link[l].cost
-                        heap.heappush(PriorityQueue, (cost[n] + self.link[l].cost, self.link[l].head))
-             
-      return (backlink, cost)
+         nodeCost, n = heap.heappop(PriorityQueue)
+         if nodeCost > cost[n]:
+            continue # stale queue entry, n was already settled
+         order[numSettled] = n
+         numSettled += 1
+         if n < firstThroughNode and n != origin:
+            continue
+         for l in forwardStar[n]:
+            tempCost = nodeCost + linkCosts[l]
+            j = linkHead[l]
+            if tempCost < cost[j]:
+               cost[j] = tempCost
+               backlink[j] = l
+               heap.heappush(PriorityQueue, (tempCost, j))
+      self.numSettled = numSettled
+      return (cost, backlink)
+
+   def refreshLinkCosts(self):
+      """
+      Copies the current link.cost values into the linkCosts buffer read by
+      shortestPathLabels.  Call this whenever link costs have changed.
+      """
+      linkCosts = self.linkCosts
+      for link in self.linkList:
+         linkCosts[link.index] = link.cost
+
+   def pendingTargetsFor(self, demandFunction):
+      """
+      True if targetDemandBuffer and targetFlowBuffer already hold the target
+      demands of demandFunction and their all-or-nothing flows at the current
+      link costs (left there by a convergence measure such as
+      convergence.DualityGap), so a solver step can use them instead of
+      recomputing.  The buffers are claimed: the next call returns False.
+      """
+      if self.pendingTargets is None:
+         return False
+      pending = self.pendingTargets
+      self.pendingTargets = None
+      return pending == (self.costState(), demandFunction.__name__)
+
+   def currentDemands(self):
+      """
+      Copies the current OD demands into demandBuffer (indexed by OD.index)
+      and returns it.
+      """
+      demands = self.demandBuffer
+      for od in self.ODlist:
+         demands[od.index] = od.demand
+      return demands
+
+   def currentFlows(self):
+      """
+      Copies the current link flows into flowBuffer (indexed by link.index)
+      and returns it.
+      """
+      flows = self.flowBuffer
+      for link in self.linkList:
+         flows[link.index] = link.flow
+      return flows
+
+   def setLinkFunction(self, function, linkTypes = None, **parameters):
+      """
+      Sets the link performance function (see linkfunctions.py): function is
+      a LinkFunction or the name of a registered one ('bpr', 'conical',
+      'akcelik', 'piecewise'), created with the given parameters, e.g.
+         network.setLinkFunction('akcelik', linkTypes = [3, 4], delayParameter = 0.8)
+      With linkTypes, only links whose linkType (the tenth column of the
+      network file) is one of them use it; otherwise it becomes the default
+      of all links without a function for their type.  Link costs are
+      recomputed at the current flows.
+      """
+      function = makeLinkFunction(function, **parameters)
+      if linkTypes is None:
+         self.defaultLinkFunction = function
+      else:
+         for linkType in linkTypes:
+            self.linkFunctions[str(linkType)] = function
+      self.assignLinkFunctions()
+      if len(self.linkList) > 0:
+         for link in self.linkList:
+            if hasattr(link, 'flow'):
+               link.updateCost()
+         self.refreshLinkCosts()
+      self.pendingTargets = None
+
+   def assignLinkFunctions(self):
+      """
+      Sets each link's function attribute from linkFunctions (by link type)
+      and defaultLinkFunction, and rebuilds linkPerformance.
+      """
+      for link in self.link.values():
+         link.function = self.linkFunctions.get(str(link.linkType), self.defaultLinkFunction)
+      if len(self.linkList) > 0:
+         self.linkPerformance = LinkPerformance(self)
+
+   def refreshLinkParameters(self):
+      """
+      Updates linkPerformance after link capacities, free-flow times,
+      alpha, beta, tolls or lengths, or the toll and distance factors, have
+      been changed.  reset and warmStart call it.
+      """
+      if self.linkPerformance is not None:
+         self.linkPerformance.refresh()
+
+   def buildWorkBuffers(self):
+      """
+      Assigns positions to links and OD pairs and preallocates the work
+      buffers used by the solvers (see the class docstring).  Called by
+      finalize; call it again if links or OD pairs are added later.
+      """
+      self.linkList = list()
+      for ij in self.link:
+         self.link[ij].ID = ij
+         self.link[ij].index = len(self.linkList)
+         self.linkList.append(self.link[ij])
+      self.ODlist = list()
+      self.originODs = dict()
+      for OD in sorted(self.ODpair, key=lambda OD : self.ODpair[OD].origin):
+         self.ODpair[OD].ID = OD
+         self.ODpair[OD].index = len(self.ODlist)
+         self.ODlist.append(self.ODpair[OD])
+         self.originODs.setdefault(self.ODpair[OD].origin, list()).append(self.ODpair[OD])
+
+      maxNode = max(self.node) if len(self.node) > 0 else 0
+      self.linkTail = array('i', [link.tail for link in self.linkList])
+      self.linkHead = array('i', [link.head for link in self.linkList])
+      self.forwardStarIndex = [list() for i in range(maxNode + 1)]
+      for link in self.linkList:
+         self.forwardStarIndex[link.tail].append(link.index)
+
+      self.linkCosts = array('d', [0.0]) * len(self.linkList)
+      self.refreshLinkCosts()
+      self.blankCostLabels = array('d', [utils.INFINITY]) * (maxNode + 1)
+      self.blankBacklinkLabels = array('i', [-1]) * (maxNode + 1)
+      self.costLabels = array('d', self.blankCostLabels)
+      self.backlinkLabels = array('i', self.blankBacklinkLabels)
+      self.settledOrder = array('i', [0]) * (maxNode + 1)
+      self.numSettled = 0
+      self.nodeLoads = array('d', [0.0]) * (maxNode + 1)
+      self.priorityQueue = list()
+
+      self.blankLinkBuffer = array('d', [0.0]) * len(self.linkList)
+      self.targetFlowBuffer = array('d', self.blankLinkBuffer)
+      self.flowBuffer = array('d', self.blankLinkBuffer)
+      self.trialFlowBuffer = array('d', self.blankLinkBuffer)
+      self.trialCostBuffer = array('d', self.blankLinkBuffer)
+      self.flowChangeBuffer = array('d', self.blankLinkBuffer)
+      self.assignLinkFunctions()
+      self.buildODBuffers()
+
+   def buildODBuffers(self):
+      """
+      Allocates the OD-sized work buffers, with typecode storageType.
+      """
+      self.targetDemandBuffer = array(self.storageType, [0.0]) * len(self.ODlist)
+      self.demandBuffer = array(self.storageType, [0.0]) * len(self.ODlist)
+      self.trialDemandBuffer = array(self.storageType, [0.0]) * len(self.ODlist)
+      self.weightBuffer = array(self.storageType, [0.0]) * len(self.ODlist)
+      self.pendingTargets = None
+
+   def setPrecision(self, precision):
+      """
+      Chooses the storage precision of the large OD- and zone-sized arrays:
+      'double' (the default) or 'single', which stores them as 32-bit floats
+      and halves their memory.  It applies to the OD work buffers (target
+      demands, demand logit weights, demand snapshots), and to the arrays
+      sized from this network afterwards: ScenarioBatch shifted attribute
+      columns, demands and targets, the columns a Scenario modifies, UserClass
+      buffers and skim files written by writeSkims.
+
+      Only storage is rounded.  Link flows and costs, shortest path labels,
+      the OD objects, the base attribute columns of ScenarioBase and
+      ScenarioBatch (from which applying or restoring writes the OD objects
+      back) and every accumulation (TSTT, SPTT, TMF, the logit
+      denominators, the Beckmann and demand objectives) stay in double
+      precision, so single precision perturbs the target demands by about
+      1e-7 relative, well below the gaps the solvers are run to.
+      """
+      if precision not in PRECISIONS:
+         raise BadNetworkOperationException("Unknown precision %s; use one of %s" % (precision, ", ".join(PRECISIONS)))
+      self.storageType = PRECISIONS[precision]
+      if len(self.ODlist) > 0:
+         self.buildODBuffers()
     
    def allOrNothingDemand(self, targetDemands):
       """
@@ -562,73 +1719,62 @@ class Network:
          1. Find shortest paths from all origins to all destinations
          2. For each OD pairs in the network, load its demand onto the shortest
             path found above.  (Ties can be broken arbitrarily.)
-      The resulting link flows should be returned in the allOrNothing dict, whose
-      keys are the link IDs.
+      The resulting link flows are returned in targetFlowBuffer, indexed by
+      link.index; targetDemands is indexed by OD.index.
 
-      Be aware that the network files are in the TNTP format, where nodes are numbered
-      starting at 1, whereas Python starts numbering at 0.  
-            
-      Your code will not be scored based on efficiency, but you should think about
-      different ways of finding an all-or-nothing loading, and how this might
-      best be done.
+      Demand is loaded onto each origin's shortest path tree in one pass over
+      the nodes in reverse settled order: every node passes its accumulated
+      load to its backlink and on to the tail of that link.
       """
-      allOrNothing = dict()
+      self.refreshLinkCosts()
+      allOrNothing = self.targetFlowBuffer
+      allOrNothing[:] = self.blankLinkBuffer
       self.SPTT = 0
-      for ij in self.link:
-         allOrNothing[ij] = 0
          
       for origin in self.relevant_origins:
-         (backlink, cost) = self.shortestPath(origin)
-         for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-            curnode = self.ODpair[OD].destination
-            self.SPTT += targetDemands[OD]*cost[curnode]
-            while curnode != self.ODpair[OD].origin:
-               if backlink[curnode] == utils.NO_PATH_EXISTS:
-                    print(f"No path found for OD pair {OD}, current node: {curnode}")
-                    break
-               if backlink[curnode] not in allOrNothing:
-                    print(f"Invalid backlink {backlink[curnode]} for node {curnode} in OD pair {OD}")
-                    break
-               #print(curnode)
-               #print(OD)
-               #print(backlink[curnode])
-               #print(allOrNothing[backlink[curnode]])
-               #print(targetDemands[OD])
-               allOrNothing[backlink[curnode]] += targetDemands[OD]
-               curnode = self.link[backlink[curnode]].tail
+         self.shortestPathLabels(origin)
+         self.SPTT += self.loadOriginTree(origin, targetDemands, allOrNothing)
+         if self.originFlows is not None:
+            self.originFlows.recordTree(origin, targetDemands)
       return allOrNothing
+
+   def loadOriginTree(self, origin, targetDemands, flows, ods = None):
+      """
+      Adds the demand of origin's OD pairs (targetDemands, indexed by OD.index)
+      to flows (indexed by link.index) along the shortest path tree held in the
+      label buffers, which must come from shortestPathLabels(origin).  Returns
+      the shortest path travel time of this demand.  ods replaces the
+      network's OD pairs of origin, e.g. with those of a user class.
+      """
+      cost = self.costLabels
+      backlink = self.backlinkLabels
+      loads = self.nodeLoads
+      linkTail = self.linkTail
+      order = self.settledOrder
+      SPTT = 0
+      for od in (self.originODs[origin] if ods is None else ods):
+         SPTT += targetDemands[od.index]*cost[od.destination]
+         if backlink[od.destination] < 0:
+            print(f"No path found for OD pair {od.ID}")
+            continue
+         loads[od.destination] += targetDemands[od.index]
+      for position in range(self.numSettled - 1, 0, -1):
+         n = order[position]
+         if loads[n] != 0:
+            l = backlink[n]
+            flows[l] += loads[n]
+            loads[linkTail[l]] += loads[n]
+            loads[n] = 0
+      loads[origin] = 0
+      return SPTT
     
    def allOrNothing(self):
       """
-      This method generates an all-or-nothing assignment using the current link
-      cost values.  It must do the following:
-         1. Find shortest paths from all origins to all destinations
-         2. For each OD pairs in the network, load its demand onto the shortest
-            path found above.  (Ties can be broken arbitrarily.)
-      The resulting link flows should be returned in the allOrNothing dict, whose
-      keys are the link IDs.
-
-      Be aware that the network files are in the TNTP format, where nodes are numbered
-      starting at 1, whereas Python starts numbering at 0.  
-            
-      Your code will not be scored based on efficiency, but you should think about
-      different ways of finding an all-or-nothing loading, and how this might
-      best be done.
+      All-or-nothing assignment of the current OD demands (OD.demand) using the
+      current link cost values; see allOrNothingDemand.  The resulting link
+      flows are returned in targetFlowBuffer, indexed by link.index.
       """
-      allOrNothing = dict()
-      self.SPTT = 0
-      for ij in self.link:
-         allOrNothing[ij] = 0
-         
-      for origin in self.relevant_origins:
-         (backlink, cost) = self.shortestPath(origin)
-         for OD in [OD for OD in self.ODpair if self.ODpair[OD].origin == origin]:
-            curnode = self.ODpair[OD].destination
-            self.SPTT += self.ODpair[OD].demand*cost[curnode]
-            while curnode != self.ODpair[OD].origin:
-               allOrNothing[backlink[curnode]] += self.ODpair[OD].demand
-               curnode = self.link[backlink[curnode]].tail
-      return allOrNothing
+      return self.allOrNothingDemand(self.currentDemands())
     
    def findLeastEnteringLinks(self):
       """
@@ -753,6 +1899,17 @@ class Network:
       self.validate()
       self.finalize()
       
+   def openInput(self, fileName):
+      """
+      Opens an input file for reading; if it was read ahead by
+      self.inputPrefetch (see pipeline.py), its text is served from memory.
+      """
+      if self.inputPrefetch is not None:
+         text = self.inputPrefetch.take(fileName)
+         if text is not None:
+            return io.StringIO(text)
+      return open(fileName, "r")
+
    def readNetworkFile(self, networkFileName):
       """
       Reads network topology data from the TNTP data format.  In keeping with
@@ -760,7 +1917,7 @@ class Network:
       IDs (1, 2, ..., numZones).
       """
       try:
-         with open(networkFileName, "r") as networkFile:
+         with self.openInput(networkFileName) as networkFile:
             fileLines = networkFile.read().splitlines()
             
             # Set default parameters for metadata, then read
@@ -829,7 +1986,7 @@ class Network:
       Reads demand (OD matrix) data from a file in the TNTP format.
       """
       try:
-         with open(demandFileName, "r") as demandFile:
+         with self.openInput(demandFileName) as demandFile:
             fileLines = demandFile.read().splitlines()
             self.totalDemand = 0
 
@@ -968,6 +2125,8 @@ class Network:
           self.relevant_origins.add(self.ODpair[OD].origin)
           self.relevant_destinations.add(self.ODpair[OD].destination)
 
+      self.buildWorkBuffers()
+
       print(f"Network has {len(self.relevant_origins)} relevant origins and {len(self.relevant_destinations)} relevant destinations")
 
    def printODFile(self, fileName):
@@ -985,99 +2144,14 @@ class Network:
                 f.write(f"{od.origin},{origin_node.x},{origin_node.y},{origin_node.geoid},{od.destination},{dest_node.x},{dest_node.y},{dest_node.geoid},{od.FIXEDdemand:.6f},{od.k_rs:.6f},{od.P_r:.6f},{od.P_r_aug:.6f},{od.tel:.6f},{od.a_rs:.6f},{od.a_rn:.6f},{od.a_rsE:.6f},{od.a_rnE:.6f},{od.a_rsSC:.6f}\n")
         print(f"OD data written to {fileName}")
 
+   @instrumented("printResults")
    def printResults(self, ODFilename, Linksfilename, OriginFilename, DestinationFilename, AggregateResults):
         """
-        Prints OD pair data to a text file.
-        Format: origin,destination,a_rs,P_r,k_rs
+        Prints OD pair, link, origin, destination and network-wide results of
+        the current solution to text files; see AssignmentResult.writeFiles.
         """
-        with open(ODFilename, 'w') as f:
-            f.write("origin,origin_x,origin_y,origin_geoid,destination,dest_x,dest_y,dest_geoid,Demand,TravelTime\n")  # Header
-            #f.write("origin,destination,demand\n")  # Header
-            for OD in self.ODpair:
-                od = self.ODpair[OD]
-                origin_node = self.node[od.origin]
-                dest_node = self.node[od.destination]
-                f.write(f"{od.origin},{origin_node.x},{origin_node.y},{origin_node.geoid},{od.destination},{dest_node.x},{dest_node.y},{dest_node.geoid},{od.demand:.6f},{od.k_rs:.6f}\n")
-                #f.write(f"{od.origin},{od.destination},{od.demand:.6f}\n")
-        print(f"OD results written to {ODFilename}")
-        
-        with open(Linksfilename, 'w') as f:
-            f.write("Tail,Tail_x,Tail_y,Tail_geoid,Head,Head_x,Head_y,Head_geoid,Flow,Cost\n")  # Header
-            #f.write("Tail,Head,Flow,Cost\n")  # Header
-            for l in self.link:
-                link = self.link[l]
-                tail_node = self.node[link.tail]
-                head_node = self.node[link.head]
-                f.write(f"{link.tail},{tail_node.x},{tail_node.y},{tail_node.geoid},{link.head},{head_node.x},{head_node.y},{head_node.geoid},{link.flow:.6f},{link.cost:.6f}\n")
-                #f.write(f"{link.tail},{link.head},{link.flow:.6f},{link.cost:.6f}\n")
-        print(f"Flow results written to {Linksfilename}")
-        
-        with open(OriginFilename, 'w') as f:
-            f.write("Origin,Origin_x,Origin_y,Origin_geoid,P_r_aug,Total_Demand,Demand_Not_Traveling,Total_Travel_Time,Average_Travel_Time\n")  # Header
-            
-            for origin in self.relevant_origins:
-                origin_node = self.node[origin]
-                origin_ods = [od for od in self.ODpair.values() if od.origin == origin]
-                
-                P_r_aug = origin_ods[0].P_r_aug
-                total_demand = sum(od.demand for od in origin_ods)
-                demand_not_traveling = P_r_aug - total_demand
-                
-                total_travel_time = sum(od.demand * od.k_rs for od in origin_ods)
-                average_travel_time = total_travel_time / total_demand if total_demand > 0 else 0
-                
-                f.write(f"{origin},{origin_node.x},{origin_node.y},{origin_node.geoid},{P_r_aug:.6f},{total_demand:.6f},{demand_not_traveling:.6f},{total_travel_time:.6f},{average_travel_time:.6f}\n")
-        print(f"Aggregated origin results written to {OriginFilename}")
-        
-        with open(DestinationFilename, 'w') as f:
-            f.write("Origin,Origin_x,Origin_y,Origin_geoid,P_r_aug,Total_Demand,Demand_Not_Traveling,Total_Travel_Time,Average_Travel_Time\n")  # Header
-            
-            for dest in self.relevant_destinations:
-                dest_node = self.node[dest]
-                dest_ods = [od for od in self.ODpair.values() if od.destination == dest]
-                
-                total_demand = sum(od.demand for od in dest_ods)
-                total_travel_time = sum(od.demand * od.k_rs for od in dest_ods)
-                average_travel_time = total_travel_time / total_demand if total_demand > 0 else 0
-                
-                f.write(f"{dest},{dest_node.x},{dest_node.y},{dest_node.geoid},{total_demand:.6f},{total_travel_time:.6f},{average_travel_time:.6f}\n")
-        print(f"Aggregated origin results written to {DestinationFilename}")
-        
-        
-        # Network-wide metrics
-        total_possible_demand = 0
-        for origin in self.relevant_origins:
-                origin_node = self.node[origin]
-                origin_ods = [od for od in self.ODpair.values() if od.origin == origin]
-                total_possible_demand += origin_ods[0].P_r_aug
-        
-        realized_demand = sum(od.demand for od in self.ODpair.values())
-        demand_not_traveling = total_possible_demand - realized_demand
-        average_travel_time = self.TSTT / realized_demand if realized_demand > 0 else 0
-        
-        # Calculate relative gap and average excess cost
-        relative_gap = self.relativeGap()
-        average_excess_cost = self.averageExcessCost()
-    
-        # Calculate network-wide average trip length
-        total_distance = sum(link.flow * link.length for link in self.link.values())
-        average_trip_length = total_distance / realized_demand if realized_demand > 0 else 0
-        
-        with open(AggregateResults, 'w') as f:
-            f.write("Metric,Value\n")  # Header
-            f.write(f"TSTT,{self.TSTT:.6f}\n")
-            f.write(f"Total_Possible_Demand,{total_possible_demand:.6f}\n")
-            f.write(f"Realized_Demand,{realized_demand:.6f}\n")
-            f.write(f"Demand_Not_Traveling,{demand_not_traveling:.6f}\n")
-            f.write(f"Average_Travel_Time,{average_travel_time:.6f}\n")
-            f.write(f"AEC,{average_excess_cost:.6f}\n")
-            f.write(f"TMF,{self.TMF:.6f}\n")
-            f.write(f"Relative_Gap,{relative_gap:.6f}\n")
-            f.write(f"Average_Trip_Length,{average_trip_length:.6f}\n")
-            f.write(f"Total_distance_traveled,{total_distance:.6f}\n")
-        
-        print(f"Network-wide metrics written to {AggregateResults}")
-    
+        AssignmentResult(self).writeFiles(ODFilename, Linksfilename, OriginFilename, DestinationFilename,
+                                          AggregateResults, print)
 
    def readODFile(self, fileName):
         """
@@ -1085,7 +2159,7 @@ class Network:
         Expected format: origin,destination,a_rs,P_r,k_rs
         """
         try:
-            with open(fileName, 'r') as f:
+            with self.openInput(fileName) as f:
                 next(f)  # Skip header
                 for line in f:
                     origin, originX, originY, originGEOID, destination, destinationX, destinationY, destinationGEOID, FIXEDdemand, k_rs, P_r, P_r_aug, tel, a_rs, a_rn, a_rsE, a_rnE, a_rsSC = line.strip().split(',')
@@ -1116,7 +2190,10 @@ class Network:
         Expected file format: node_id,x,y,tel,geoid
         """
         try:
-            with open(fileName, 'r') as f:
+            originODs = dict()
+            for OD in self.ODpair:
+                originODs.setdefault(self.ODpair[OD].origin, list()).append(self.ODpair[OD])
+            with self.openInput(fileName) as f:
                 next(f)  # Skip header if present
                 for line in f:
                     node_id, x, y, tel, geoid = line.strip().split()
@@ -1128,9 +2205,8 @@ class Network:
                         self.node[node_id].geoid = int(geoid)
                         
                         # Assign tel as a_rn to OD pairs where this node is the origin
-                        for OD in self.ODpair:
-                            if self.ODpair[OD].origin == node_id:
-                                self.ODpair[OD].tel = max(float(tel),0.01)
+                        for od in originODs.get(node_id, ()):
+                            od.tel = max(float(tel),0.01)
                     else:
                         print(f"Warning: Node {node_id} not found in network")
             
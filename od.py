@@ -14,4 +14,7 @@ class OD:
       self.P_r = 0.0
       self.P_r_aug = 0.0
       self.k_rs = 0.0
-      self.tel = 0.0
\ No newline at end of file
+      self.tel = 0.0
+
+      self.ID = None # set by Network.buildWorkBuffers, along with the position
+      self.index = None # of the OD pair in Network.ODlist
\ No newline at end of file
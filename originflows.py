@@ -0,0 +1,151 @@
+from array import array
+
+import operator
+
+RESCALE_THRESHOLD = 1e-100 # renormalize an origin's flows when its scale gets this small
+
+class OriginFlows:
+   """
+   Link flows broken down by origin, x_o, with x = sum over origins of x_o.
+   Tracking is switched on with Network.trackOriginFlows, after which the
+   solvers keep these flows in step with the total link flows; they are what
+   lets incremental.py re-equilibrate one origin at a time.
+
+   Each origin's flows are stored as scale[o] * flows[o][link.index].  A solver
+   step x_o <- (1 - stepSize) x_o + stepSize y_o only touches scale[o] and the
+   links of the all-or-nothing tree y_o (recorded by recordTree), so tracking
+   costs a pass over each tree rather than over every link for every origin.
+   """
+
+   def __init__(self, network):
+      self.network = network
+      numLinks = len(network.linkList)
+      self.blankFlows = array('d', [0.0]) * numLinks
+      self.flows = dict()
+      self.scale = dict()
+      self.treeLinks = dict()
+      self.treeLoads = dict()
+      for origin in network.relevant_origins:
+         self.flows[origin] = array('d', self.blankFlows)
+         self.scale[origin] = 1.0
+         self.treeLinks[origin] = array('i')
+         self.treeLoads[origin] = array('d')
+
+   def clear(self):
+      for origin in self.flows:
+         self.flows[origin][:] = self.blankFlows
+         self.scale[origin] = 1.0
+         del self.treeLinks[origin][:]
+         del self.treeLoads[origin][:]
+
+   def snapshot(self):
+      """
+      Copy of the tracked flows, for restore().
+      """
+      return dict((origin, (array('d', self.flows[origin]), self.scale[origin])) for origin in self.flows)
+
+   def restore(self, snapshot):
+      for origin, (flows, scale) in snapshot.items():
+         self.flows[origin][:] = flows
+         self.scale[origin] = scale
+
+   def recordTree(self, origin, targetDemands):
+      """
+      Records the all-or-nothing loading y_o of origin's target demands
+      (indexed by OD.index) on the shortest path tree currently held in the
+      network's label buffers, as (link.index, load) pairs.  Called by
+      Network.allOrNothingDemand right after loadOriginTree.
+      """
+      network = self.network
+      backlink = network.backlinkLabels
+      loads = network.nodeLoads
+      linkTail = network.linkTail
+      order = network.settledOrder
+      links = self.treeLinks[origin]
+      treeLoads = self.treeLoads[origin]
+      del links[:]
+      del treeLoads[:]
+      for od in network.originODs[origin]:
+         if backlink[od.destination] >= 0:
+            loads[od.destination] += targetDemands[od.index]
+      for position in range(network.numSettled - 1, 0, -1):
+         n = order[position]
+         if loads[n] != 0:
+            l = backlink[n]
+            links.append(l)
+            treeLoads.append(loads[n])
+            loads[linkTail[l]] += loads[n]
+            loads[n] = 0
+      loads[origin] = 0
+
+   def shift(self, stepSize, origins = None):
+      """
+      Moves the flows of each origin (all of them by default) stepSize of the
+      way towards its recorded tree, matching the shift of the total link
+      flows made by the solver.
+      """
+      for origin in (origins if origins is not None else self.flows):
+         flows = self.flows[origin]
+         if stepSize >= 1:
+            flows[:] = self.blankFlows
+            self.scale[origin] = 1.0
+         else:
+            self.scale[origin] *= 1 - stepSize
+            if self.scale[origin] < RESCALE_THRESHOLD:
+               self.rescale(origin)
+         weight = stepSize / self.scale[origin]
+         for l, load in zip(self.treeLinks[origin], self.treeLoads[origin]):
+            flows[l] += weight * load
+
+   def rescale(self, origin):
+      flows = self.flows[origin]
+      scale = self.scale[origin]
+      for l in range(len(flows)):
+         flows[l] *= scale
+      self.scale[origin] = 1.0
+
+   def originFlows(self, origin):
+      """
+      The actual link flows of origin, as a new array indexed by link.index.
+      """
+      scale = self.scale[origin]
+      return array('d', [scale * flow for flow in self.flows[origin]])
+
+   def originCost(self, origin, linkCosts):
+      """
+      Total cost of origin's flows at the given link costs, sum_l x_ol c_l.
+      """
+      return self.scale[origin] * sum(map(operator.mul, self.flows[origin], linkCosts))
+
+   def usesLink(self, origin, linkIndex):
+      return self.flows[origin][linkIndex] > 0
+
+   def shiftOrigin(self, origin, targetDemands, stepSize):
+      """
+      Gauss-Seidel step for a single origin: moves its flows stepSize of the
+      way to the tree recorded by recordTree, and its OD demands towards
+      targetDemands, updating the total link flows, link costs and the
+      network's linkCosts buffer to match.  Unlike the solvers' shift, every
+      link carrying flow from this origin is visited.
+      """
+      network = self.network
+      linkList = network.linkList
+      linkCosts = network.linkCosts
+      flows = self.flows[origin]
+      scale = self.scale[origin]
+      change = dict()
+      for l in range(len(flows)):
+         if flows[l] != 0:
+            change[l] = -stepSize * scale * flows[l]
+      for l, load in zip(self.treeLinks[origin], self.treeLoads[origin]):
+         change[l] = change.get(l, 0) + stepSize * load
+      for l, delta in change.items():
+         link = linkList[l]
+         link.flow += delta
+         if link.flow < 0:
+            link.flow = 0 # roundoff
+         link.updateCost()
+         linkCosts[l] = link.cost
+      self.shift(stepSize, (origin,))
+      for od in network.originODs[origin]:
+         od.demand = (1 - stepSize) * od.demand + stepSize * targetDemands[od.index]
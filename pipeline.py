@@ -0,0 +1,151 @@
+from network import Network, BadNetworkOperationException
+
+import concurrent.futures
+import os
+import threading
+
+class InputPrefetcher:
+   """
+   Reads a set of input files on background threads, so that the disk reads
+   of the later files overlap the parsing of the earlier ones.  Set as a
+   Network's inputPrefetch, it serves the texts to the file readers (see
+   Network.openInput) in place of opening the files; each text is handed
+   out once and then released.  A read error (e.g. a missing file) is raised
+   when the text is taken, where the reader would have raised it.
+   """
+
+   def __init__(self, fileNames, workers = 4):
+      fileNames = [fileName for fileName in fileNames if fileName]
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = max(1, min(workers, len(fileNames))))
+      self.pending = dict()
+      for fileName in fileNames:
+         self.pending[os.path.abspath(fileName)] = self.executor.submit(InputPrefetcher.read, fileName)
+
+   @staticmethod
+   def read(fileName):
+      with open(fileName, "r") as f:
+         return f.read()
+
+   def take(self, fileName):
+      """
+      The text of fileName, or None if it is not prefetched.
+      """
+      future = self.pending.pop(os.path.abspath(fileName), None)
+      if future is None:
+         return None
+      return future.result()
+
+   def close(self):
+      for future in self.pending.values():
+         future.cancel()
+      self.pending = dict()
+      self.executor.shutdown(wait = True)
+
+def loadNetwork(networkFile, demandFile, nodeFile = None, attributeFile = None, workers = 4):
+   """
+   Equivalent of Network(networkFile, demandFile) followed by
+   readNodeFile(nodeFile) and readODFile(attributeFile) (when given), with
+   all four files read from disk concurrently while the network and demand
+   files are parsed.  The parsing itself stays in order, as each reader
+   updates the objects created by the previous ones.
+   """
+   network = Network()
+   network.name = os.path.splitext(os.path.basename(networkFile))[0]
+   network.inputPrefetch = InputPrefetcher((networkFile, demandFile, nodeFile, attributeFile), workers)
+   try:
+      network.readFromFiles(networkFile, demandFile)
+      if nodeFile:
+         network.readNodeFile(nodeFile)
+      if attributeFile:
+         network.readODFile(attributeFile)
+   finally:
+      network.inputPrefetch.close()
+      network.inputPrefetch = None
+   return network
+
+def writeResult(result, fileNames):
+   result.writeFiles(*fileNames)
+   return fileNames
+
+class ResultWriter:
+   """
+   Writes AssignmentResults (see results.py) to the printResults files in
+   the background, so the next solve can start while the previous one's
+   files are formatted and written:
+      with ResultWriter(maxPending = 2) as writer:
+         for scenario in scenarios:
+            with scenario.applied(net):
+               writer.submit(net.solve(...), "od.txt", "links.txt", ...)
+   submit blocks while maxPending results are queued or being written,
+   which caps the memory held by results waiting for the disk.  Results are
+   written one at a time in submission order, by a thread or, with
+   useProcess, by a separate process (which also takes the text formatting
+   off the solver's interpreter, at the cost of pickling each result).  The
+   first write error is raised by the next submit or by close; close (or
+   leaving the with block) waits until everything is written.
+   """
+
+   def __init__(self, maxPending = 2, useProcess = False, log = print):
+      if maxPending < 1:
+         raise BadNetworkOperationException("A ResultWriter needs room for at least one pending result")
+      if useProcess:
+         self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = 1)
+      else:
+         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+      self.slots = threading.BoundedSemaphore(maxPending)
+      self.log = log
+      self.lock = threading.Lock()
+      self.error = None
+      self.written = 0
+
+   def submit(self, result, ODFilename, Linksfilename, OriginFilename, DestinationFilename, AggregateResults):
+      """
+      Queues result for writing to the five files, in the argument order
+      of Network.printResults.
+      """
+      self.raiseError()
+      self.slots.acquire()
+      fileNames = (ODFilename, Linksfilename, OriginFilename, DestinationFilename, AggregateResults)
+      try:
+         future = self.executor.submit(writeResult, result, fileNames)
+      except BaseException:
+         self.slots.release()
+         raise
+      future.add_done_callback(self.finished)
+
+   def finished(self, future):
+      try:
+         fileNames = future.result()
+         with self.lock:
+            self.written += 1
+         if self.log is not None:
+            self.log("Results written to %s" % ", ".join(fileNames))
+      except BaseException as error:
+         with self.lock:
+            if self.error is None:
+               self.error = error
+      finally:
+         self.slots.release()
+
+   def raiseError(self):
+      with self.lock:
+         error = self.error
+         self.error = None
+      if error is not None:
+         raise error
+
+   def close(self):
+      """
+      Waits for the queued results to be written and stops the writer.
+      """
+      self.executor.shutdown(wait = True)
+      self.raiseError()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, excType, excValue, traceback):
+      if excType is None:
+         self.close()
+      else:
+         self.executor.shutdown(wait = True)
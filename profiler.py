@@ -0,0 +1,269 @@
+import cProfile
+import functools
+import os
+import pstats
+import signal
+import time
+
+SAMPLING_INTERVAL = 0.005 # seconds of CPU time between stack samples
+MAX_COLLAPSED_DEPTH = 64
+
+class Profiler:
+   """
+   Profiling hooks for the solver entry points of a Network (userEquilibrium,
+   RELAXEDuserEquilibrium, calcAttractiveness, printResults).  A Profiler is
+   attached with Network.enableProfiling; when no profiler is attached the
+   network runs exactly as before.
+
+   Two levels are available:
+      sampling (default) -- the call stack is sampled every SAMPLING_INTERVAL
+                            seconds of CPU time, which costs almost nothing and
+                            is enough for a flame graph.  Sampling relies on
+                            signal.setitimer, so on platforms without it only
+                            the wall-clock timings are recorded.
+      deep               -- every function call is traced with cProfile.  This
+                            gives exact call counts and a pstats dump, but slows
+                            the run down considerably, so it is off by default.
+
+   For the iterative solvers only iterations firstIteration..lastIteration
+   (inclusive, lastIteration = None meaning "until the end") are profiled;
+   calcAttractiveness and printResults are profiled in full.  When a profiled
+   section finishes, the following files are written using outputPrefix and
+   tagged with the network and scenario names:
+      <prefix>.collapsed -- collapsed stacks ("f1;f2;f3 count" lines), ready
+                            for flamegraph.pl or speedscope
+      <prefix>.pstats    -- cProfile statistics (deep mode only)
+      <prefix>.txt       -- timing and top-N hot function summary, which is
+                            also printed
+   """
+
+   def __init__(self, networkName = "", scenario = "", firstIteration = 1, lastIteration = None,
+                topN = 20, outputPrefix = "profile", deep = False):
+      self.networkName = networkName
+      self.scenario = scenario
+      self.firstIteration = firstIteration
+      self.lastIteration = lastIteration
+      self.topN = topN
+      self.outputPrefix = outputPrefix
+      self.deep = deep
+
+      self.section = None
+      self.active = False
+      self.sectionTimes = list()
+      self.iterationTimes = dict()
+
+   def tag(self):
+      """
+      Returns the network/scenario tag used in file names and summaries.
+      """
+      parts = [part for part in (self.networkName, self.scenario) if len(part) > 0]
+      return "_".join(parts) if len(parts) > 0 else "network"
+
+   def enter(self, section, iterative = False):
+      """
+      Called when a profiled entry point starts.  Non-iterative sections are
+      profiled in full; iterative ones wait for iteration() to open the window.
+      """
+      self.section = section
+      self.sectionStart = time.time()
+      self.iterationStart = None
+      self.samples = dict()
+      self.cProfile = cProfile.Profile() if self.deep else None
+      self.profiledIterations = 0
+      if not iterative:
+         self.start()
+
+   def iteration(self, iteration):
+      """
+      Called at the top of every solver iteration to open and close the
+      profiling window.
+      """
+      now = time.time()
+      if self.iterationStart is not None:
+         self.iterationTimes.setdefault(self.section, list()).append(now - self.iterationStart)
+      self.iterationStart = now
+      inWindow = (iteration >= self.firstIteration
+                  and (self.lastIteration is None or iteration <= self.lastIteration))
+      if inWindow and not self.active:
+         self.start()
+      elif not inWindow and self.active:
+         self.stop()
+      if inWindow:
+         self.profiledIterations += 1
+
+   def exit(self, extraReport = ""):
+      """
+      Called when a profiled entry point returns; closes the window and writes
+      the reports for this section.  extraReport is appended to the summary.
+      """
+      if self.section is None:
+         return
+      if self.iterationStart is not None:
+         self.iterationTimes.setdefault(self.section, list()).append(time.time() - self.iterationStart)
+      self.stop()
+      self.sectionTimes.append((self.section, time.time() - self.sectionStart))
+      self.report(extraReport)
+      self.section = None
+
+   def start(self):
+      self.active = True
+      if self.cProfile is not None:
+         self.cProfile.enable()
+      elif hasattr(signal, "setitimer"):
+         self.previousHandler = signal.signal(signal.SIGPROF, self.sample)
+         signal.setitimer(signal.ITIMER_PROF, SAMPLING_INTERVAL, SAMPLING_INTERVAL)
+
+   def stop(self):
+      if not self.active:
+         return
+      self.active = False
+      if self.cProfile is not None:
+         self.cProfile.disable()
+      elif hasattr(signal, "setitimer"):
+         signal.setitimer(signal.ITIMER_PROF, 0, 0)
+         signal.signal(signal.SIGPROF, self.previousHandler)
+
+   def sample(self, signum, frame):
+      """
+      SIGPROF handler: records the current call stack, outermost frame first.
+      """
+      stack = list()
+      while frame is not None:
+         stack.append(frameLabel(frame.f_code.co_filename, frame.f_code.co_name))
+         frame = frame.f_back
+      stack = tuple(reversed(stack))
+      self.samples[stack] = self.samples.get(stack, 0) + 1
+
+   def deepStats(self):
+      """
+      Returns the cProfile statistics dictionary, which is empty if the
+      profiling window never opened.
+      """
+      try:
+         return pstats.Stats(self.cProfile).stats
+      except TypeError:
+         return dict()
+
+   def collapsedStacks(self):
+      """
+      Returns a dictionary mapping collapsed stack strings to counts.  In
+      sampling mode counts are samples; in deep mode stacks are rebuilt from
+      the cProfile caller graph and counts are microseconds of self time.
+      """
+      collapsed = dict()
+      if self.cProfile is None:
+         for stack, count in self.samples.items():
+            key = ";".join(stack)
+            collapsed[key] = collapsed.get(key, 0) + count
+         return collapsed
+
+      stats = self.deepStats()
+      callees = dict()
+      for function, (cc, nc, tt, ct, callers) in stats.items():
+         for caller, edge in callers.items():
+            callees.setdefault(caller, list()).append((function, edge[3]))
+      roots = [function for function in stats if len(stats[function][4]) == 0]
+
+      def walk(function, stack, share):
+         label = frameLabel(function[0], function[2])
+         stack = stack + (label,)
+         selfTime = int(stats[function][2] * share * 1e6)
+         if selfTime > 0:
+            key = ";".join(stack)
+            collapsed[key] = collapsed.get(key, 0) + selfTime
+         if len(stack) >= MAX_COLLAPSED_DEPTH:
+            return
+         for callee, edgeTime in callees.get(function, list()):
+            calleeTime = stats[callee][3]
+            if calleeTime <= 0 or frameLabel(callee[0], callee[2]) in stack:
+               continue
+            walk(callee, stack, share * min(edgeTime / calleeTime, 1))
+
+      for root in roots:
+         walk(root, (self.section,), 1.0)
+      return collapsed
+
+   def hotFunctions(self):
+      """
+      Returns a list of (function, self, cumulative) tuples, hottest first.
+      Units are seconds in deep mode and samples in sampling mode.
+      """
+      hot = list()
+      if self.cProfile is not None:
+         stats = self.deepStats()
+         for function, (cc, nc, tt, ct, callers) in stats.items():
+            hot.append((frameLabel(function[0], function[2]), tt, ct))
+      else:
+         selfCount = dict()
+         totalCount = dict()
+         for stack, count in self.samples.items():
+            selfCount[stack[-1]] = selfCount.get(stack[-1], 0) + count
+            for label in set(stack):
+               totalCount[label] = totalCount.get(label, 0) + count
+         for label in totalCount:
+            hot.append((label, selfCount.get(label, 0), totalCount[label]))
+      hot.sort(key=lambda item : item[1], reverse=True)
+      return hot[:self.topN]
+
+   def report(self, extraReport = ""):
+      """
+      Writes the collapsed stacks, pstats dump and summary for the section
+      that just finished, and prints the summary.
+      """
+      prefix = "%s_%s_%s" % (self.outputPrefix, self.tag(), self.section)
+      directory = os.path.dirname(prefix)
+      if len(directory) > 0 and not os.path.isdir(directory):
+         os.makedirs(directory)
+
+      with open(prefix + ".collapsed", "w") as f:
+         for stack, count in sorted(self.collapsedStacks().items()):
+            f.write("%s %d\n" % (stack, count))
+      if self.cProfile is not None:
+         self.cProfile.dump_stats(prefix + ".pstats")
+
+      unit = "s" if self.cProfile is not None else "samples"
+      summary = "Profile of %s for %s (%s mode)\n" % (self.section, self.tag(), "deep" if self.deep else "sampling")
+      summary += "Wall-clock time %f\n" % self.sectionTimes[-1][1]
+      iterationTimes = self.iterationTimes.get(self.section, list())
+      if len(iterationTimes) > 0:
+         summary += "Iterations %d (profiled %d), mean iteration time %f\n" % (
+            len(iterationTimes), self.profiledIterations, sum(iterationTimes) / len(iterationTimes))
+      summary += "Top %d functions by self time (%s):\n" % (self.topN, unit)
+      summary += "%12s %12s  %s\n" % ("self", "cumulative", "function")
+      for label, selfTime, totalTime in self.hotFunctions():
+         summary += "%12.4g %12.4g  %s\n" % (selfTime, totalTime, label)
+      summary += extraReport
+
+      with open(prefix + ".txt", "w") as f:
+         f.write(summary)
+      print(summary)
+
+def frameLabel(fileName, functionName):
+   """
+   Label used for a stack frame in collapsed stacks and summaries, e.g.
+   network.py:shortestPath
+   """
+   return "%s:%s" % (os.path.basename(fileName), functionName)
+
+def instrumented(section, iterative = False):
+   """
+   Decorator for Network entry points.  If network.profiler is set, the call
+   is bracketed by Profiler.enter/exit, and if network.memoryMonitor is set
+   the call is recorded as a memory phase named after the section; otherwise
+   the method runs untouched.  Iterative methods should call
+   network.profiler.iteration(i) each iteration.
+   """
+   def decorator(method):
+      @functools.wraps(method)
+      def wrapper(network, *args, **kwargs):
+         if network.profiler is None or network.profiler.section is not None:
+            with network.phase(section):
+               return method(network, *args, **kwargs)
+         network.profiler.enter(section, iterative)
+         try:
+            with network.phase(section):
+               return method(network, *args, **kwargs)
+         finally:
+            network.profiler.exit(network.formatMemoryReport() if network.memoryMonitor is not None else "")
+      return wrapper
+   return decorator
@@ -0,0 +1,249 @@
+from array import array
+from network import BadNetworkOperationException
+
+class AssignmentQueries:
+   """
+   Post-assignment queries -- select-link, select-zone and the path of an OD
+   pair -- answered from stored per-origin shortest path trees instead of
+   re-running assignment or walking backlinks by hand.
+
+   The trees are built once, at the network's link costs when the
+   AssignmentQueries object is created (normally right after a solve), and
+   the OD demands are copied at the same time, so later changes to the
+   network do not affect the answers; build a new object after a new solve.
+   At equilibrium each OD pair may use several paths of equal cost and the
+   tree holds one of them.  If the solve tracked origin flows
+   (Network.trackOriginFlows), selectLink(link, method = 'flows') instead
+   splits each origin's actual flows proportionally at every node, which
+   accounts for all used paths.
+
+   For every origin the tree is stored as backlinks (link.index, -1 for none)
+   and a depth-first preorder of its nodes, so that the nodes whose path uses
+   a link are the contiguous preorder range of the subtree below its head.
+   Memory is about four ints per node per origin.
+   """
+
+   def __init__(self, network):
+      self.network = network
+      network.refreshLinkCosts()
+      self.linkCosts = array('d', network.linkCosts)
+      self.demands = array('d', [od.demand for od in network.ODlist])
+      numNodes = len(network.blankBacklinkLabels)
+      self.backlinks = dict()
+      self.preorder = dict()
+      self.position = dict()
+      self.subtreeSize = dict()
+      children = [list() for n in range(numNodes)]
+      for origin in sorted(network.relevant_origins):
+         backlink = array('i', network.shortestPathLabels(origin)[1])
+         order = network.settledOrder[0:network.numSettled]
+         for n in order[1:]:
+            children[network.linkTail[backlink[n]]].append(n)
+         preorder = array('i')
+         position = array('i', [-1]) * numNodes
+         size = array('i', [0]) * numNodes
+         stack = [origin]
+         while len(stack) > 0:
+            n = stack.pop()
+            position[n] = len(preorder)
+            preorder.append(n)
+            stack.extend(children[n])
+         for n in reversed(preorder):
+            size[n] += 1
+            if n != origin:
+               size[network.linkTail[backlink[n]]] += size[n]
+         for n in order:
+            children[n] = list()
+         self.backlinks[origin] = backlink
+         self.preorder[origin] = preorder
+         self.position[origin] = position
+         self.subtreeSize[origin] = size
+      self.odByNodes = dict(((od.origin, od.destination), od) for od in network.ODlist)
+      self.linkByNodes = dict(((link.tail, link.head), link) for link in network.linkList)
+
+   def findLink(self, key):
+      """
+      The Link with the given ID or (tail, head) tuple.
+      """
+      link = self.network.link.get(key) if key in self.network.link else self.linkByNodes.get(key)
+      if link is None:
+         raise BadNetworkOperationException("Unknown link " + str(key))
+      return link
+
+   def path(self, origin, destination):
+      """
+      The links (as Link objects, in order) of the stored path from origin to
+      destination; empty if there is none.
+      """
+      network = self.network
+      backlink = self.backlinks[origin]
+      links = list()
+      n = destination
+      while n != origin and backlink[n] >= 0:
+         links.append(network.linkList[backlink[n]])
+         n = network.linkTail[backlink[n]]
+      if n != origin:
+         return list()
+      links.reverse()
+      return links
+
+   def pathNodes(self, origin, destination):
+      links = self.path(origin, destination)
+      return [origin] + [link.head for link in links] if len(links) > 0 else list()
+
+   def pathCost(self, origin, destination):
+      return sum(self.linkCosts[link.index] for link in self.path(origin, destination))
+
+   def selectLink(self, key, method = 'tree'):
+      """
+      Demand of every OD pair through the link (ID or (tail, head)), as a
+      dictionary mapping OD pair IDs to demand.  With method 'tree' this is
+      the demand of the OD pairs whose stored path uses the link; with
+      method 'flows' it is each OD pair's share of its origin's tracked
+      flow on the link (see the class docstring).
+      """
+      if method == 'flows':
+         return self.selectLinkFlows(key)
+      if method != 'tree':
+         raise BadNetworkOperationException("Unknown select-link method " + str(method))
+      network = self.network
+      link = self.findLink(key)
+      head = link.head
+      selected = dict()
+      for origin, backlink in self.backlinks.items():
+         if backlink[head] != link.index:
+            continue
+         start = self.position[origin][head]
+         for n in self.preorder[origin][start : start + self.subtreeSize[origin][head]]:
+            od = self.odByNodes.get((origin, n))
+            if od is not None and self.demands[od.index] > 0:
+               selected[od.ID] = self.demands[od.index]
+      return selected
+
+   def selectLinkFlows(self, key):
+      network = self.network
+      originFlows = network.originFlows
+      if originFlows is None:
+         raise BadNetworkOperationException("Select-link by flows needs origin flow tracking "
+                                            "(trackOriginFlows) during the solve")
+      link = self.findLink(key)
+      selected = dict()
+      numNodes = len(network.blankBacklinkLabels)
+      for origin in self.backlinks:
+         if not originFlows.usesLink(origin, link.index):
+            continue
+         flows = originFlows.originFlows(origin)
+         inflow = array('d', [0.0]) * numNodes
+         incoming = [list() for n in range(numNodes)]
+         for l in range(len(flows)):
+            if flows[l] > 0:
+               inflow[network.linkHead[l]] += flows[l]
+               incoming[network.linkHead[l]].append(l)
+         share = array('d', [0.0]) * numNodes
+         for n in self.flowOrder(origin, flows, incoming):
+            if inflow[n] <= 0:
+               continue
+            through = 0.0
+            for l in incoming[n]:
+               through += flows[l] if l == link.index else flows[l] * share[network.linkTail[l]]
+            share[n] = min(through / inflow[n], 1.0)
+         for od in network.originODs[origin]:
+            if share[od.destination] > 0 and self.demands[od.index] > 0:
+               selected[od.ID] = self.demands[od.index] * share[od.destination]
+      return selected
+
+   def flowOrder(self, origin, flows, incoming):
+      """
+      Topological order of the nodes reached by origin's flows (so that
+      every node comes after the tails of the links bringing it flow).  If
+      the flows contain a cycle, the remaining nodes follow in order of
+      their cost from the origin.
+      """
+      network = self.network
+      waiting = dict((n, len(links)) for n, links in enumerate(incoming) if len(links) > 0)
+      outgoing = dict()
+      for l in range(len(flows)):
+         if flows[l] > 0:
+            outgoing.setdefault(network.linkTail[l], list()).append(network.linkHead[l])
+      order = list()
+      ready = [origin]
+      while len(ready) > 0:
+         n = ready.pop()
+         order.append(n)
+         for head in outgoing.get(n, list()):
+            waiting[head] -= 1
+            if waiting[head] == 0:
+               ready.append(head)
+      if len(order) < len(waiting) + 1:
+         placed = set(order)
+         network.shortestPathLabels(origin, self.linkCosts)
+         order.extend(n for n in network.settledOrder[0:network.numSettled] if n in waiting and n not in placed)
+      return order
+
+   def selectZone(self, zone, direction = 'origin'):
+      """
+      Link flows of the trips starting at (direction 'origin') or ending at
+      (direction 'destination') the zone, loaded on the stored paths, as a
+      dictionary mapping link IDs to flow.
+      """
+      network = self.network
+      flows = dict()
+      if direction == 'origin':
+         pairs = [(od.origin, od.destination, od) for od in network.originODs.get(zone, list())]
+      elif direction == 'destination':
+         pairs = [(origin, zone, self.odByNodes[(origin, zone)]) for origin in self.backlinks
+                  if (origin, zone) in self.odByNodes]
+      else:
+         raise BadNetworkOperationException("Unknown select-zone direction " + str(direction))
+      for origin, destination, od in pairs:
+         demand = self.demands[od.index]
+         if demand <= 0:
+            continue
+         for link in self.path(origin, destination):
+            flows[link.ID] = flows.get(link.ID, 0.0) + demand
+      return flows
+
+   def exportSelectLink(self, keys, fileName, method = 'tree'):
+      """
+      Writes the select-link results of each link in keys to a CSV file with
+      one row per link and OD pair.
+      """
+      with open(fileName, 'w') as f:
+         f.write("Tail,Head,Origin,Destination,Demand\n")
+         for key in keys:
+            link = self.findLink(key)
+            for ODID, demand in sorted(self.selectLink(key, method).items()):
+               od = self.network.ODpair[ODID]
+               f.write(f"{link.tail},{link.head},{od.origin},{od.destination},{demand:.6f}\n")
+      print(f"Select-link results written to {fileName}")
+
+   def exportSelectZone(self, zones, fileName, direction = 'origin'):
+      """
+      Writes the select-zone link flows of each zone to a CSV file with one
+      row per zone and link.
+      """
+      with open(fileName, 'w') as f:
+         f.write("Zone,Direction,Tail,Head,Flow\n")
+         for zone in zones:
+            for linkID, flow in sorted(self.selectZone(zone, direction).items()):
+               link = self.network.link[linkID]
+               f.write(f"{zone},{direction},{link.tail},{link.head},{flow:.6f}\n")
+      print(f"Select-zone results written to {fileName}")
+
+   def exportPaths(self, fileName, pairs = None):
+      """
+      Writes the stored path of each (origin, destination) pair in pairs (all
+      OD pairs with demand if None) to a CSV file, with the nodes of the path
+      separated by semicolons.
+      """
+      if pairs is None:
+         pairs = [(od.origin, od.destination) for od in self.network.ODlist if self.demands[od.index] > 0]
+      with open(fileName, 'w') as f:
+         f.write("Origin,Destination,Demand,Cost,Path\n")
+         for origin, destination in pairs:
+            od = self.odByNodes.get((origin, destination))
+            demand = self.demands[od.index] if od is not None else 0
+            nodes = self.pathNodes(origin, destination)
+            f.write(f"{origin},{destination},{demand:.6f},{self.pathCost(origin, destination):.6f},"
+                    f"{';'.join(str(n) for n in nodes)}\n")
+      print(f"Paths written to {fileName}")
@@ -0,0 +1,156 @@
+from array import array
+
+class AssignmentResult:
+   """
+   Snapshot of a solved network, returned by Network.solve.  The values are
+   copied out of the Link and OD objects into flat arrays, so the result
+   stays valid when the network is solved again:
+      linkIDs, linkTails, linkHeads -- link identification, by link.index
+      linkFlows, linkCosts          -- array('d') indexed by link.index
+      ODIDs, ODorigins, ODdestinations -- OD identification, by OD.index
+      demands, travelTimes          -- array('d') of OD demand and k_rs
+      origins, originPotential, originDemand, originNotTraveling,
+      originTravelTime, originAverageTime
+                                    -- per relevant origin: P_r_aug, realized
+                                       demand, P_r_aug minus that demand,
+                                       total and average travel time
+      destinations, destinationDemand, destinationTravelTime,
+      destinationAverageTime        -- the same per relevant destination
+      metrics                       -- network-wide values, in the order and
+                                       with the names of the aggregate file
+      convergenceHistory            -- (iteration, gap, gap2, elapsed time)
+      iterations, stopReason, solveTime
+   Nothing is formatted or written unless writeFiles is called; it produces
+   the files of Network.printResults (which calls it).  The network's node
+   dictionary is kept for the coordinates in those files.
+   """
+
+   def __init__(self, network, solveTime = 0.0):
+      self.node = network.node
+      linkList = network.linkList
+      ODlist = network.ODlist
+      self.linkIDs = [link.ID for link in linkList]
+      self.linkTails = array('i', [link.tail for link in linkList])
+      self.linkHeads = array('i', [link.head for link in linkList])
+      self.linkFlows = array('d', [link.flow for link in linkList])
+      self.linkCosts = array('d', [link.cost for link in linkList])
+      self.ODIDs = [od.ID for od in ODlist]
+      self.ODorigins = array('i', [od.origin for od in ODlist])
+      self.ODdestinations = array('i', [od.destination for od in ODlist])
+      self.demands = array('d', [od.demand for od in ODlist])
+      self.travelTimes = array('d', [od.k_rs for od in ODlist])
+
+      self.origins = array('i', network.relevant_origins)
+      self.originPotential = array('d')
+      self.originDemand = array('d')
+      self.originTravelTime = array('d')
+      for origin in self.origins:
+         ods = network.originODs[origin]
+         self.originPotential.append(ods[0].P_r_aug)
+         self.originDemand.append(sum(self.demands[od.index] for od in ods))
+         self.originTravelTime.append(sum(self.demands[od.index] * self.travelTimes[od.index] for od in ods))
+      self.originNotTraveling = array('d', [potential - demand for potential, demand
+                                            in zip(self.originPotential, self.originDemand)])
+      self.originAverageTime = self.averages(self.originTravelTime, self.originDemand)
+
+      self.destinations = array('i', network.relevant_destinations)
+      position = dict((destination, d) for d, destination in enumerate(self.destinations))
+      self.destinationDemand = array('d', [0.0]) * len(self.destinations)
+      self.destinationTravelTime = array('d', [0.0]) * len(self.destinations)
+      for od in ODlist:
+         d = position.get(od.destination)
+         if d is not None:
+            self.destinationDemand[d] += self.demands[od.index]
+            self.destinationTravelTime[d] += self.demands[od.index] * self.travelTimes[od.index]
+      self.destinationAverageTime = self.averages(self.destinationTravelTime, self.destinationDemand)
+
+      totalPossibleDemand = sum(self.originPotential)
+      realizedDemand = sum(self.demands)
+      totalDistance = sum(link.flow * link.length for link in linkList)
+      self.metrics = {'TSTT' : network.TSTT,
+                      'Total_Possible_Demand' : totalPossibleDemand,
+                      'Realized_Demand' : realizedDemand,
+                      'Demand_Not_Traveling' : totalPossibleDemand - realizedDemand,
+                      'Average_Travel_Time' : network.TSTT / realizedDemand if realizedDemand > 0 else 0,
+                      'AEC' : network.averageExcessCost(),
+                      'TMF' : network.TMF,
+                      'Relative_Gap' : network.relativeGap(),
+                      'Average_Trip_Length' : totalDistance / realizedDemand if realizedDemand > 0 else 0,
+                      'Total_distance_traveled' : totalDistance}
+
+      self.convergenceHistory = list(network.convergenceHistory)
+      self.iterations = network.iterations
+      self.stopReason = network.stopReason
+      self.solveTime = solveTime
+
+   @staticmethod
+   def averages(totals, demands):
+      return array('d', [total / demand if demand > 0 else 0 for total, demand in zip(totals, demands)])
+
+   def gap(self):
+      """
+      (gap, gap2) of the last iteration, or None if no iteration was run.
+      """
+      if len(self.convergenceHistory) == 0:
+         return None
+      return self.convergenceHistory[-1][1:3]
+
+   def linkFlowDict(self):
+      """
+      Dictionary mapping link IDs to flows.
+      """
+      return dict(zip(self.linkIDs, self.linkFlows))
+
+   def demandDict(self):
+      """
+      Dictionary mapping OD pair IDs to demands.
+      """
+      return dict(zip(self.ODIDs, self.demands))
+
+   def writeFiles(self, ODFilename, Linksfilename, OriginFilename, DestinationFilename, AggregateResults, log = None):
+      """
+      Writes the OD, link, origin, destination and network-wide results in
+      the printResults formats; log (e.g. print) is called with a message
+      after each file.
+      """
+      node = self.node
+      with open(ODFilename, 'w') as f:
+         f.write("origin,origin_x,origin_y,origin_geoid,destination,dest_x,dest_y,dest_geoid,Demand,TravelTime\n")
+         for i in range(len(self.ODIDs)):
+            origin_node = node[self.ODorigins[i]]
+            dest_node = node[self.ODdestinations[i]]
+            f.write(f"{self.ODorigins[i]},{origin_node.x},{origin_node.y},{origin_node.geoid},{self.ODdestinations[i]},{dest_node.x},{dest_node.y},{dest_node.geoid},{self.demands[i]:.6f},{self.travelTimes[i]:.6f}\n")
+      if log is not None:
+         log(f"OD results written to {ODFilename}")
+
+      with open(Linksfilename, 'w') as f:
+         f.write("Tail,Tail_x,Tail_y,Tail_geoid,Head,Head_x,Head_y,Head_geoid,Flow,Cost\n")
+         for i in range(len(self.linkIDs)):
+            tail_node = node[self.linkTails[i]]
+            head_node = node[self.linkHeads[i]]
+            f.write(f"{self.linkTails[i]},{tail_node.x},{tail_node.y},{tail_node.geoid},{self.linkHeads[i]},{head_node.x},{head_node.y},{head_node.geoid},{self.linkFlows[i]:.6f},{self.linkCosts[i]:.6f}\n")
+      if log is not None:
+         log(f"Flow results written to {Linksfilename}")
+
+      with open(OriginFilename, 'w') as f:
+         f.write("Origin,Origin_x,Origin_y,Origin_geoid,P_r_aug,Total_Demand,Demand_Not_Traveling,Total_Travel_Time,Average_Travel_Time\n")
+         for i, origin in enumerate(self.origins):
+            origin_node = node[origin]
+            f.write(f"{origin},{origin_node.x},{origin_node.y},{origin_node.geoid},{self.originPotential[i]:.6f},{self.originDemand[i]:.6f},{self.originNotTraveling[i]:.6f},{self.originTravelTime[i]:.6f},{self.originAverageTime[i]:.6f}\n")
+      if log is not None:
+         log(f"Aggregated origin results written to {OriginFilename}")
+
+      with open(DestinationFilename, 'w') as f:
+         f.write("Origin,Origin_x,Origin_y,Origin_geoid,P_r_aug,Total_Demand,Demand_Not_Traveling,Total_Travel_Time,Average_Travel_Time\n")
+         for i, dest in enumerate(self.destinations):
+            dest_node = node[dest]
+            f.write(f"{dest},{dest_node.x},{dest_node.y},{dest_node.geoid},{self.destinationDemand[i]:.6f},{self.destinationTravelTime[i]:.6f},{self.destinationAverageTime[i]:.6f}\n")
+      if log is not None:
+         log(f"Aggregated origin results written to {DestinationFilename}")
+
+      with open(AggregateResults, 'w') as f:
+         f.write("Metric,Value\n")
+         for name, value in self.metrics.items():
+            f.write(f"{name},{value:.6f}\n")
+      if log is not None:
+         log(f"Network-wide metrics written to {AggregateResults}")
@@ -0,0 +1,233 @@
+from array import array
+from batch import OD_ATTRIBUTES, BadScenarioException
+
+import contextlib
+
+KEYS = ('origin', 'destination', 'origin_geoid', 'dest_geoid')
+
+class ScenarioBase:
+   """
+   Snapshot of a Network's OD attractiveness table as flat columns indexed by
+   OD.index (one array per attribute in batch.OD_ATTRIBUTES), together with
+   the origin, destination and their geoids used for masks and joins.  All
+   Scenarios built on one ScenarioBase share these columns.  They are kept in
+   double precision whatever the network's storage precision (see
+   Network.setPrecision), so that restoring the base writes back the exact
+   values read from the attr file.
+   """
+
+   def __init__(self, network):
+      self.network = network
+      self.numODs = len(network.ODlist)
+      self.columns = dict()
+      for attribute in OD_ATTRIBUTES:
+         self.columns[attribute] = array('d', [getattr(od, attribute) for od in network.ODlist])
+      self.keys = dict()
+      self.keys['origin'] = array('q', [od.origin for od in network.ODlist])
+      self.keys['destination'] = array('q', [od.destination for od in network.ODlist])
+      self.keys['origin_geoid'] = array('q', [network.node[od.origin].geoid for od in network.ODlist])
+      self.keys['dest_geoid'] = array('q', [network.node[od.destination].geoid for od in network.ODlist])
+
+   def mask(self, origins = None, destinations = None, originGeoids = None, destinationGeoids = None):
+      """
+      Returns a bytearray over OD.index which is 1 for OD pairs whose origin
+      is in origins, destination in destinations, and so on.  Criteria that
+      are None are not checked; the ones given must all hold.
+      """
+      mask = bytearray(b'\x01') * self.numODs
+      for key, values in (('origin', origins), ('destination', destinations),
+                          ('origin_geoid', originGeoids), ('dest_geoid', destinationGeoids)):
+         if values is None:
+            continue
+         values = set(values)
+         column = self.keys[key]
+         for i in range(self.numODs):
+            if column[i] not in values:
+               mask[i] = 0
+      return mask
+
+class Scenario:
+   """
+   A named set of edits to the OD attractiveness parameters, applied in memory
+   instead of writing an attr file, transforming it in Scenarios.R and reading
+   it back.  Edits are copy-on-write: a Scenario only owns the columns it has
+   modified and reads everything else from its ScenarioBase, so many scenarios
+   can be held at once without duplicating the OD table.  Modified columns
+   are stored in the network's storage precision.
+
+   Transforms return the Scenario, so they can be chained:
+      S2a = Scenario(base, "S2a").shiftByTable(('a_rs', 'a_rsE', 'a_rsSC'),
+                                               incomeTable, 'inc', 5, 'dest_geoid')
+   Use apply(network) (or the applied context manager) to write the scenario
+   into the Network's OD pairs before solving, or batchShifts() to pass it to
+   ScenarioBatch.
+   """
+
+   def __init__(self, base, name = ""):
+      self.base = base
+      self.name = name
+      self.columns = dict()
+
+   def column(self, attribute):
+      """
+      Current values of attribute (shared with the base if never modified).
+      """
+      if attribute in self.columns:
+         return self.columns[attribute]
+      if attribute not in self.base.columns:
+         raise BadScenarioException("Unknown OD attribute " + str(attribute))
+      return self.base.columns[attribute]
+
+   def writableColumn(self, attribute):
+      if attribute not in self.columns:
+         column = self.column(attribute)
+         self.columns[attribute] = array(self.base.network.storageType, column)
+      return self.columns[attribute]
+
+   def shift(self, attributes, value, mask = None):
+      """
+      Adds the constant value to each of the given attributes, for all OD
+      pairs or only where mask (see ScenarioBase.mask) is set.
+      """
+      for attribute in attributes:
+         column = self.writableColumn(attribute)
+         for i in range(self.base.numODs):
+            if mask is None or mask[i]:
+               column[i] += value
+      return self
+
+   def shiftByTable(self, attributes, table, tableColumn, scale = 1.0, key = 'dest_geoid', missing = 0.0):
+      """
+      Joins the OD pairs with an attribute table (see readAttributeTable) on
+      key, one of 'origin', 'destination', 'origin_geoid' or 'dest_geoid', and
+      adds scale * table[keyValue][tableColumn] to each of the given
+      attributes.  OD pairs whose key is not in the table are shifted by
+      scale * missing.
+      """
+      if key not in KEYS:
+         raise BadScenarioException("Unknown join key " + str(key))
+      keys = self.base.keys[key]
+      shifts = array('d', [scale * table[keys[i]][tableColumn] if keys[i] in table else scale * missing
+                           for i in range(self.base.numODs)])
+      for attribute in attributes:
+         column = self.writableColumn(attribute)
+         for i in range(self.base.numODs):
+            column[i] += shifts[i]
+      return self
+
+   def set(self, attributes, value, mask = None):
+      """
+      Sets the given attributes to value, for all OD pairs or where mask is set.
+      """
+      for attribute in attributes:
+         column = self.writableColumn(attribute)
+         for i in range(self.base.numODs):
+            if mask is None or mask[i]:
+               column[i] = value
+      return self
+
+   def batchShifts(self):
+      """
+      The scenario as a ScenarioBatch shift dictionary: for each modified
+      attribute, the per-OD difference from the base.
+      """
+      shifts = dict()
+      for attribute, column in self.columns.items():
+         baseColumn = self.base.columns[attribute]
+         shifts[attribute] = array('d', [column[i] - baseColumn[i] for i in range(self.base.numODs)])
+      return shifts
+
+   def apply(self, network = None):
+      """
+      Writes every attribute column (modified or not) into the OD pairs of the
+      network the base was taken from, so that solving the network solves
+      this scenario.
+      """
+      network = network if network is not None else self.base.network
+      for attribute in OD_ATTRIBUTES:
+         column = self.column(attribute)
+         for od in network.ODlist:
+            setattr(od, attribute, column[od.index])
+
+   @contextlib.contextmanager
+   def applied(self, network = None):
+      """
+      Context manager that applies the scenario and restores the base values
+      on exit:
+         with S1a.applied(net):
+            net.RELAXEDuserEquilibrium(...)
+            net.printResults(...)
+      """
+      network = network if network is not None else self.base.network
+      self.apply(network)
+      try:
+         yield self
+      finally:
+         Scenario(self.base).apply(network)
+
+def readAttributeTable(fileName, key, sep = ','):
+   """
+   Reads a zone or geoid attribute table with a header row, such as the
+   low_income_tracts file used by Scenarios.R, into a dictionary mapping the
+   value of the key column (as an int) to a dictionary of the other columns
+   (as floats).
+   """
+   table = dict()
+   with open(fileName, 'r') as f:
+      header = [name.strip().strip('"') for name in next(f).strip().split(sep)]
+      if key not in header:
+         raise BadScenarioException("Column %s not found in %s" % (key, fileName))
+      keyPosition = header.index(key)
+      for line in f:
+         values = [value.strip().strip('"') for value in line.strip().split(sep)]
+         if len(values) < len(header):
+            continue
+         row = dict()
+         for name, value in zip(header, values):
+            if name != key:
+               try:
+                  row[name] = float(value)
+               except ValueError:
+                  row[name] = value
+         table[int(float(values[keyPosition]))] = row
+   return table
+
+def readTractList(fileName, column, sep = ','):
+   """
+   Reads one column of geoids (such as Tracts_large in the Austin CBD file)
+   into a set of ints.
+   """
+   tracts = set()
+   with open(fileName, 'r') as f:
+      header = [name.strip().strip('"') for name in next(f).strip().split(sep)]
+      position = header.index(column)
+      for line in f:
+         values = line.strip().split(sep)
+         if len(values) > position and len(values[position].strip()) > 0:
+            tracts.add(int(float(values[position].strip().strip('"'))))
+   return tracts
+
+def austinScenarios(base, incomeTable = None, cbdTracts = None):
+   """
+   The scenario families of Input_Files/Scenarios.R, built in memory:
+      S1a-S1d -- a_rn and a_rnE shifted by +5, +10, +15, -5
+      S2a-S2d -- a_rs, a_rsE, a_rsSC shifted by inc * (5, 10, 15, -5) for the
+                 destination tract (incomeTable from readAttributeTable on
+                 low_income_tracts with key 'data.GEOID')
+      S3a-S3d -- a_rs, a_rsE, a_rsSC shifted by 5, -5, -10, -15 for
+                 destinations in the CBD tracts (cbdTracts from readTractList)
+   S2 and S3 are only built if the corresponding table is given.  Returns a
+   dictionary mapping scenario names to Scenarios.
+   """
+   scenarios = dict()
+   for suffix, value in zip("abcd", (5, 10, 15, -5)):
+      scenarios["S1" + suffix] = Scenario(base, "S1" + suffix).shift(('a_rn', 'a_rnE'), value)
+   if incomeTable is not None:
+      for suffix, value in zip("abcd", (5, 10, 15, -5)):
+         scenarios["S2" + suffix] = Scenario(base, "S2" + suffix).shiftByTable(
+            ('a_rs', 'a_rsE', 'a_rsSC'), incomeTable, 'inc', value, 'dest_geoid')
+   if cbdTracts is not None:
+      cbd = base.mask(destinationGeoids = cbdTracts)
+      for suffix, value in zip("abcd", (5, -5, -10, -15)):
+         scenarios["S3" + suffix] = Scenario(base, "S3" + suffix).shift(('a_rs', 'a_rsE', 'a_rsSC'), value, cbd)
+   return scenarios
@@ -0,0 +1,383 @@
+from array import array
+from network import BadNetworkOperationException
+
+import math
+import time
+
+MIN_DERIVATIVE_RATIO = 1e-4 # floor on link cost derivatives, as a fraction of freeFlowTime / capacity
+CG_TOLERANCE = 1e-9 # relative residual at which the per-origin conjugate gradient solve stops
+
+DEMAND_PARAMETERS = {
+   'targetDemandsRelaxed' : ('a_rs', 'a_rn'),
+   'targetDemandsElastic' : ('a_rsE', 'a_rnE'),
+   'targetDemandsSinglyConstrained' : ('a_rsSC',),
+   'targetDemandsStatic' : (),
+}
+
+class OriginSystem:
+   """
+   The linearized equilibrium conditions of one origin, restricted to its
+   bush (the links it uses at equilibrium).  Node potentials are the
+   derivatives of the shortest path costs from the origin, and the origin's
+   derivative flows are determined by them: on every bush link
+      dx_l = (dpi_head - dpi_tail - dc_l(other terms)) / c'_l
+   so conservation at each node, with the demand derivatives as sinks, is
+   a symmetric positive definite system in the potentials: the bush
+   Laplacian (conductances 1 / c'_l) minus the Jacobian of the demand
+   function with respect to the shortest path costs.  Local node 0 is the
+   origin, whose potential is fixed at zero.
+   """
+
+   def __init__(self, network, origin, bushLinks, costDerivatives, model):
+      self.origin = origin
+      self.model = model
+      self.localNode = {origin : 0}
+      for l in bushLinks:
+         for n in (network.linkTail[l], network.linkHead[l]):
+            if n not in self.localNode:
+               self.localNode[n] = len(self.localNode)
+      self.links = array('i', bushLinks)
+      self.tails = [self.localNode[network.linkTail[l]] for l in bushLinks]
+      self.heads = [self.localNode[network.linkHead[l]] for l in bushLinks]
+      self.conductances = [1 / costDerivatives[l] for l in bushLinks]
+      self.ods = list()
+      for od in network.originODs[origin]:
+         if od.destination != origin and od.destination in self.localNode and od.demand > 0:
+            self.ods.append(od)
+      self.destinations = [self.localNode[od.destination] for od in self.ods]
+      self.demands = [od.demand for od in self.ods]
+      if model == 'targetDemandsRelaxed':
+         self.totalDemand = self.ods[0].P_r_aug if len(self.ods) > 0 else 1
+      elif model == 'targetDemandsSinglyConstrained':
+         self.totalDemand = self.ods[0].P_r if len(self.ods) > 0 else 1
+      elif model == 'targetDemandsElastic':
+         self.curvatures = [od.demand * (1 - od.demand * (1 - od.tel) / od.FIXEDdemand) for od in self.ods]
+      self.potentials = [0.0] * len(self.localNode)
+      self.flows = [0.0] * len(bushLinks)
+
+   def demandCurvature(self, v):
+      """
+      Minus the demand Jacobian times the destination potentials v, one entry
+      per OD pair in self.ods.
+      """
+      if self.model == 'targetDemandsElastic':
+         return [c * v[n] for c, n in zip(self.curvatures, self.destinations)]
+      if self.model == 'targetDemandsStatic':
+         return [0.0] * len(self.ods)
+      weighted = 0.0
+      for d, n in zip(self.demands, self.destinations):
+         weighted += d * v[n]
+      weighted /= self.totalDemand
+      return [d * (v[n] - weighted) for d, n in zip(self.demands, self.destinations)]
+
+   def multiply(self, v):
+      out = [0.0] * len(v)
+      for t, h, g in zip(self.tails, self.heads, self.conductances):
+         difference = g * (v[h] - v[t])
+         out[h] += difference
+         out[t] -= difference
+      for n, value in zip(self.destinations, self.demandCurvature(v)):
+         out[n] += value
+      out[0] = 0.0
+      return out
+
+   def solve(self, offsets, demandTerms, maxIterations):
+      """
+      Solves for the potentials given the cost offsets of the bush links
+      (cost derivative not due to this origin's own flows) and the direct
+      demand derivatives demandTerms (one per OD pair in self.ods), starting
+      from the previous potentials, and updates self.flows.  Returns the
+      number of conjugate gradient iterations.
+      """
+      rhs = [0.0] * len(self.potentials)
+      for t, h, g, q in zip(self.tails, self.heads, self.conductances, offsets):
+         rhs[h] += g * q
+         rhs[t] -= g * q
+      for n, b in zip(self.destinations, demandTerms):
+         rhs[n] += b
+      rhs[0] = 0.0
+
+      x = self.potentials
+      Ax = self.multiply(x)
+      r = [b - a for b, a in zip(rhs, Ax)]
+      p = list(r)
+      rr = sum(value * value for value in r)
+      threshold = CG_TOLERANCE * CG_TOLERANCE * max(sum(value * value for value in rhs), 1e-300)
+      iteration = 0
+      while rr > threshold and iteration < maxIterations:
+         iteration += 1
+         Ap = self.multiply(p)
+         pAp = sum(a * b for a, b in zip(p, Ap))
+         if pAp <= 0:
+            break
+         alpha = rr / pAp
+         for i in range(len(x)):
+            x[i] += alpha * p[i]
+            r[i] -= alpha * Ap[i]
+         rrNew = sum(value * value for value in r)
+         beta = rrNew / rr
+         rr = rrNew
+         for i in range(len(p)):
+            p[i] = r[i] + beta * p[i]
+      for k, (t, h, g, q) in enumerate(zip(self.tails, self.heads, self.conductances, offsets)):
+         self.flows[k] = g * (x[h] - x[t] - q)
+      return iteration
+
+   def demandDerivatives(self, demandTerms):
+      return [b - value for b, value in zip(demandTerms, self.demandCurvature(self.potentials))]
+
+class SensitivityResult:
+   """
+   First-order derivatives of the equilibrium with respect to one scenario
+   parameter: linkFlows (indexed by link.index), demands (indexed by
+   OD.index), TSTT and totalDemand.  apply(network, delta) changes the
+   parameter itself by delta, which checkSensitivity uses.
+   """
+
+   def __init__(self, name, linkFlows, demands, TSTT, totalDemand, sweeps, apply):
+      self.name = name
+      self.linkFlows = linkFlows
+      self.demands = demands
+      self.TSTT = TSTT
+      self.totalDemand = totalDemand
+      self.sweeps = sweeps
+      self.apply = apply
+
+   def predict(self, network, delta):
+      """
+      First-order estimate of the equilibrium after changing the parameter
+      by delta, as a dictionary with 'linkFlows' and 'demands' arrays
+      (clipped at zero), 'TSTT' and 'totalDemand'.
+      """
+      prediction = dict()
+      prediction['linkFlows'] = array('d', [max(link.flow + delta * self.linkFlows[link.index], 0)
+                                            for link in network.linkList])
+      prediction['demands'] = array('d', [max(od.demand + delta * self.demands[od.index], 0)
+                                          for od in network.ODlist])
+      prediction['TSTT'] = network.TSTT + delta * self.TSTT
+      prediction['totalDemand'] = network.totalDemand + delta * self.totalDemand
+      return prediction
+
+class Sensitivity:
+   """
+   Sensitivity analysis at a converged RELAXEDuserEquilibrium solution:
+   derivatives of link flows, OD demands and TSTT with respect to shifts of
+   the attractiveness parameters (for groups of origins or destinations)
+   and link capacities, from the linearized equilibrium conditions on each
+   origin's bush rather than a new solve.  Multiplying by a parameter change
+   gives an approximate scenario outcome (SensitivityResult.predict), good
+   for small changes and for screening; checkSensitivity measures the error
+   against a full solve.
+
+   The solve must have been run with origin flow tracking on
+   (Network.trackOriginFlows), since each origin's bush is taken from its
+   flows: the links carrying flow from the origin whose reduced cost is
+   within reducedCostTolerance of the shortest path cost to their head, plus
+   the current shortest path tree to each destination.  The coupled system
+   is solved origin by origin (block Gauss-Seidel, with conjugate gradients
+   within each origin) until the derivative flows change by less than
+   tolerance relative to their largest value.
+   """
+
+   def __init__(self, network, demandFunction = None, reducedCostTolerance = 0.01,
+                flowTolerance = 1e-6, tolerance = 1e-4, maxSweeps = 50):
+      if network.originFlows is None:
+         raise BadNetworkOperationException("Sensitivity analysis needs the origin flows of the solve; "
+                                            "call trackOriginFlows() before solving")
+      demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+      self.network = network
+      self.model = demandFunction.__name__
+      if self.model not in DEMAND_PARAMETERS:
+         raise BadNetworkOperationException("No sensitivity analysis for demand function " + self.model)
+      self.tolerance = tolerance
+      self.maxSweeps = maxSweeps
+
+      derivatives = network.linkPerformance.derivatives(network.currentFlows(), array('d', network.blankLinkBuffer))
+      self.costDerivatives = array('d', [max(derivatives[link.index],
+                                             MIN_DERIVATIVE_RATIO * link.freeFlowTime / link.capacity)
+                                         for link in network.linkList])
+      network.refreshLinkCosts()
+      linkCosts = network.linkCosts
+      self.systems = list()
+      for origin in sorted(network.relevant_origins):
+         cost, backlink = network.shortestPathLabels(origin)
+         flows = network.originFlows.originFlows(origin)
+         originDemand = sum(od.demand for od in network.originODs[origin])
+         bush = set()
+         for l in range(len(flows)):
+            if flows[l] > flowTolerance * originDemand:
+               head = network.linkHead[l]
+               reducedCost = cost[network.linkTail[l]] + linkCosts[l] - cost[head]
+               if reducedCost <= reducedCostTolerance * max(cost[head], linkCosts[l]):
+                  bush.add(l)
+         for od in network.originODs[origin]:
+            n = od.destination
+            while od.demand > 0 and backlink[n] >= 0 and n != origin:
+               bush.add(backlink[n])
+               n = network.linkTail[backlink[n]]
+         self.systems.append(OriginSystem(network, origin, sorted(bush), self.costDerivatives, self.model))
+
+   def solve(self, name, linkTerms, demandTerms, apply):
+      """
+      Solves the linearized system for one parameter.  linkTerms maps
+      link.index to the direct derivative of the link cost; demandTerms(system)
+      returns the direct derivatives of the origin's demands (for the OD pairs
+      in system.ods).
+      """
+      network = self.network
+      costDerivatives = self.costDerivatives
+      totalFlows = array('d', [0.0]) * len(network.linkList)
+      originTerms = [demandTerms(system) for system in self.systems]
+      for system in self.systems:
+         system.potentials = [0.0] * len(system.potentials)
+         system.flows = [0.0] * len(system.flows)
+      startTime = time.time()
+      sweep = 0
+      while sweep < self.maxSweeps:
+         sweep += 1
+         change = 0.0
+         for system, terms in zip(self.systems, originTerms):
+            offsets = [linkTerms.get(l, 0.0) + costDerivatives[l] * (totalFlows[l] - flow)
+                       for l, flow in zip(system.links, system.flows)]
+            old = list(system.flows)
+            system.solve(offsets, terms, 10 * len(system.potentials) + 10)
+            for l, before, after in zip(system.links, old, system.flows):
+               totalFlows[l] += after - before
+               change = max(change, abs(after - before))
+         largest = max((abs(flow) for flow in totalFlows), default = 0)
+         if change <= self.tolerance * max(largest, 1e-12):
+            break
+
+      demands = array('d', [0.0]) * len(network.ODlist)
+      for system, terms in zip(self.systems, originTerms):
+         for od, value in zip(system.ods, system.demandDerivatives(terms)):
+            demands[od.index] = value
+      TSTT = 0.0
+      for link in network.linkList:
+         l = link.index
+         TSTT += totalFlows[l] * link.cost + link.flow * (costDerivatives[l] * totalFlows[l] + linkTerms.get(l, 0.0))
+      if network.iterationLog is not None:
+         network.iterationLog("Sensitivity to %s: %d sweeps, %f seconds" % (name, sweep, time.time() - startTime))
+      return SensitivityResult(name, totalFlows, demands, TSTT, sum(demands), sweep, apply)
+
+   def attractiveness(self, attribute, origins = None, destinations = None):
+      """
+      Derivatives with respect to adding the same amount to attribute (one of
+      the demand function's parameters, e.g. a_rs or a_rn for the relaxed
+      model) for all OD pairs with origin in origins and destination in
+      destinations (None meaning all).
+      """
+      if attribute not in DEMAND_PARAMETERS[self.model]:
+         raise BadNetworkOperationException("%s is not a parameter of %s" % (attribute, self.model))
+      multiplier = self.network.telework_multiplier
+      origins = set(origins) if origins is not None else None
+      destinations = set(destinations) if destinations is not None else None
+
+      def selected(od):
+         return ((origins is None or od.origin in origins)
+                 and (destinations is None or od.destination in destinations))
+
+      def demandTerms(system):
+         mask = [1.0 if selected(od) else 0.0 for od in system.ods]
+         if attribute in ('a_rs', 'a_rsSC'):
+            # the demands depend on a_rs - k_rs, so this is the cost Jacobian applied to -mask
+            weighted = sum(d * m for d, m in zip(system.demands, mask)) / system.totalDemand
+            return [d * (m - weighted) for d, m in zip(system.demands, mask)]
+         if attribute == 'a_rsE':
+            return [c * m for c, m in zip(system.curvatures, mask)]
+         if attribute == 'a_rnE':
+            return [-multiplier * c * m for c, m in zip(system.curvatures, mask)]
+         # a_rn: each OD pair's demand has exp(a_rn * multiplier) in its own denominator
+         share = 1 - sum(system.demands) / system.totalDemand
+         return [-multiplier * d * share * m for d, m in zip(system.demands, mask)]
+
+      def apply(network, delta):
+         for od in network.ODlist:
+            if selected(od):
+               setattr(od, attribute, getattr(od, attribute) + delta)
+
+      name = attribute
+      if origins is not None:
+         name += " (%d origins)" % len(origins)
+      if destinations is not None:
+         name += " (%d destinations)" % len(destinations)
+      return self.solve(name, dict(), demandTerms, apply)
+
+   def capacity(self, links):
+      """
+      Derivatives with respect to adding the same amount to the capacity of
+      each of the given links (IDs or (tail, head) tuples).
+      """
+      network = self.network
+      linkByNodes = dict(((link.tail, link.head), link) for link in network.linkList)
+      selected = list()
+      for key in links:
+         link = network.link.get(key) if key in network.link else linkByNodes.get(key)
+         if link is None:
+            raise BadNetworkOperationException("Unknown link " + str(key))
+         selected.append(link)
+      linkTerms = dict((link.index, link.calculateCapacityDerivative()) for link in selected)
+
+      def apply(network, delta):
+         for link in selected:
+            network.linkList[link.index].capacity += delta
+         network.refreshLinkParameters()
+         for link in selected:
+            network.linkList[link.index].updateCost()
+
+      return self.solve("capacity of %d links" % len(selected), linkTerms, lambda system : [0.0] * len(system.ods),
+                        apply)
+
+def checkSensitivity(network, result, delta, demandFunction = None, teleworkMultiplier = None,
+                     maxIterations = 1000, targetGap = 1e-4, targetGap2 = 1e-2, stepOffset = 10):
+   """
+   Error check of a SensitivityResult against a full solve: changes the
+   parameter by delta, re-solves with a warm-started RELAXEDuserEquilibrium
+   and compares the solution with the first-order prediction, and with the
+   unchanged solution as a baseline.  The network (flows, demands, origin
+   flows and the parameter) is restored afterwards.  Returns a dictionary of
+   errors: root mean square and maximum absolute link flow and OD demand
+   errors, and the relative TSTT error, for the 'prediction' and 'baseline'.
+   """
+   demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+   teleworkMultiplier = teleworkMultiplier if teleworkMultiplier is not None else network.telework_multiplier
+   flows = array('d', [link.flow for link in network.linkList])
+   demands = array('d', [od.demand for od in network.ODlist])
+   saved = (network.TSTT, network.SPTT, network.TMF, network.totalDemand)
+   originFlows = network.originFlows.snapshot() if network.originFlows is not None else None
+   prediction = result.predict(network, delta)
+   baseline = {'linkFlows' : flows, 'demands' : demands, 'TSTT' : network.TSTT}
+
+   result.apply(network, delta)
+   try:
+      network.RELAXEDuserEquilibrium('MSA', maxIterations, targetGap, targetGap2, network.averageExcessCost,
+                                     network.TMFGap, demandFunction, teleworkMultiplier, True, stepOffset)
+      actualFlows = [link.flow for link in network.linkList]
+      actualDemands = [od.demand for od in network.ODlist]
+      actualTSTT = network.TSTT
+   finally:
+      result.apply(network, -delta)
+      for link in network.linkList:
+         link.flow = flows[link.index]
+         link.updateCost()
+      for od in network.ODlist:
+         od.demand = demands[od.index]
+      network.TSTT, network.SPTT, network.TMF, network.totalDemand = saved
+      if originFlows is not None:
+         network.originFlows.restore(originFlows)
+
+   errors = dict()
+   for label, estimate in (('prediction', prediction), ('baseline', baseline)):
+      flowErrors = [abs(a - b) for a, b in zip(actualFlows, estimate['linkFlows'])]
+      demandErrors = [abs(a - b) for a, b in zip(actualDemands, estimate['demands'])]
+      errors[label] = {
+         'linkFlowRMSE' : math.sqrt(sum(e * e for e in flowErrors) / max(len(flowErrors), 1)),
+         'linkFlowMax' : max(flowErrors, default = 0),
+         'demandRMSE' : math.sqrt(sum(e * e for e in demandErrors) / max(len(demandErrors), 1)),
+         'demandMax' : max(demandErrors, default = 0),
+         'TSTTRelative' : abs(actualTSTT - estimate['TSTT']) / actualTSTT if actualTSTT > 0 else 0,
+      }
+      print("%s for %s %+g: link flow RMSE %f (max %f), demand RMSE %f (max %f), TSTT error %.4f%%" % (
+         label, result.name, delta, errors[label]['linkFlowRMSE'], errors[label]['linkFlowMax'],
+         errors[label]['demandRMSE'], errors[label]['demandMax'], 100 * errors[label]['TSTTRelative']))
+   return errors
@@ -0,0 +1,324 @@
+from network import Network, BadNetworkOperationException
+from queries import AssignmentQueries
+from scenario import ScenarioBase, Scenario
+from batch import BadScenarioException
+from skim import openSkims
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import socket
+import threading
+import time
+
+DEMAND_FUNCTIONS = {'relaxed' : 'targetDemandsRelaxed',
+                    'elastic' : 'targetDemandsElastic',
+                    'singly' : 'targetDemandsSinglyConstrained',
+                    'static' : 'targetDemandsStatic'}
+READ_OPERATIONS = ('status', 'skims', 'selectLink', 'selectZone', 'path', 'linkFlows')
+
+class BadRequestException(Exception):
+   """
+   Raised for a service request that is malformed or cannot be answered.
+   """
+   pass
+
+class AssignmentService:
+   """
+   Long-running assignment service: loads a Network once, keeps the latest
+   equilibrium in memory, and answers requests over a Unix socket or TCP
+   port, so that analysts pay for parsing and a cold solve once rather than
+   per question.
+
+   The protocol is JSON lines: each request is one JSON object on a line,
+   with an "op" and optionally an "id" echoed in the response, and each
+   response is one line
+      {"id": ..., "ok": true, "result": ..., "version": n, "cached": false, "time": seconds}
+   or {"id": ..., "ok": false, "error": message}.  Requests on one connection
+   are processed concurrently, so responses may come back out of order.
+   Operations:
+      status                        -- solution summary
+      solve {warm, teleworkMultiplier}
+                                    -- re-solve the current scenario (warm
+                                       from the current solution by default)
+      scenario {name, shifts, teleworkMultiplier, warm}
+                                    -- apply attractiveness shifts relative
+                                       to the base OD table, each
+                                       {"attributes": [...], "value": v,
+                                       "origins": [...], "destinations": [...]}
+                                       (see scenario.py), and re-solve from the
+                                       current solution; no shifts restores
+                                       the base table
+      skims {zones, destinations}   -- shortest path costs between zones
+      selectLink {link, method}     -- demand by OD pair through link [tail, head]
+      selectZone {zone, direction}  -- link flows of trips from or to a zone
+      path {origin, destination}    -- stored path, its cost and demand
+      linkFlows                     -- [tail, head, flow, cost] for all links
+      shutdown                      -- stop the server
+
+   Each solve increments version.  Responses to read operations are cached
+   (cacheSize entries, least recently used dropped) until the next solve.
+   The work runs on a pool of worker threads so the server stays responsive
+   during a solve; operations that use the Network's buffers hold a lock,
+   while tree-based queries (selectLink 'tree', selectZone, path) read the
+   AssignmentQueries of the latest solve and run alongside a solve.
+   """
+
+   def __init__(self, network, demandFunction = None, teleworkMultiplier = 0, workers = 2, cacheSize = 256,
+                **solverArguments):
+      self.network = network
+      self.demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+      self.teleworkMultiplier = teleworkMultiplier
+      self.solverArguments = dict(stepSizeRule = 'MSA', maxIterations = 1000, targetGap = 1e-6, targetGap2 = 1e-2,
+                                  gapFunction = network.averageExcessCost, gapFunction2 = network.TMFGap)
+      self.solverArguments.update(solverArguments)
+      self.base = ScenarioBase(network)
+      self.scenarioName = "base"
+      self.networkLock = threading.Lock()
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+      self.cache = collections.OrderedDict()
+      self.cacheSize = cacheSize
+      self.current = (0, None) # (version, AssignmentQueries of that solution)
+      self.summary = dict()
+      self.server = None
+      self.stopping = None
+      self.connections = set()
+      self.operations = {'status' : self.status, 'solve' : self.solve, 'scenario' : self.scenario,
+                         'skims' : self.skims, 'selectLink' : self.selectLink, 'selectZone' : self.selectZone,
+                         'path' : self.path, 'linkFlows' : self.linkFlows}
+
+   def runSolve(self, warm, teleworkMultiplier = None):
+      """
+      Solves the network (holding the network lock) and publishes the new
+      solution: version, summary and the AssignmentQueries for it.
+      """
+      network = self.network
+      if teleworkMultiplier is not None:
+         self.teleworkMultiplier = teleworkMultiplier
+      result = network.solve(demandFunction = self.demandFunction, teleworkMultiplier = self.teleworkMultiplier,
+                             warmStart = warm, stepOffset = 10 if warm else 0, **self.solverArguments)
+      queries = AssignmentQueries(network)
+      version = self.current[0] + 1
+      gap, gap2 = result.gap() if result.gap() is not None else (0, 0)
+      self.summary = {'scenario' : self.scenarioName, 'warm' : warm, 'teleworkMultiplier' : self.teleworkMultiplier,
+                      'iterations' : result.iterations, 'gap' : gap, 'gap2' : gap2, 'stopReason' : result.stopReason,
+                      'TSTT' : network.TSTT, 'totalDemand' : network.totalDemand, 'solveTime' : result.solveTime}
+      self.current = (version, queries)
+      return (version, dict(self.summary))
+
+   def status(self, request):
+      version = self.current[0]
+      return (version, dict(self.summary, version = version, zones = self.network.numZones))
+
+   def solve(self, request):
+      with self.networkLock:
+         return self.runSolve(request.get('warm', self.current[1] is not None), request.get('teleworkMultiplier'))
+
+   def scenario(self, request):
+      scenario = Scenario(self.base, request.get('name', 'request'))
+      for shift in request.get('shifts', list()):
+         if 'attributes' not in shift or 'value' not in shift:
+            raise BadRequestException("A shift needs attributes and value")
+         mask = None
+         if 'origins' in shift or 'destinations' in shift:
+            mask = self.base.mask(shift.get('origins'), shift.get('destinations'))
+         scenario.shift(shift['attributes'], float(shift['value']), mask)
+      with self.networkLock:
+         scenario.apply(self.network)
+         self.scenarioName = scenario.name
+         return self.runSolve(request.get('warm', self.current[1] is not None), request.get('teleworkMultiplier'))
+
+   def skims(self, request):
+      network = self.network
+      zones = request.get('zones', list(range(1, network.numZones + 1)))
+      destinations = request.get('destinations', zones)
+      for zone in list(zones) + list(destinations):
+         if zone not in network.node:
+            raise BadRequestException("Unknown zone " + str(zone))
+      with self.networkLock:
+         version = self.current[0]
+         skims = network.currentSkims()
+         costs = list()
+         for zone in zones:
+            cost = network.originCostLabels(zone, skims)
+            costs.append([cost[destination] for destination in destinations])
+      return (version, {'zones' : zones, 'destinations' : destinations, 'costs' : costs})
+
+   def currentQueries(self):
+      version, queries = self.current
+      if queries is None:
+         raise BadRequestException("No solution yet")
+      return (version, queries)
+
+   def selectLink(self, request):
+      if 'link' not in request:
+         raise BadRequestException("selectLink needs a link")
+      method = request.get('method', 'tree')
+      if method == 'tree':
+         version, queries = self.currentQueries()
+         return (version, queries.selectLink(tuple(request['link']), method))
+      with self.networkLock:
+         version, queries = self.currentQueries()
+         return (version, queries.selectLink(tuple(request['link']), method))
+
+   def selectZone(self, request):
+      if 'zone' not in request:
+         raise BadRequestException("selectZone needs a zone")
+      version, queries = self.currentQueries()
+      flows = queries.selectZone(request['zone'], request.get('direction', 'origin'))
+      return (version, [[self.network.link[ID].tail, self.network.link[ID].head, flow] for ID, flow in sorted(flows.items())])
+
+   def path(self, request):
+      version, queries = self.currentQueries()
+      origin = request.get('origin')
+      destination = request.get('destination')
+      od = queries.odByNodes.get((origin, destination))
+      return (version, {'nodes' : queries.pathNodes(origin, destination),
+                        'cost' : queries.pathCost(origin, destination),
+                        'demand' : queries.demands[od.index] if od is not None else 0})
+
+   def linkFlows(self, request):
+      with self.networkLock:
+         version = self.current[0]
+         return (version, [[link.tail, link.head, link.flow, link.cost] for link in self.network.linkList])
+
+   async def dispatch(self, line):
+      """
+      Parses and answers one request line, returning the response object.
+      """
+      startTime = time.time()
+      requestID = None
+      try:
+         request = json.loads(line)
+         if not isinstance(request, dict) or 'op' not in request:
+            raise BadRequestException("A request is a JSON object with an op")
+         requestID = request.get('id')
+         op = request['op']
+         if op == 'shutdown':
+            if self.stopping is not None:
+               self.stopping.set()
+            return {'id' : requestID, 'ok' : True, 'result' : None}
+         if op not in self.operations:
+            raise BadRequestException("Unknown op " + str(op))
+         key = None
+         if op in READ_OPERATIONS and op != 'status':
+            key = (self.current[0], json.dumps(dict((k, v) for k, v in request.items() if k != 'id'), sort_keys = True))
+            if key in self.cache:
+               self.cache.move_to_end(key)
+               version, result = self.cache[key]
+               return {'id' : requestID, 'ok' : True, 'result' : result, 'version' : version, 'cached' : True,
+                       'time' : time.time() - startTime}
+         loop = asyncio.get_running_loop()
+         version, result = await loop.run_in_executor(self.executor, self.operations[op], request)
+         if op not in READ_OPERATIONS:
+            self.cache.clear()
+         elif key is not None and version == key[0]:
+            self.cache[key] = (version, result)
+            if len(self.cache) > self.cacheSize:
+               self.cache.popitem(last = False)
+         return {'id' : requestID, 'ok' : True, 'result' : result, 'version' : version, 'cached' : False,
+                 'time' : time.time() - startTime}
+      except (ValueError, KeyError, TypeError, BadRequestException, BadNetworkOperationException,
+              BadScenarioException) as e:
+         return {'id' : requestID, 'ok' : False, 'error' : "%s: %s" % (type(e).__name__, e)}
+
+   async def handle(self, reader, writer):
+      self.connections.add(asyncio.current_task())
+      writeLock = asyncio.Lock()
+      pending = set()
+      async def respond(line):
+         response = await self.dispatch(line)
+         async with writeLock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+      while True:
+         line = await reader.readline()
+         if not line:
+            break
+         if len(line.strip()) == 0:
+            continue
+         task = asyncio.ensure_future(respond(line))
+         pending.add(task)
+         task.add_done_callback(pending.discard)
+      if len(pending) > 0:
+         await asyncio.gather(*pending)
+      writer.close()
+      self.connections.discard(asyncio.current_task())
+
+   async def serve(self, socketPath = None, host = '127.0.0.1', port = 8765):
+      """
+      Serves requests on the Unix socket socketPath, or on host:port if it is
+      None, until a shutdown request.
+      """
+      self.stopping = asyncio.Event()
+      if socketPath is not None:
+         self.server = await asyncio.start_unix_server(self.handle, path = socketPath)
+         print("Serving on %s" % socketPath)
+      else:
+         self.server = await asyncio.start_server(self.handle, host, port)
+         print("Serving on %s:%d" % (host, port))
+      try:
+         await self.stopping.wait()
+         self.server.close()
+         await self.server.wait_closed()
+         if len(self.connections) > 0:
+            await asyncio.wait(self.connections, timeout = 5)
+      finally:
+         self.executor.shutdown(wait = True)
+         if socketPath is not None and os.path.exists(socketPath):
+            os.unlink(socketPath)
+      print("Service stopped")
+
+def request(message, socketPath = None, host = '127.0.0.1', port = 8765):
+   """
+   Sends one request (a dictionary) to a running service and returns the
+   response, for scripts and notebooks.
+   """
+   if socketPath is not None:
+      connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      connection.connect(socketPath)
+   else:
+      connection = socket.create_connection((host, port))
+   with connection:
+      connection.sendall((json.dumps(message) + "\n").encode())
+      with connection.makefile('r') as responses:
+         return json.loads(responses.readline())
+
+def main(arguments = None):
+   parser = argparse.ArgumentParser(description = "Resident traffic assignment service")
+   parser.add_argument('network', help = "TNTP network file")
+   parser.add_argument('demand', help = "TNTP trips file")
+   parser.add_argument('--nodes', help = "node file (see Network.readNodeFile)")
+   parser.add_argument('--attributes', help = "attractiveness file (see Network.readODFile)")
+   parser.add_argument('--skims', help = "skim file to attach (see skim.py)")
+   parser.add_argument('--model', choices = sorted(DEMAND_FUNCTIONS), default = 'relaxed')
+   parser.add_argument('--telework', type = float, default = 1.0, help = "telework multiplier")
+   parser.add_argument('--step-size-rule', default = 'MSA')
+   parser.add_argument('--max-iterations', type = int, default = 1000)
+   parser.add_argument('--target-gap', type = float, default = 1e-6)
+   parser.add_argument('--target-gap2', type = float, default = 1e-2)
+   parser.add_argument('--workers', type = int, default = 2)
+   parser.add_argument('--socket', help = "Unix socket path; otherwise TCP on --host and --port")
+   parser.add_argument('--host', default = '127.0.0.1')
+   parser.add_argument('--port', type = int, default = 8765)
+   options = parser.parse_args(arguments)
+
+   network = Network(options.network, options.demand)
+   if options.nodes is not None:
+      network.readNodeFile(options.nodes)
+   if options.attributes is not None:
+      network.readODFile(options.attributes)
+   if options.skims is not None:
+      network.attachSkims(openSkims(options.skims, network))
+   service = AssignmentService(network, getattr(network, DEMAND_FUNCTIONS[options.model]), options.telework,
+                               options.workers, stepSizeRule = options.step_size_rule,
+                               maxIterations = options.max_iterations, targetGap = options.target_gap,
+                               targetGap2 = options.target_gap2)
+   service.runSolve(False)
+   asyncio.run(service.serve(options.socket, options.host, options.port))
+
+if __name__ == '__main__':
+   main()
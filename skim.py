@@ -0,0 +1,196 @@
+from array import array
+
+import json
+import mmap
+import os
+import sys
+import time
+
+SKIM_MAGIC = "TAPSKIM1"
+HEADER_SIZE = 4096 # bytes reserved for the JSON metadata at the start of the file
+LAYERS = ('time', 'length')
+
+class BadSkimException(Exception):
+   """
+   Raised when a skim file is malformed, or does not match the network or the
+   request made of it.
+   """
+   pass
+
+class SkimMatrix:
+   """
+   Zone-to-zone skim matrices stored in a binary file and memory-mapped, so
+   that the shortest path costs of a solved network can be reused (by
+   Network.updateSkims, the demand functions and downstream analysis) without
+   running shortest paths again, and so that several processes can map one
+   skim file read-only and share its pages.
+
+   The file starts with a HEADER_SIZE-byte JSON header holding the metadata:
+      numZones   -- zones are nodes 1..numZones, as in the network file
+      layers     -- the stored quantities, in file order; 'time' is the
+                    shortest path cost (k_rs) and 'length' the length of that
+                    same path
+      costState  -- Network.costState() of the link costs the skims were
+                    computed at
+      network, created, byteorder, typecode
+   followed by one (numZones+1) x (numZones+1) row-major matrix per layer, of
+   doubles or (for a network in single precision, see Network.setPrecision)
+   32-bit floats, as recorded by typecode.  Row and column 0 are unused so
+   that, like the network's label buffers, the matrices are indexed directly
+   by node ID: row(origin) can be used wherever a costLabels buffer would be
+   for zone destinations.
+   """
+
+   def __init__(self, fileName):
+      self.fileName = fileName
+      with open(fileName, 'rb') as f:
+         header = f.read(HEADER_SIZE)
+      try:
+         self.metadata = json.loads(header.decode('ascii').strip())
+      except ValueError:
+         raise BadSkimException("%s is not a skim file" % fileName)
+      if self.metadata.get('magic') != SKIM_MAGIC:
+         raise BadSkimException("%s is not a skim file" % fileName)
+      if self.metadata['byteorder'] != sys.byteorder:
+         raise BadSkimException("Skim file %s was written on a %s-endian machine" % (fileName, self.metadata['byteorder']))
+      self.numZones = self.metadata['numZones']
+      self.layers = tuple(self.metadata['layers'])
+      self.costState = self.metadata['costState']
+      self.width = self.numZones + 1
+
+      self.file = open(fileName, 'rb')
+      self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+      layerSize = self.width * self.width
+      itemSize = array(self.metadata['typecode']).itemsize
+      if len(self.map) != HEADER_SIZE + itemSize * layerSize * len(self.layers):
+         self.close()
+         raise BadSkimException("Skim file %s is truncated" % fileName)
+      values = memoryview(self.map)[HEADER_SIZE:].cast(self.metadata['typecode'])
+      self.matrices = dict()
+      for position, layer in enumerate(self.layers):
+         self.matrices[layer] = values[position * layerSize : (position + 1) * layerSize]
+      self.values = values
+
+   def row(self, origin, layer = 'time'):
+      """
+      The skims from origin to every zone, indexed by destination node ID.
+      """
+      if layer not in self.matrices:
+         raise BadSkimException("Skim file %s has no %s layer" % (self.fileName, layer))
+      return self.matrices[layer][origin * self.width : (origin + 1) * self.width]
+
+   def cost(self, origin, destination, layer = 'time'):
+      return self.matrices[layer][origin * self.width + destination]
+
+   def isCurrent(self, network):
+      """
+      True if the skims were computed at the network's current link costs.
+      """
+      return network.costState() == self.costState
+
+   def close(self):
+      """
+      Releases the mapping.  Rows returned by row() are views into the
+      mapping, so they must have been dropped (or released) first.
+      """
+      if self.map is None:
+         return
+      if hasattr(self, 'values'):
+         for matrix in self.matrices.values():
+            matrix.release()
+         self.values.release()
+      try:
+         self.map.close()
+      except BufferError:
+         raise BadSkimException("Rows of skim file %s are still in use" % self.fileName)
+      self.file.close()
+      self.map = None
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, excType, excValue, excTraceback):
+      self.close()
+      return False
+
+def writeSkims(network, fileName, layers = ('time',)):
+   """
+   Computes the skims of the network at its current link costs and writes
+   them to fileName (see SkimMatrix for the format).  One shortest path tree
+   is built per zone; the 'length' layer, if requested, accumulates link
+   lengths along the same least-cost tree rather than finding shortest
+   distance paths.  Unreachable zones get utils.INFINITY in both layers.
+   Returns the SkimMatrix, mapped read-only.
+   """
+   for layer in layers:
+      if layer not in LAYERS:
+         raise BadSkimException("Unknown skim layer " + str(layer))
+   numZones = network.numZones
+   width = numZones + 1
+   metadata = {
+      'magic' : SKIM_MAGIC,
+      'network' : network.name,
+      'numZones' : numZones,
+      'layers' : list(layers),
+      'costState' : network.costState(),
+      'created' : time.strftime("%Y-%m-%d %H:%M:%S"),
+      'byteorder' : sys.byteorder,
+      'typecode' : network.storageType,
+   }
+   header = json.dumps(metadata).encode('ascii')
+   if len(header) >= HEADER_SIZE:
+      raise BadSkimException("Skim metadata too long")
+
+   typecode = network.storageType
+   blankRow = array(typecode, [network.blankCostLabels[0]]) * width
+   linkLengths = array('d', [link.length for link in network.linkList])
+   lengthRow = array(typecode, blankRow)
+   distance = network.nodeLoads # scratch node buffer, zero between uses
+   order = network.settledOrder
+   rowBytes = blankRow.itemsize * width
+   layerBytes = rowBytes * width
+   # Write to a temporary name and rename, so processes that have the old
+   # skim file mapped keep a consistent view.
+   temporaryName = fileName + ".tmp"
+   with open(temporaryName, 'wb') as f:
+      f.write(header.ljust(HEADER_SIZE))
+      f.truncate(HEADER_SIZE + layerBytes * len(layers))
+      for origin in range(width):
+         if origin == 0 or origin not in network.node:
+            rows = dict((layer, blankRow) for layer in layers)
+         else:
+            cost, backlink = network.shortestPathLabels(origin)
+            rows = {'time' : cost[0:width] if typecode == 'd' else array(typecode, cost[0:width])}
+            if 'length' in layers:
+               lengthRow[:] = blankRow
+               lengthRow[origin] = 0
+               for position in range(1, network.numSettled):
+                  n = order[position]
+                  l = backlink[n]
+                  distance[n] = distance[network.linkTail[l]] + linkLengths[l]
+                  if n < width:
+                     lengthRow[n] = distance[n]
+               for position in range(network.numSettled):
+                  distance[order[position]] = 0
+               rows['length'] = lengthRow
+         for position, layer in enumerate(layers):
+            f.seek(HEADER_SIZE + position * layerBytes + origin * rowBytes)
+            rows[layer].tofile(f)
+   os.replace(temporaryName, fileName)
+   print("Skims %s written to %s" % (", ".join(layers), fileName))
+   return SkimMatrix(fileName)
+
+def openSkims(fileName, network = None):
+   """
+   Maps an existing skim file read-only.  If a network is given, the file
+   must have the network's zone count, and a warning is printed if the skims
+   were computed at different link costs from the network's current ones.
+   """
+   skims = SkimMatrix(fileName)
+   if network is not None:
+      if skims.numZones != network.numZones:
+         skims.close()
+         raise BadSkimException("Skim file %s has %d zones, network has %d" % (fileName, skims.numZones, network.numZones))
+      if not skims.isCurrent(network):
+         print("Warning: skims in %s were computed at different link costs" % fileName)
+   return skims
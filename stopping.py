@@ -0,0 +1,155 @@
+from array import array
+
+import math
+
+class StoppingPolicy:
+   """
+   Optional stopping rules for the iterative solvers, on top of
+   maxIterations and the gap targets, and tracking of the best iterate.
+   Pass one as the stoppingPolicy argument of RELAXEDuserEquilibrium,
+   userEquilibrium or gaussSeidelEquilibrium:
+      timeBudget         -- stop after this many seconds
+      stallIterations    -- stop if the best combined gap has not improved by
+                            a factor (1 - stallTolerance) for this many
+                            iterations
+      projectedTimeLimit -- stop if, extrapolating the combined gap of the
+                            last projectionWindow iterations (log-linear fit
+                            against time), the solve would not reach its
+                            targets within this many seconds in total
+      trackBest          -- keep a copy of the iterate with the lowest combined
+                            gap and restore it when the solver stops, so a run
+                            cut short returns the best solution seen rather
+                            than the last one (MSA gaps are not monotone)
+   The combined gap is max(gap / targetGap, gap2 / targetGap2), which is
+   below 1 exactly when both targets are met; pass combine(gap, gap2) to use
+   another measure.  Rules left as None are not applied.
+
+   After the solve network.stopReason is one of 'converged',
+   'maxIterations', 'timeBudget', 'stalled', 'projected' or 'callback' (see
+   the solvers' callback argument), and
+   bestIteration / bestGap describe the iterate the network was left in.
+   """
+
+   def __init__(self, timeBudget = None, stallIterations = None, stallTolerance = 0.01,
+                projectedTimeLimit = None, projectionWindow = 20, trackBest = True, combine = None):
+      self.timeBudget = timeBudget
+      self.stallIterations = stallIterations
+      self.stallTolerance = stallTolerance
+      self.projectedTimeLimit = projectedTimeLimit
+      self.projectionWindow = projectionWindow
+      self.trackBest = trackBest
+      self.combine = combine
+
+   def start(self, network, targetGap, targetGap2 = None):
+      """
+      Called by the solver before its first iteration.
+      """
+      self.targetGap = targetGap
+      self.targetGap2 = targetGap2
+      self.history = list()
+      self.bestGap = math.inf
+      self.bestIteration = 0
+      self.lastImprovement = 0
+      self.latestIteration = 0
+      self.bestFlows = None
+      self.bestDemands = None
+      self.bestTotals = None
+      self.bestOriginFlows = None
+      network.stopReason = 'maxIterations'
+
+   def combinedGap(self, gap, gap2):
+      if self.combine is not None:
+         return self.combine(gap, gap2)
+      combined = gap / self.targetGap if self.targetGap > 0 else gap
+      if self.targetGap2 is not None:
+         combined = max(combined, gap2 / self.targetGap2 if self.targetGap2 > 0 else gap2)
+      return combined
+
+   def check(self, network, iteration, gap, gap2, elapsed):
+      """
+      Called by the solver each iteration once the gaps of the current
+      iterate are known.  Records the iterate if it is the best so far and
+      returns the reason to stop, or None to continue.
+      """
+      combined = self.combinedGap(gap, gap2)
+      self.history.append((elapsed, combined))
+      self.latestIteration = iteration
+      if combined < self.bestGap:
+         if combined < self.bestGap * (1 - self.stallTolerance):
+            self.lastImprovement = iteration
+         self.bestGap = combined
+         self.bestIteration = iteration
+         if self.trackBest:
+            self.snapshot(network)
+
+      if self.timeBudget is not None and elapsed >= self.timeBudget:
+         return 'timeBudget'
+      if self.stallIterations is not None and iteration - self.lastImprovement >= self.stallIterations:
+         return 'stalled'
+      if self.projectedTimeLimit is not None and self.projectedTime() > self.projectedTimeLimit:
+         return 'projected'
+      return None
+
+   def projectedTime(self):
+      """
+      Projected total time to reach a combined gap of 1, from a least
+      squares fit of log(combined gap) against time over the last
+      projectionWindow iterations; infinite if the gap is not falling, and 0
+      until the window has filled.
+      """
+      if len(self.history) < self.projectionWindow:
+         return 0
+      window = [(t, math.log(g)) for t, g in self.history[-self.projectionWindow:] if g > 0]
+      if len(window) < 2:
+         return 0
+      meanTime = sum(t for t, g in window) / len(window)
+      meanLog = sum(g for t, g in window) / len(window)
+      variance = sum((t - meanTime) ** 2 for t, g in window)
+      if variance <= 0:
+         return 0
+      slope = sum((t - meanTime) * (g - meanLog) for t, g in window) / variance
+      if slope >= 0:
+         return math.inf
+      latestTime, latestLog = window[-1]
+      return latestTime + max(latestLog, 0) / -slope
+
+   def snapshot(self, network):
+      flows = array('d', [link.flow for link in network.linkList])
+      demands = array('d', [od.demand for od in network.ODlist])
+      self.bestFlows = flows
+      self.bestDemands = demands
+      self.bestTotals = (network.SPTT, network.TMF)
+      if network.originFlows is not None:
+         self.bestOriginFlows = network.originFlows.snapshot()
+
+   def finish(self, network, reason = None, moved = False):
+      """
+      Called by the solver when it stops (reason None meaning it ran out of
+      iterations); restores the best iterate if it is not the one the network
+      holds.  moved means the solver has shifted the flows since the last
+      check, so the network holds an iterate whose gap was never measured.
+      Returns whether the flows were restored.
+      """
+      if reason is not None:
+         network.stopReason = reason
+      if not self.trackBest or self.bestFlows is None:
+         return False
+      if self.bestIteration == self.latestIteration and not moved:
+         return False
+      network.TSTT = 0
+      for link in network.linkList:
+         link.flow = self.bestFlows[link.index]
+         link.updateCost()
+         network.TSTT += link.flow * link.cost
+      network.totalDemand = 0
+      for od in network.ODlist:
+         od.demand = self.bestDemands[od.index]
+         network.totalDemand += od.demand
+      network.SPTT, network.TMF = self.bestTotals
+      if self.bestOriginFlows is not None:
+         network.originFlows.restore(self.bestOriginFlows)
+      network.refreshLinkCosts()
+      if network.iterationLog is not None:
+         network.iterationLog("Stopped (%s) at iteration %d; restored iteration %d with combined gap %f" % (
+            network.stopReason, self.latestIteration, self.bestIteration, self.bestGap))
+      return True
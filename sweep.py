@@ -0,0 +1,109 @@
+import time
+
+class SweepStep:
+   """
+   Record of one solve in a parameter sweep: the parameter value, whether the
+   solve was warm-started, the iterations and wall-clock time it took, and the
+   final gaps and network-wide totals.
+   """
+
+   def __init__(self, value, warm, iterations, solveTime, gap, gap2, TSTT, TMF, totalDemand):
+      self.value = value
+      self.warm = warm
+      self.iterations = iterations
+      self.solveTime = solveTime
+      self.gap = gap
+      self.gap2 = gap2
+      self.TSTT = TSTT
+      self.TMF = TMF
+      self.totalDemand = totalDemand
+
+   def __str__(self):
+      return "%s\t%s\t%d\t%f\t%f\t%f\t%f\t%f" % (self.value, "warm" if self.warm else "cold", self.iterations,
+                                                 self.solveTime, self.gap, self.gap2, self.TSTT, self.totalDemand)
+
+def parameterSweep(network, values, applyParameter, stepSizeRule = 'MSA', maxIterations = 1000,
+                   targetGap = 1e-6, targetGap2 = 1e-2, gapFunction = None, gapFunction2 = None,
+                   demandFunction = None, teleworkMultiplier = 0, stepOffset = 10, onStep = None):
+   """
+   Solves network.RELAXEDuserEquilibrium for each parameter value in turn,
+   ordering the values along the parameter path (ascending) and starting each
+   solve from the previous solution's link flows and demands instead of
+   reset().  Only the first value is solved cold.
+
+   applyParameter(network, value) must put the network in the state for that
+   value (for instance set attractiveness parameters) and may return the
+   telework multiplier to use; if it returns None, teleworkMultiplier is used.
+   onStep(network, step), if given, is called after each solve while the
+   network holds that solution, e.g. to call printResults.  The other
+   arguments are passed to RELAXEDuserEquilibrium; stepOffset is only used
+   for the warm-started solves.
+
+   Returns the list of SweepStep records, in the order solved.
+   """
+   gapFunction = gapFunction if gapFunction is not None else network.averageExcessCost
+   gapFunction2 = gapFunction2 if gapFunction2 is not None else network.TMFGap
+   demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+
+   steps = list()
+   for value in sorted(values):
+      multiplier = applyParameter(network, value)
+      if multiplier is None:
+         multiplier = teleworkMultiplier
+      warm = len(steps) > 0
+      startTime = time.time()
+      network.RELAXEDuserEquilibrium(stepSizeRule, maxIterations, targetGap, targetGap2, gapFunction,
+                                     gapFunction2, demandFunction, multiplier, warm, stepOffset if warm else 0)
+      iteration, gap, gap2, elapsed = network.convergenceHistory[-1]
+      step = SweepStep(value, warm, network.iterations, time.time() - startTime, gap, gap2,
+                       network.TSTT, network.TMF, network.totalDemand)
+      steps.append(step)
+      if network.iterationLog is not None:
+         network.iterationLog("Sweep value %s: %s start, %d iterations, %f seconds"
+                              % (value, "warm" if warm else "cold", step.iterations, step.solveTime))
+      if onStep is not None:
+         onStep(network, step)
+   return steps
+
+def teleworkSweep(network, multipliers, **solverArguments):
+   """
+   Sweep over telework multipliers, e.g. teleworkSweep(net, [0.5, 1.0, 1.5],
+   demandFunction = net.targetDemandsElastic).
+   """
+   return parameterSweep(network, multipliers, lambda network, value : value, **solverArguments)
+
+def attractivenessSweep(network, shifts, attributes = ('a_rn', 'a_rnE'), **solverArguments):
+   """
+   Sweep over constant shifts of OD attractiveness attributes, as in scenario
+   family S1 of Scenarios.R (a_rn and a_rnE + 5, 10, 15 and - 5):
+      attractivenessSweep(net, [-5, 5, 10, 15], demandFunction = net.targetDemandsElastic,
+                          teleworkMultiplier = 1.0)
+   Each shift is applied to the base values present when the sweep starts,
+   and the base values are restored afterwards.
+   """
+   base = dict()
+   for attribute in attributes:
+      base[attribute] = [getattr(od, attribute) for od in network.ODlist]
+
+   def applyShift(network, value):
+      for attribute in attributes:
+         for od, baseValue in zip(network.ODlist, base[attribute]):
+            setattr(od, attribute, baseValue + value)
+      return None
+
+   try:
+      return parameterSweep(network, shifts, applyShift, **solverArguments)
+   finally:
+      for attribute in attributes:
+         for od, baseValue in zip(network.ODlist, base[attribute]):
+            setattr(od, attribute, baseValue)
+
+def printSweep(steps, fileName):
+   """
+   Writes the SweepStep records to a tab-separated text file.
+   """
+   with open(fileName, 'w') as f:
+      f.write("Value\tStart\tIterations\tTime\tGap\tGap2\tTSTT\tTotal_Demand\n")
+      for step in steps:
+         f.write(str(step) + "\n")
+   print(f"Sweep results written to {fileName}")
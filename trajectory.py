@@ -0,0 +1,325 @@
+from array import array
+
+import hashlib
+import json
+import math
+import mmap
+import sys
+import time
+
+TRAJECTORY_MAGIC = "TAPTRAJ1"
+HEADER_SIZE = 4096 # bytes reserved for the JSON metadata at the start of the file
+FIELDS = ('flow', 'cost', 'demand')
+INDEX_FIELDS = ('iteration', 'gap', 'gap2', 'stepSize', 'elapsed')
+
+class BadTrajectoryException(Exception):
+   """
+   Raised when a trajectory file is malformed, does not match the network,
+   or is asked for a snapshot or field it does not hold.
+   """
+   pass
+
+def orderFingerprint(IDs):
+   """
+   Hash of a sequence of link or OD IDs, identifying the positions
+   (link.index, OD.index) the snapshots are indexed by.
+   """
+   return hashlib.sha1("\n".join(str(ID) for ID in IDs).encode('utf-8')).hexdigest()
+
+def sidecarName(fileName):
+   return fileName + ".idx"
+
+class TrajectoryRecorder:
+   """
+   Records snapshots of a solve, every every-th iteration, into a trajectory
+   file (see Trajectory for the format) preallocated for maxSnapshots
+   snapshots of the given fields:
+      flow   -- link flows, indexed by link.index
+      cost   -- link costs, indexed by link.index
+      demand -- OD demands, indexed by OD.index, in the network's storage
+                precision (see Network.setPrecision)
+   Network.recordTrajectory attaches one to the network; the solvers then
+   call record once the gaps of an iteration are known, before the
+   convergence test, so the last iterate of a converged solve is recorded
+   when its iteration number is a multiple of every.  The step size stored
+   with a snapshot is the one of the move that produced it (nan after a
+   reset).  Snapshots go straight into the mapped file, so recording costs
+   a copy of the arrays and no formatting; once the file is full, further
+   snapshots are dropped.
+   """
+
+   def __init__(self, network, fileName, every = 1, maxSnapshots = 100, fields = FIELDS):
+      if every < 1 or maxSnapshots < 1:
+         raise BadTrajectoryException("Need every >= 1 and maxSnapshots >= 1")
+      for field in fields:
+         if field not in FIELDS:
+            raise BadTrajectoryException("Unknown trajectory field " + str(field))
+      self.network = network
+      self.fileName = fileName
+      self.every = every
+      self.capacity = maxSnapshots
+      self.fields = tuple(fields)
+      self.count = 0
+      numLinks = len(network.linkList)
+      numODs = len(network.ODlist)
+      typecodes = {'flow' : 'd', 'cost' : 'd', 'demand' : network.storageType}
+      metadata = {
+         'magic' : TRAJECTORY_MAGIC,
+         'network' : network.name,
+         'numLinks' : numLinks,
+         'numODs' : numODs,
+         'linkOrder' : orderFingerprint(link.ID for link in network.linkList),
+         'ODOrder' : orderFingerprint(od.ID for od in network.ODlist),
+         'fields' : list(self.fields),
+         'typecodes' : dict((field, typecodes[field]) for field in self.fields),
+         'capacity' : maxSnapshots,
+         'every' : every,
+         'created' : time.strftime("%Y-%m-%d %H:%M:%S"),
+         'byteorder' : sys.byteorder,
+      }
+      header = json.dumps(metadata).encode('ascii')
+      if len(header) >= HEADER_SIZE:
+         raise BadTrajectoryException("Trajectory metadata too long")
+      layout = fieldLayout(metadata)
+
+      with open(fileName, 'wb') as f:
+         f.write(header.ljust(HEADER_SIZE))
+         f.truncate(layout['end'])
+      with open(sidecarName(fileName), 'wb'):
+         pass
+      self.file = open(fileName, 'r+b')
+      self.map = mmap.mmap(self.file.fileno(), 0)
+      self.blocks = dict()
+      for field in self.fields:
+         offset, size = layout[field]
+         self.blocks[field] = (memoryview(self.map)[offset : offset + size * maxSnapshots
+                                                     * array(typecodes[field]).itemsize].cast(typecodes[field]), size)
+      self.index = open(sidecarName(fileName), 'ab')
+
+   def record(self, network, iteration, gap, gap2, elapsed):
+      if iteration % self.every != 0 or self.map is None:
+         return
+      if self.count == self.capacity:
+         if network.iterationLog is not None:
+            network.iterationLog("Trajectory file %s is full (%d snapshots); iteration %d not recorded"
+                                 % (self.fileName, self.capacity, iteration))
+         self.count += 1
+         return
+      if self.count > self.capacity:
+         return
+      for field in self.fields:
+         block, size = self.blocks[field]
+         if field == 'flow':
+            values = network.currentFlows()
+         elif field == 'cost':
+            values = array('d', [link.cost for link in network.linkList])
+         else:
+            values = network.currentDemands()
+         block[self.count * size : (self.count + 1) * size] = values
+      stepSize = network.lastStepSize if network.lastStepSize is not None else math.nan
+      # The index record is written last: readers only use snapshots it lists
+      array('d', [iteration, gap, gap2, stepSize, elapsed]).tofile(self.index)
+      self.index.flush()
+      self.count += 1
+
+   def close(self):
+      if self.map is None:
+         return
+      for block, size in self.blocks.values():
+         block.release()
+      self.map.flush()
+      self.map.close()
+      self.file.close()
+      self.index.close()
+      self.map = None
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, excType, excValue, excTraceback):
+      self.close()
+      return False
+
+def fieldLayout(metadata):
+   """
+   Byte offset and row length of each field's block (capacity rows, one
+   per snapshot), and the file size; blocks start on 8-byte boundaries.
+   """
+   sizes = {'flow' : metadata['numLinks'], 'cost' : metadata['numLinks'], 'demand' : metadata['numODs']}
+   layout = dict()
+   offset = HEADER_SIZE
+   for field in metadata['fields']:
+      layout[field] = (offset, sizes[field])
+      offset += sizes[field] * array(metadata['typecodes'][field]).itemsize * metadata['capacity']
+      offset += -offset % 8
+   layout['end'] = offset
+   return layout
+
+class Trajectory:
+   """
+   Read-only view of a trajectory file written by TrajectoryRecorder.  The
+   file starts with a HEADER_SIZE-byte JSON header:
+      numLinks, numODs -- row lengths of the link and OD fields
+      linkOrder, ODOrder -- fingerprints of the link and OD IDs in index
+                    order (see matches)
+      fields, typecodes -- the stored fields, in file order, and their
+                    array typecodes
+      capacity, every -- snapshots preallocated, iterations between them
+      network, created, byteorder
+   followed by one block per field of capacity rows, row k holding
+   snapshot k.  The sidecar file (name + ".idx") holds one record of
+   doubles per written snapshot, INDEX_FIELDS, and only snapshots it lists
+   are read, so a file can be opened while the solve is still running
+   (refresh picks up new snapshots).
+
+   The file is memory-mapped: snapshot returns a row and series the values
+   of one link or OD pair across snapshots, both as memoryviews into the
+   mapping, so only the pages touched are read.  The index is loaded into
+   the arrays iterations, gaps, gap2s, stepSizes and elapsed.
+   """
+
+   def __init__(self, fileName):
+      self.fileName = fileName
+      with open(fileName, 'rb') as f:
+         header = f.read(HEADER_SIZE)
+      try:
+         self.metadata = json.loads(header.decode('ascii').strip())
+      except ValueError:
+         raise BadTrajectoryException("%s is not a trajectory file" % fileName)
+      if self.metadata.get('magic') != TRAJECTORY_MAGIC:
+         raise BadTrajectoryException("%s is not a trajectory file" % fileName)
+      if self.metadata['byteorder'] != sys.byteorder:
+         raise BadTrajectoryException("Trajectory file %s was written on a %s-endian machine"
+                                      % (fileName, self.metadata['byteorder']))
+      self.fields = tuple(self.metadata['fields'])
+      self.capacity = self.metadata['capacity']
+      layout = fieldLayout(self.metadata)
+
+      self.file = open(fileName, 'rb')
+      self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+      if len(self.map) != layout['end']:
+         self.close()
+         raise BadTrajectoryException("Trajectory file %s is truncated" % fileName)
+      self.blocks = dict()
+      for field in self.fields:
+         offset, size = layout[field]
+         typecode = self.metadata['typecodes'][field]
+         self.blocks[field] = (memoryview(self.map)[offset : offset + size * self.capacity
+                                                     * array(typecode).itemsize].cast(typecode), size)
+      self.refresh()
+
+   def refresh(self):
+      """
+      Rereads the index, e.g. to see the snapshots added by a running solve.
+      """
+      records = array('d')
+      with open(sidecarName(self.fileName), 'rb') as f:
+         data = f.read()
+      recordSize = records.itemsize * len(INDEX_FIELDS)
+      records.frombytes(data[: len(data) - len(data) % recordSize])
+      self.count = min(len(records) // len(INDEX_FIELDS), self.capacity)
+      columns = [records[i : self.count * len(INDEX_FIELDS) : len(INDEX_FIELDS)] for i in range(len(INDEX_FIELDS))]
+      self.iterations = array('i', [int(iteration) for iteration in columns[0]])
+      self.gaps, self.gap2s, self.stepSizes, self.elapsed = columns[1:]
+
+   def __len__(self):
+      return self.count
+
+   def matches(self, network):
+      """
+      True if the snapshots are indexed like the network's links and OD
+      pairs.
+      """
+      return (self.metadata['linkOrder'] == orderFingerprint(link.ID for link in network.linkList)
+              and self.metadata['ODOrder'] == orderFingerprint(od.ID for od in network.ODlist))
+
+   def block(self, field):
+      if field not in self.blocks:
+         raise BadTrajectoryException("Trajectory file %s has no %s field" % (self.fileName, field))
+      return self.blocks[field]
+
+   def find(self, iteration):
+      """
+      Number of the snapshot taken at iteration.
+      """
+      for k, recorded in enumerate(self.iterations):
+         if recorded == iteration:
+            return k
+      raise BadTrajectoryException("Iteration %d is not in trajectory file %s" % (iteration, self.fileName))
+
+   def snapshot(self, k, field = 'flow'):
+      """
+      The values of field in snapshot k (negative counts from the last).
+      """
+      values, size = self.block(field)
+      if k < 0:
+         k += self.count
+      if not 0 <= k < self.count:
+         raise BadTrajectoryException("Trajectory file %s has no snapshot %d (it has %d)" % (self.fileName, k, self.count))
+      return values[k * size : (k + 1) * size]
+
+   def series(self, position, field = 'flow', start = 0, stop = None):
+      """
+      The values of one link (field 'flow' or 'cost', position link.index)
+      or OD pair ('demand', OD.index) in snapshots start..stop-1.
+      """
+      values, size = self.block(field)
+      if not 0 <= position < size:
+         raise BadTrajectoryException("No %s position %d in trajectory file %s" % (field, position, self.fileName))
+      stop = self.count if stop is None else min(stop, self.count)
+      return values[start * size + position : stop * size : size]
+
+   def spread(self, field = 'flow', start = 0, stop = None):
+      """
+      Per position, the difference between the largest and smallest value
+      of field over snapshots start..stop-1, e.g. the amplitude of
+      oscillating link flows in the last snapshots.  Reads one snapshot at
+      a time.
+      """
+      stop = self.count if stop is None else min(stop, self.count)
+      if stop <= start:
+         raise BadTrajectoryException("No snapshots in range %d..%d" % (start, stop))
+      low = array('d', self.snapshot(start, field))
+      high = array('d', low)
+      for k in range(start + 1, stop):
+         row = self.snapshot(k, field)
+         low = array('d', map(min, low, row))
+         high = array('d', map(max, high, row))
+         row.release()
+      return array('d', [h - l for h, l in zip(high, low)])
+
+   def close(self):
+      """
+      Releases the mapping.  Rows and series returned by snapshot() and
+      series() are views into the mapping, so they must have been dropped
+      (or released) first.
+      """
+      if self.map is None:
+         return
+      if hasattr(self, 'blocks'):
+         for values, size in self.blocks.values():
+            values.release()
+      try:
+         self.map.close()
+      except BufferError:
+         raise BadTrajectoryException("Snapshots of trajectory file %s are still in use" % self.fileName)
+      self.file.close()
+      self.map = None
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, excType, excValue, excTraceback):
+      self.close()
+      return False
+
+def openTrajectory(fileName, network = None):
+   """
+   Maps a trajectory file read-only; if a network is given, its links and
+   OD pairs must be the ones the snapshots are indexed by.
+   """
+   trajectory = Trajectory(fileName)
+   if network is not None and not trajectory.matches(network):
+      trajectory.close()
+      raise BadTrajectoryException("Trajectory file %s was recorded on a different network" % fileName)
+   return trajectory
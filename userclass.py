@@ -0,0 +1,89 @@
+from network import Network, BadNetworkOperationException
+from array import array
+
+class UserClass:
+   """
+   One user class for multi-class assignment (Network.RELAXEDuserEquilibrium
+   with userClasses): its own OD table and attractiveness parameters, demand
+   function, generalized cost weights and passenger car equivalent.
+      demandFile     -- TNTP trip table of the class; if None, the class uses
+                        the network's own OD pairs (at most one class should)
+      attributeFile  -- optional attractiveness file in the printODFile
+                        format (see Network.readODFile) for those OD pairs
+      demandFunction -- one of the network's targetDemands* methods
+      tollFactor, distanceFactor -- generalized cost weights of tolls and
+                        length; default to the network's
+      pce            -- passenger car equivalent of one trip of the class, the
+                        weight of its flow in the link flows that determine
+                        travel times
+
+   A class has the OD-side attributes of a Network (ODpair, ODlist,
+   originODs, relevant_origins, weightBuffer, telework_multiplier, and
+   openInput without an inputPrefetch), so the network's demand file readers
+   and per-origin demand kernels run on it unchanged.  After a solve, flows
+   holds the class's link flows (in trips of the class, indexed by
+   link.index), and the OD objects its demands.
+   """
+
+   def __init__(self, network, name, demandFile = None, attributeFile = None, demandFunction = None,
+                tollFactor = None, distanceFactor = None, pce = 1.0):
+      self.network = network
+      self.name = name
+      self.tollFactor = network.tollFactor if tollFactor is None else tollFactor
+      self.distanceFactor = network.distanceFactor if distanceFactor is None else distanceFactor
+      self.pce = pce
+      self.demandFunction = demandFunction if demandFunction is not None else network.targetDemandsRelaxed
+      self.originDemands = getattr(Network, network.originDemandFunction(self.demandFunction).__name__)
+      self.telework_multiplier = network.telework_multiplier
+      self.numZones = network.numZones
+      self.totalDemand = 0
+      self.inputPrefetch = None
+
+      if demandFile is None:
+         self.ODpair = network.ODpair
+         self.ODlist = network.ODlist
+         self.originODs = network.originODs
+         self.relevant_origins = network.relevant_origins
+      else:
+         self.ODpair = dict()
+         Network.readDemandFile(self, demandFile)
+         if attributeFile is not None:
+            Network.readODFile(self, attributeFile)
+         self.buildODList()
+      self.targetDemands = array(network.storageType, [0.0]) * len(self.ODlist)
+      self.weightBuffer = array(network.storageType, [0.0]) * len(self.ODlist)
+      self.flows = None
+      self.targetFlows = None
+
+   openInput = Network.openInput
+
+   def buildODList(self):
+      """
+      Positions of the class's OD pairs, grouped by origin as in
+      Network.buildWorkBuffers.
+      """
+      self.ODlist = list()
+      self.originODs = dict()
+      self.relevant_origins = set()
+      for ODID in sorted(self.ODpair, key = lambda ODID : self.ODpair[ODID].origin):
+         od = self.ODpair[ODID]
+         if od.origin not in self.network.node or od.destination not in self.network.node:
+            raise BadNetworkOperationException("OD pair %s of class %s is not in the network" % (ODID, self.name))
+         od.ID = ODID
+         od.index = len(self.ODlist)
+         self.ODlist.append(od)
+         self.originODs.setdefault(od.origin, list()).append(od)
+         self.relevant_origins.add(od.origin)
+
+   def costKey(self):
+      """
+      Classes with equal keys have the same link costs and share shortest
+      path trees.
+      """
+      return (self.tollFactor, self.distanceFactor)
+
+   def linkFlows(self):
+      """
+      Dictionary mapping link IDs to the class's flow after a solve.
+      """
+      return dict((link.ID, self.flows[link.index]) for link in self.network.linkList)